@@ -0,0 +1,105 @@
+import numpy as np
+
+import generate_stats
+import instrumentation
+import ndvi_histogram
+import ndvi_storage
+
+# This module detects where vegetation changed between two dates of an area.
+# Every pixel of both NDVI matrices is assigned a class code and the pair of codes of a pixel is stored
+# as a single transition code in an 8 bit raster: start_code * CLASS_COUNT + end_code. Class code 0 holds
+# the pixels which do not belong to any class (below the lowest threshold or NaN), and class code i holds
+# the pixels of the class with the i-th lowest threshold in NDVI_CLASS_VARIABLES. Both matrices are read in
+# aligned blocks of rows, so only a single block of each is held in memory at a time.
+
+CLASS_NAMES = ["Unclassified", "No Vegetation", "Sparse Vegetation", "Moderate Vegetation", "Thick Vegetation"]
+CLASS_COUNT = len(CLASS_NAMES)
+
+TRANSITION_RASTER_FILENAME = "change_transitions.tmp.npy"
+TRANSITION_SUMMARY_FILENAME = "change_summary.tmp.csv"
+
+
+# Class to read blocks of rows of an NDVI matrix stored by the ndvi-generator, in either format.
+# A .npy matrix is memory mapped. A matrix in the compact format is decoded one chunk at a time.
+class NDVIBlockReader:
+    def __init__(self, ndvi_data_path: str):
+        self.matrix = generate_stats.loadNDVI(ndvi_data_path)
+        self.shape = self.matrix.shape
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if(isinstance(self.matrix, ndvi_storage.CompactMatrix)):
+            self.matrix.close()
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self.matrix[start:stop]
+
+
+# Function to assign the class code of every pixel of a block
+def classifyBlock(block: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    codes = np.digitize(block, thresholds).astype(np.uint8)
+
+    # NaN pixels are placed in the highest class by digitize, but they do not belong to any class
+    codes[np.isnan(block)] = 0
+    return codes
+
+
+# Function to calculate the transition raster between the NDVI matrices of two dates and write it to the given file.
+# Returns the transition matrix, where element [i, j] is the number of pixels which changed from class code i
+# to class code j. The raster is written block by block into a memory mapped file.
+@instrumentation.instrumented("change_detection")
+def detectChange(ndvi_data_path_start: str, ndvi_data_path_end: str, raster_filename: str = TRANSITION_RASTER_FILENAME, block_rows: int = generate_stats.CLASSIFICATION_BLOCK_ROWS) -> np.ndarray:
+    thresholds = np.array(ndvi_histogram.getClassThresholds())
+    transitions = np.zeros(CLASS_COUNT * CLASS_COUNT, dtype = np.int64)
+
+    with NDVIBlockReader(ndvi_data_path_start) as reader_start, NDVIBlockReader(ndvi_data_path_end) as reader_end:
+        if(reader_start.shape != reader_end.shape):
+            raise ValueError(f"The NDVI matrices have different shapes {reader_start.shape} and {reader_end.shape}")
+
+        raster = np.lib.format.open_memmap(raster_filename, mode = "w+", dtype = np.uint8, shape = reader_start.shape)
+
+        for start in range(0, reader_start.shape[0], block_rows):
+            stop = min(start + block_rows, reader_start.shape[0])
+
+            codes = classifyBlock(reader_start.read(start, stop), thresholds)
+            codes *= CLASS_COUNT
+            codes += classifyBlock(reader_end.read(start, stop), thresholds)
+
+            raster[start:stop] = codes
+            transitions += np.bincount(codes.ravel(), minlength = CLASS_COUNT * CLASS_COUNT)
+
+        raster.flush()
+        del raster
+
+    return transitions.reshape(CLASS_COUNT, CLASS_COUNT)
+
+
+# Function to write the summary table of a transition matrix as a CSV file.
+# Every row holds a pair of classes with the number and percentage of pixels which changed from one to the other.
+def writeChangeSummary(transitions: np.ndarray, filename: str = TRANSITION_SUMMARY_FILENAME) -> None:
+    total_pixels = int(transitions.sum())
+
+    with open(filename, "w") as file:
+        file.write("from_class,to_class,pixels,percent\n")
+        for start_code, start_name in enumerate(CLASS_NAMES):
+            for end_code, end_name in enumerate(CLASS_NAMES):
+                pixels = int(transitions[start_code, end_code])
+                file.write(f"{start_name},{end_name},{pixels},{pixels / max(total_pixels, 1) * 100:.4f}\n")
+
+
+# Function to print the transitions between different classes, largest first
+def printChangeSummary(transitions: np.ndarray) -> None:
+    total_pixels = int(transitions.sum())
+
+    changes = [
+        (int(transitions[start_code, end_code]), start_name, end_name)
+        for start_code, start_name in enumerate(CLASS_NAMES)
+        for end_code, end_name in enumerate(CLASS_NAMES)
+        if start_code != end_code and transitions[start_code, end_code] > 0
+    ]
+
+    print("\nClass transitions:")
+    for (pixels, start_name, end_name) in sorted(changes, reverse = True):
+        print(f"{start_name} -> {end_name}: {pixels / max(total_pixels, 1) * 100:.2f} %")
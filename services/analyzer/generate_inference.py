@@ -1,8 +1,24 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import pandas as pd
 import math
 import datetime
 import os
+import sys
+import prophet
 from prophet import Prophet
+from prophet.serialize import model_from_json, model_to_json
+
+# This module also runs on its own (from WSL), so it is an entry point too, and adds the path of the modules shared
+# by all the services unless the main module of the analyzer has added it already
+common_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common")
+if(common_path not in sys.path):
+    sys.path.append(common_path)
+import instrumentation
+
+instrumentation.setService("analyzer")
 
 
 # This is used to suppress extra output from libraries which are not required in this case.
@@ -39,57 +55,269 @@ class suppress_stdout_stderr(object):
         os.close(self.null_fds[1])
 
 
-def infer(input_data) -> str:
-    df = pd.read_csv(input_data)
-    df.sort_values("ds", inplace = True, ignore_index = True)
+# Filename of the table in which the forecasts of the batch mode are stored
+FORECAST_TABLE_FILENAME = "forecasts.tmp.csv"
+
+# Parameters the models are created with. These are part of the key of every cached model.
+MODEL_PARAMETERS = {}
+
+# Fitted models are cached in this directory (MODEL_CACHE_DIR in the environment), keyed by a hash of the time series
+# and the model parameters. The least recently used models are removed once the cache grows beyond
+# MODEL_CACHE_MAX_MB megabytes. Setting MODEL_CACHE_MAX_MB to 0 disables the cache.
+DEFAULT_MODEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache.tmp")
+DEFAULT_MODEL_CACHE_MAX_MB = 256
+
+
+# Function to convert the time series given to the inferencer into a data frame sorted by date.
+# The series is either a data frame, a dictionary of lists, a list of records or the filename of a CSV file.
+def loadSeries(input_data) -> pd.DataFrame:
+    if(isinstance(input_data, pd.DataFrame)):
+        df = input_data
+    elif(isinstance(input_data, (dict, list))):
+        df = pd.DataFrame(input_data)
+    else:
+        df = pd.read_csv(input_data, dtype = { "area": str, "ds": str })
+
+    return df.sort_values("ds", ignore_index = True)
+
+
+# Function to calculate the key of the cached model of a time series
+def getModelKey(df: pd.DataFrame) -> str:
+    series = df[["ds", "y"]].astype({ "ds": str, "y": float }).to_csv(index = False)
+    parameters = json.dumps(MODEL_PARAMETERS, sort_keys = True)
+    return hashlib.sha256(f"{series}{parameters}{prophet.__version__}".encode()).hexdigest()
+
+
+# Function to remove the least recently used models from the cache until it fits within the given size.
+# Other processes may be using the cache at the same time, so models which have already been removed are ignored.
+def evictModels(cache_dir: str, max_bytes: float) -> None:
+    entries = []
+    for filename in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        except FileNotFoundError:
+            continue
+
+    total_bytes = sum(size for (_, size, _) in entries)
+    for (_, size, filename) in sorted(entries):
+        if(total_bytes <= max_bytes):
+            break
+
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+# Function to get a model fitted to a time series.
+# If a model was already fitted to the same time series with the same parameters, it is loaded from the cache.
+# Otherwise the model is fitted and stored in the cache.
+def fitModel(df: pd.DataFrame) -> Prophet:
+    cache_dir = os.environ.get("MODEL_CACHE_DIR", DEFAULT_MODEL_CACHE_DIR)
+    max_bytes = float(os.environ.get("MODEL_CACHE_MAX_MB", DEFAULT_MODEL_CACHE_MAX_MB)) * 1024 * 1024
+    model_path = os.path.join(cache_dir, getModelKey(df) + ".json")
+
+    if(max_bytes > 0 and os.path.isfile(model_path)):
+        try:
+            with open(model_path, "r") as file:
+                model = model_from_json(file.read())
+
+            # Mark the model as recently used
+            os.utime(model_path)
+            return model
+        except (OSError, ValueError):
+            # The model was removed by another process or is damaged, so it is fitted again
+            pass
 
     # Create the model
-    model = Prophet()
+    model = Prophet(**MODEL_PARAMETERS)
 
     # Fit the model and suppress extra unnecessary output
-    with suppress_stdout_stderr():
+    with suppress_stdout_stderr(), instrumentation.measure("prophet_fit"):
         model.fit(df)
 
-    # For calculation of rate of change of forest cover, we need to select two dates and calculate the
-    # change between them. Here, we select them. For the starting date, we select the December of 2016
-    # because we have data from 2016 and not before that (Sentinel was deployed in 2015). For the end
-    # date, we select whatever the current year is. We take December 2020 because we are concerned with the
-    # change in forest cover by the end of the year. Subsequently, we have to take December of 2016 due
-    # to the effects of seasonality over time series data.
-    current_year = datetime.date.today().year
-    end_date = f"{current_year - 1}-12"
-    start_date = "2016-12"
+    if(max_bytes > 0):
+        # The model is written under a name unique to this process and then renamed, so that other
+        # processes never read a partially written model
+        os.makedirs(cache_dir, exist_ok = True)
+        partial_path = f"{model_path}.{os.getpid()}.partial"
+        with open(partial_path, "w") as file:
+            file.write(model_to_json(model))
+        os.replace(partial_path, model_path)
 
-    # Area under forest cover at start date. This is taken from the dataset.
-    area_at_start_date = round(model.predict(pd.DataFrame.from_dict({'ds': [start_date]}))['yhat'].tolist()[0])
+        evictModels(cache_dir, max_bytes)
 
-    # Area under forest cover at end date. This is predicted from the fitted model.
-    area_at_end_date = round(model.predict(pd.DataFrame.from_dict({'ds': [end_date]}))['yhat'].tolist()[0])
+    return model
 
-    # Calculate and print the rate of change of forest cover.
-    r = (1 / (current_year - 2016 - 1)) * math.log(((area_at_end_date * 100) / (area_at_start_date * 100)))
-    print(f"\nRate of {'Deforestation' if r < 0.0 else 'Reforestation'} calculated from December 2016 to December {current_year - 1}: {round(abs(r * 100), 2)} % per year\n")
 
-    # Now we predict the change in forest cover. Here, we say how much forest cover will change in the current
-    # year from a similar time in last year. Again, this similar time is important because of seasonality.
+# Function to get the dates needed for the forecast in a given year.
+# For calculation of rate of change of forest cover, we need to select two dates and calculate the
+# change between them. For the starting date, we select the December of 2016 because we have data
+# from 2016 and not before that (Sentinel was deployed in 2015). For the end date, we select the
+# December of the previous year because we are concerned with the change in forest cover by the end
+# of the year. Subsequently, we have to take December of 2016 due to the effects of seasonality over
+# time series data. The forest cover is then predicted for the December of the current year.
+def getForecastDates(current_year: int) -> dict:
+    return {
+        "start_date": "2016-12",
+        "previous_date": f"{current_year - 1}-12",
+        "end_date": f"{current_year}-12"
+    }
 
-    # We first determine the previous year and get the forest cover from dataset.
-    previous_date = f"{current_year - 1}-12"
-    area_at_previous_date = df.loc[df['ds'] == previous_date]['y'].tolist()[0]
 
-    end_date = f"{current_year}-12"
-    area_at_end_date = round(model.predict(pd.DataFrame.from_dict({'ds': [end_date]}))['yhat'].tolist()[0])
+# Function to fit a model to the time series of an area and calculate the forecast.
+# All the dates needed are predicted in a single call to the model.
+def forecastSeries(df: pd.DataFrame, current_year: int) -> dict:
+    df = df.sort_values("ds", ignore_index = True)
+    dates = getForecastDates(current_year)
 
-    # Then we calculate how many pixels will change.
-    changed_area = area_at_end_date - area_at_previous_date
+    # Get the fitted model, from the cache if the same series has been fitted before
+    model = fitModel(df)
 
+    with instrumentation.measure("prophet_predict"):
+        prediction = model.predict(pd.DataFrame.from_dict({ "ds": [dates["start_date"], dates["previous_date"], dates["end_date"]] }))
+    area_at_start_date, area_at_previous_end_date, area_at_end_date = [round(value) for value in prediction["yhat"].tolist()]
+
+    # Calculate the rate of change of forest cover from the start date to the December of the previous year.
+    r = (1 / (current_year - 2016 - 1)) * math.log(((area_at_previous_end_date * 100) / (area_at_start_date * 100)))
+
+    # Now we predict the change in forest cover. Here, we say how much forest cover will change in the current
+    # year from a similar time in last year. Again, this similar time is important because of seasonality.
+    # We first determine the forest cover in the previous year from the dataset.
+    previous_values = df.loc[df["ds"] == dates["previous_date"]]["y"].tolist()
+    area_at_previous_date = previous_values[0] if len(previous_values) > 0 else None
+
+    # Then we calculate how many pixels will change.
     # As each pixel represents a 10 meter by 10 meter (100 meter square) area, we first multiply by 100
     # This gives us the total area in square meters. Then we convert it to square kilometers by dividing
     # by 10^6
-    changed_area = (changed_area * 100) / 1000000
+    changed_area = None
+    if(area_at_previous_date is not None):
+        changed_area = ((area_at_end_date - area_at_previous_date) * 100) / 1000000
+
+    return {
+        **dates,
+        "yhat_start": area_at_start_date,
+        "yhat_previous": area_at_previous_end_date,
+        "yhat_end": area_at_end_date,
+        "y_previous": area_at_previous_date,
+        "rate_percent": r * 100,
+        "changed_area_km2": changed_area
+    }
+
+
+# Function to forecast a single time series and print the forecast.
+# The series is given directly as a data frame or a dictionary with ds and y lists, or as the filename of a CSV file.
+def infer(input_data) -> None:
+    df = loadSeries(input_data)
+    current_year = datetime.date.today().year
+
+    forecast = forecastSeries(df, current_year)
+
+    # Print the rate of change of forest cover.
+    rate = forecast["rate_percent"]
+    print(f"\nRate of {'Deforestation' if rate < 0.0 else 'Reforestation'} calculated from December 2016 to December {current_year - 1}: {round(abs(rate), 2)} % per year\n")
+
+    # The change can only be predicted relative to the December of the previous year if it is in the time series
+    changed_area = forecast["changed_area_km2"]
+    if(changed_area is None):
+        print(f"\nThe change in land cover by December {current_year} cannot be predicted, as there is no baseline: the time series has no value for December {current_year - 1}")
+        return
 
     print(f"\nApproximately {round(abs(changed_area), 2)} square kilometers of land will be {'Deforested' if changed_area < 0.0 else 'Reforested'} by December {current_year} compared to that in December {current_year - 1}")
 
 
+# Function to calculate a hash of the time series of an area and the model parameters along with the dates it is forecast for.
+# The forecast of an area is only recalculated when this changes.
+def hashSeries(df: pd.DataFrame, current_year: int) -> str:
+    dates = ",".join(getForecastDates(current_year).values())
+    return hashlib.sha256(f"{getModelKey(df.sort_values('ds', ignore_index = True))}{dates}".encode()).hexdigest()
+
+
+# Function to fit the model of an area in a worker process and return its forecast along with the identifying columns
+def _forecastArea(area: str, df: pd.DataFrame, series_hash: str, current_year: int) -> dict:
+    with instrumentation.labels(area = area):
+        forecast = forecastSeries(df, current_year)
+
+    return {
+        "area": area,
+        "series_hash": series_hash,
+        "fitted_at": datetime.datetime.now().isoformat(timespec = "seconds"),
+        **forecast
+    }
+
+
+# Function to forecast every area of a time series with area, ds and y columns (as output by the series mode
+# of the analyzer) and store the forecasts in a table. One model is fitted per area in a pool of worker processes.
+# Areas whose time series has not changed since their forecast in the existing table was calculated are not fitted again.
+# The series is given directly as a data frame, a dictionary of lists or a list of records, or as the filename of a CSV file.
+def inferAreas(input_data, table_filename: str = FORECAST_TABLE_FILENAME, workers: int = None) -> pd.DataFrame:
+    df = loadSeries(input_data)
+    current_year = datetime.date.today().year
+
+    previous_forecasts = {}
+    if(os.path.isfile(table_filename)):
+        previous_table = pd.read_csv(table_filename, dtype = { "area": str })
+        previous_forecasts = { row["area"]: row for row in previous_table.to_dict("records") }
+
+    forecasts = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = []
+        for area, area_df in df.groupby("area", sort = True):
+            area_df = area_df[["ds", "y"]]
+            series_hash = hashSeries(area_df, current_year)
+
+            if(area in previous_forecasts and previous_forecasts[area]["series_hash"] == series_hash):
+                forecasts.append(previous_forecasts[area])
+            else:
+                futures.append(executor.submit(_forecastArea, area, area_df, series_hash, current_year))
+
+        for future in futures:
+            forecasts.append(future.result())
+
+    table = pd.DataFrame(forecasts).sort_values("area", ignore_index = True)
+    table.to_csv(table_filename, index = False)
+    return table
+
+
 if(__name__ == "__main__"):
-    change_class = infer("inference_csv.tmp.csv")
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--batch",
+        action = "store_true",
+        help = "Forecast every area of the input file and store the forecasts in a table instead of printing them"
+    )
+
+    parser.add_argument(
+        "--input",
+        help = "CSV file with the time series. Defaults to the file exported by the interactive analyzer. Required with --batch, where it is the CSV output of the series mode of the analyzer."
+    )
+
+    parser.add_argument(
+        "--output",
+        default = FORECAST_TABLE_FILENAME,
+        help = "CSV file of the forecast table used with --batch"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type = int,
+        default = os.cpu_count(),
+        help = "Number of worker processes used to fit the models with --batch"
+    )
+
+    args = parser.parse_args()
+
+    if(args.batch):
+        if(args.input is None):
+            parser.error("--input is required with --batch")
+
+        table = inferAreas(args.input, args.output, args.workers)
+        print(f"Forecasts of {len(table)} areas stored in {args.output}")
+    else:
+        infer(args.input or "inference_csv.tmp.csv")
+
+    instrumentation.writePrometheus()
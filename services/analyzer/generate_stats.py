@@ -1,55 +1,213 @@
 import os
+import re
 import numpy as np
 import matplotlib.pyplot as plt
 from dotenv import load_dotenv
 
+# The modules in common are shared by all the services. Their path is added by the entry point importing this module.
+import instrumentation
+import ndvi_histogram
+import ndvi_storage
+from object_storage import ObjectStorage
+
 load_dotenv()
 
-# Function calculates the percentages of vegetated land cover
-def calculateVegetationCover(ndvi: np.ndarray) -> dict[str: float]:
-    # Counters
-    thick_vegetation = 0
-    moderate_vegetation = 0
-    sparse_vegetation = 0
-
-    # Iterate over all the pixels and increment appropriate counters
-    for row in range(ndvi.shape[0]):
-        for column in range(ndvi.shape[1]):
-            if(ndvi[row][column] >= float(os.environ.get("NDVI_THICK_VEGETATION"))):
-                thick_vegetation += 1
-            elif(ndvi[row][column] >= float(os.environ.get("NDVI_MODERATE_VEGETATION"))):
-                moderate_vegetation += 1
-            elif(ndvi[row][column] >= float(os.environ.get("NDVI_SPARSE_VEGETATION"))):
-                sparse_vegetation += 1
-    
+# Number of rows of the NDVI matrix processed at a time. This bounds the size of the
+# temporary arrays created during classification irrespective of the size of the scene.
+CLASSIFICATION_BLOCK_ROWS = 512
+
+
+# Function to find the file of the NDVI matrix stored by the ndvi-generator at the given path.
+# The matrix is either a plain .npy file or a .npz file in the compact format (see ndvi_storage in common).
+# If no complete matrix is stored, the path of the .npy file is returned.
+def getNDVIMatrixPath(ndvi_data_path: str) -> str:
+    filename = ObjectStorage.findMatrix(ndvi_data_path, "ndvi_matrix")
+    return os.path.join(ndvi_data_path, filename or "ndvi_matrix.npy")
+
+
+# Function to load an NDVI matrix stored by the ndvi-generator.
+# A .npy matrix is memory mapped instead of being read into memory, so only the parts of the file
+# which are actually accessed are read from disk. A matrix in the compact format is opened lazily,
+# and only the chunks of the rows which are sliced from it are decoded.
+def loadNDVI(ndvi_data_path: str) -> np.ndarray:
+    matrix_path = getNDVIMatrixPath(ndvi_data_path)
+    if(matrix_path.endswith(".npz")):
+        return ndvi_storage.CompactMatrix(matrix_path)
+
+    return np.load(file = matrix_path, mmap_mode = "r")
+
+
+# Directory in which the ndvi-generator stores the pyramid of downsampled overviews of the NDVI matrix
+# (see overviews in the ndvi-generator). The overview downsampled by a factor of 4 is stored as ndvi_matrix_4.npy.
+OVERVIEW_DIRECTORY = "overviews"
+
+
+# Function to load the coarsest version of an NDVI matrix which is at least as large as the target resolution.
+# This is meant for previews. Statistics must still be calculated from the full resolution matrix.
+# Returns the matrix along with the factor by which it is downsampled (1 for the full resolution matrix).
+def loadNDVIOverview(ndvi_data_path: str, width: int, height: int) -> tuple[np.ndarray, int]:
+    overview_path = os.path.join(ndvi_data_path, OVERVIEW_DIRECTORY)
+    overviews = {}
+    if(os.path.isdir(overview_path)):
+        for filename in os.listdir(overview_path):
+            match = re.fullmatch(r"ndvi_matrix_(\d+)\.npy", filename)
+            if(match is not None):
+                overviews[int(match.group(1))] = np.load(os.path.join(overview_path, filename), mmap_mode = "r")
+
+    suitable_factors = [
+        factor for factor, matrix in overviews.items()
+        if matrix.shape[0] >= height and matrix.shape[1] >= width
+    ]
+    if(len(suitable_factors) == 0):
+        return loadNDVI(ndvi_data_path), 1
+
+    factor = max(suitable_factors)
+    return overviews[factor], factor
+
+
+# Width and height of the previews of NDVI matrices, in pixels
+PREVIEW_WIDTH = 1024
+PREVIEW_HEIGHT = 1024
+
+
+# Function to plot a preview of the NDVI matrix stored at the given path.
+# The coarsest overview which meets the resolution of the preview is read instead of the full resolution matrix.
+# If there is no such overview, every n-th row and column of the matrix is read, one row at a time.
+def plotNDVIPreview(ndvi_data_path: str, width: int = PREVIEW_WIDTH, height: int = PREVIEW_HEIGHT) -> None:
+    ndvi, factor = loadNDVIOverview(ndvi_data_path, width, height)
+
+    step = max(1, min(ndvi.shape[0] // height, ndvi.shape[1] // width))
+    preview = np.stack([np.asarray(ndvi[row:row + 1])[0, ::step] for row in range(0, ndvi.shape[0], step)])
+    if(isinstance(ndvi, ndvi_storage.CompactMatrix)):
+        ndvi.close()
+
+    figure, axis = plt.subplots(figsize = (10, 10))
+    image = axis.imshow(preview, cmap = "RdYlGn", vmin = -1, vmax = 1, interpolation = "nearest")
+    figure.colorbar(image, ax = axis, fraction = 0.046, pad = 0.04, label = "NDVI")
+    axis.set_axis_off()
+    axis.set_title(f"NDVI (1/{factor * step} resolution)", loc = "left")
+
+    # Output the plot
+    filename = "ndvi_preview.tmp.png"
+    plt.savefig(filename)
+    plt.close(figure)
+
+    # Print the output location to terminal so that it can be accessed easily
+    print(f"Preview: {os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)}")
+
+
+# Function to get the keys of the NDVI classes in all the statistics dictionaries, in ascending order of their
+# thresholds. Each class is identified by the value of the environment variable holding its lower threshold.
+def getClassKeys() -> list[str]:
+    return [os.environ.get(variable) for variable in ndvi_histogram.NDVI_CLASS_VARIABLES]
+
+
+# Function to count the pixels falling in each of the NDVI classes in a single pass over the matrix.
+# A pixel belongs to a class if its value is greater than or equal to the threshold of that class and
+# less than the threshold of the next higher class. Pixels below the lowest threshold and NaN pixels
+# are not counted in any class.
+def classifyNDVI(ndvi: np.ndarray) -> dict[str: int]:
+    # Index 0 of the counts holds the pixels below the lowest threshold, index i holds the pixels of class i - 1
+    counts = ndvi_histogram.computeHistogram(ndvi, ndvi_histogram.getClassThresholds(), CLASSIFICATION_BLOCK_ROWS)["counts"]
+
+    # Construct a dictionary with the counts of each class
+    class_dict = { key: int(count) for key, count in zip(getClassKeys(), counts[1:]) }
+    class_dict["total_pixels"] = int(ndvi.size)
+
+    return class_dict
+
+
+# Function to build the histogram of an NDVI matrix and store it alongside the matrix
+def storeHistogram(ndvi: np.ndarray, ndvi_data_path: str) -> dict[str: np.ndarray]:
+    histogram = ndvi_histogram.computeHistogram(ndvi, block_rows = CLASSIFICATION_BLOCK_ROWS)
+
+    # The histogram is only a cache, so failing to store it is not an error
+    try:
+        np.savez(os.path.join(ndvi_data_path, ndvi_histogram.HISTOGRAM_FILENAME), **histogram)
+    except OSError as e:
+        print(f"Could not store histogram in {ndvi_data_path}: {e}")
+
+    return histogram
+
+
+# Function to load the histogram stored alongside an NDVI matrix.
+# Returns None if there is no histogram or if it is older than the matrix.
+def loadHistogram(ndvi_data_path: str) -> dict[str: np.ndarray]:
+    histogram_path = os.path.join(ndvi_data_path, ndvi_histogram.HISTOGRAM_FILENAME)
+    matrix_path = getNDVIMatrixPath(ndvi_data_path)
+
+    try:
+        if(os.path.getmtime(histogram_path) < os.path.getmtime(matrix_path)):
+            return None
+
+        with np.load(histogram_path) as histogram:
+            return { name: histogram[name] for name in ("edges", "counts", "total_pixels") }
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# Function to calculate the class counts from a histogram.
+# Returns None if the histogram cannot answer the current thresholds.
+def classifyHistogram(histogram: dict[str: np.ndarray]) -> dict[str: int]:
+    counts = ndvi_histogram.classifyHistogram(histogram)
+    if(counts is None):
+        return None
+
+    # Construct a dictionary with the counts of each class
+    class_dict = dict(zip(getClassKeys(), counts))
+    class_dict["total_pixels"] = int(histogram["total_pixels"])
+
+    return class_dict
+
+
+# Function to get the class counts of the NDVI matrix stored at the given path.
+# The counts are answered from the histogram stored alongside the matrix without reading the matrix.
+# If there is no valid histogram, or it cannot answer the current thresholds, the histogram is rebuilt
+# from the matrix in a single pass and stored again for the following queries.
+def loadClassCounts(ndvi_data_path: str) -> dict[str: int]:
+    with instrumentation.measure("stats", scene = ndvi_data_path):
+        histogram = loadHistogram(ndvi_data_path)
+        if(histogram is not None):
+            class_counts = classifyHistogram(histogram)
+            if(class_counts is not None):
+                return class_counts
+
+        with instrumentation.measure("stats_rebuild_histogram"):
+            ndvi = loadNDVI(ndvi_data_path)
+            histogram = storeHistogram(ndvi, ndvi_data_path)
+            if(isinstance(ndvi, ndvi_storage.CompactMatrix)):
+                ndvi.close()
+        return classifyHistogram(histogram)
+
+
+# Function calculates the percentages of vegetated land cover.
+# If the class counts of the matrix have already been calculated, they can be passed in to avoid
+# scanning the matrix again.
+def calculateVegetationCover(ndvi: np.ndarray = None, class_counts: dict[str: int] = None) -> dict[str: float]:
+    if(class_counts is None):
+        class_counts = classifyNDVI(ndvi)
+
     # Construct a dictionary with the above statistics
     vegetation_dict = {
-        os.environ.get("NDVI_SPARSE_VEGETATION"): sparse_vegetation,
-        os.environ.get("NDVI_MODERATE_VEGETATION"): moderate_vegetation,
-        os.environ.get("NDVI_THICK_VEGETATION"): thick_vegetation,
-        "total_pixels": ndvi.shape[0] * ndvi.shape[1]
+        os.environ.get("NDVI_SPARSE_VEGETATION"): class_counts[os.environ.get("NDVI_SPARSE_VEGETATION")],
+        os.environ.get("NDVI_MODERATE_VEGETATION"): class_counts[os.environ.get("NDVI_MODERATE_VEGETATION")],
+        os.environ.get("NDVI_THICK_VEGETATION"): class_counts[os.environ.get("NDVI_THICK_VEGETATION")],
+        "total_pixels": class_counts["total_pixels"]
     }
     
     return vegetation_dict
 
 
-# Function calculates the percentages of non-vegetated regions
-def calculateLandCover(ndvi: np.ndarray) -> dict[str: float]:
-    # Counters
-    no_vegetation = 0
-    barren = 0
+# Function calculates the percentages of non-vegetated regions.
+# As above, precalculated class counts can be passed in to avoid scanning the matrix again.
+def calculateLandCover(ndvi: np.ndarray = None, class_counts: dict[str: int] = None) -> dict[str: float]:
+    if(class_counts is None):
+        class_counts = classifyNDVI(ndvi)
 
-    # Again, iterate over all the pixels and update appropriate counters
-    for row in range(ndvi.shape[0]):
-        for column in range(ndvi.shape[1]):
-            if(ndvi[row][column] < float(os.environ.get("NDVI_SPARSE_VEGETATION")) and 
-                ndvi[row][column] >= float(os.environ.get("NDVI_NO_VEGETATION"))):
-                no_vegetation += 1
-    
     # Construct a dictionary from the above statistics
     land_dict = {
-        os.environ.get("NDVI_NO_VEGETATION"): no_vegetation,
-        "total_pixels": ndvi.shape[0] * ndvi.shape[1]
+        os.environ.get("NDVI_NO_VEGETATION"): class_counts[os.environ.get("NDVI_NO_VEGETATION")],
+        "total_pixels": class_counts["total_pixels"]
     }
     
     return land_dict
@@ -1,29 +1,268 @@
+import argparse
+import concurrent.futures
+import csv
+import json
 import numpy as np
 import os
+import sys
 from dotenv import load_dotenv
 import mariadb
 
+# The modules in common are shared by all the services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import instrumentation
+import ndvi_histogram
+
+import generate_change
 import generate_stats
 
-load_dotenv()
+# The Prophet library used by the inference section is not available on Windows
+try:
+    import generate_inference
+except ImportError:
+    generate_inference = None
 
-if(__name__ == "__main__"):
-    # Setup connection to database
+load_dotenv()
+instrumentation.setService("analyzer")
+
+# Modes of the non-interactive command line interface.
+# stats calculates the vegetation and land cover of every selected image, change calculates the change in cover
+# between every pair of consecutive selected images of an area and series outputs the vegetation time series of
+# every area in the format expected by the inference section. forecast sends the time series of every area
+# straight to the inference section and outputs the forecasts.
+MODES = ("stats", "change", "series", "forecast")
+
+# Query for the dates and NDVI data paths of the processed images of an area, in date order.
+# The area is joined by name so that the lookup uses the indexes on AREAS(area_name) and STORED_DATA_INFO(area_id, ndvi_generated, date).
+AREA_SCENES_QUERY = (
+    "SELECT STORED_DATA_INFO.date, STORED_DATA_INFO.ndvi_data_path FROM STORED_DATA_INFO "
+    "JOIN AREAS ON AREAS.area_id = STORED_DATA_INFO.area_id "
+    "WHERE AREAS.area_name = ? AND STORED_DATA_INFO.ndvi_generated = ? ORDER BY STORED_DATA_INFO.date"
+)
+
+# The NDVI classes, along with the names used for them in the output of the command line interface
+NDVI_CLASS_NAMES = {
+    "NDVI_THICK_VEGETATION": "thick_vegetation",
+    "NDVI_MODERATE_VEGETATION": "moderate_vegetation",
+    "NDVI_SPARSE_VEGETATION": "sparse_vegetation",
+    "NDVI_NO_VEGETATION": "no_vegetation"
+}
+
+
+# Function to fetch the images with generated NDVI data of the given areas (all areas if none are given) in a single query.
+# Returns a dictionary from area name to a list of (date, ndvi_data_path) sorted by date.
+def fetchScenes(cursor, area_names: list[str] = None) -> dict[str: list[tuple]]:
+    query = (
+        "SELECT AREAS.area_name, STORED_DATA_INFO.date, STORED_DATA_INFO.ndvi_data_path FROM STORED_DATA_INFO "
+        "JOIN AREAS ON AREAS.area_id = STORED_DATA_INFO.area_id WHERE STORED_DATA_INFO.ndvi_generated = ?"
+    )
+    parameters = [1]
+    if(area_names):
+        query += f" AND AREAS.area_name IN ({', '.join('?' for _ in area_names)})"
+        parameters += list(area_names)
+
+    cursor.execute(query, tuple(parameters))
+
+    scenes = { area_name: [] for area_name in (area_names or []) }
+    for (area_name, date, ndvi_data_path) in cursor:
+        scenes.setdefault(area_name, []).append((date, ndvi_data_path))
+
+    for area_scenes in scenes.values():
+        area_scenes.sort(key = lambda scene: scene[0])
+
+    return scenes
+
+
+# Function to fetch the class counts of the images of the given areas (all areas if none are given) from the vegetation
+# time series table maintained by the ndvi-generator, with a single query. Only counts calculated with the current
+# thresholds are returned. Returns a dictionary from the NDVI data path of every image to its class counts, in the
+# same format as generate_stats.loadClassCounts. Images which are missing from the table are not in the dictionary.
+def fetchClassCounts(cursor, area_names: list[str] = None) -> dict[str: dict[str: int]]:
+    query = (
+        "SELECT STORED_DATA_INFO.ndvi_data_path, VEGETATION_SERIES.total_pixels, VEGETATION_SERIES.no_vegetation_pixels, "
+        "VEGETATION_SERIES.sparse_vegetation_pixels, VEGETATION_SERIES.moderate_vegetation_pixels, VEGETATION_SERIES.thick_vegetation_pixels "
+        "FROM VEGETATION_SERIES JOIN STORED_DATA_INFO ON STORED_DATA_INFO.id = VEGETATION_SERIES.data_id "
+        "JOIN AREAS ON AREAS.area_id = VEGETATION_SERIES.area_id WHERE VEGETATION_SERIES.thresholds = ?"
+    )
+    parameters = [ndvi_histogram.getThresholdsKey()]
+    if(area_names):
+        query += f" AND AREAS.area_name IN ({', '.join('?' for _ in area_names)})"
+        parameters += list(area_names)
+    query += " ORDER BY VEGETATION_SERIES.area_id, VEGETATION_SERIES.date"
+
+    # Databases set up before the table was added do not have it, so every image is then classified from its histogram
     try:
-        connection = mariadb.connect(
-            user = os.environ.get("MYSQL_USER"),
-            password = os.environ.get("MYSQL_PASSWORD"),
-            host = os.environ.get("MYSQL_HOST"),
-            port = int(os.environ.get("MYSQL_PORT")),
-            database = os.environ.get("MYSQL_DATABASE")
-        )
+        cursor.execute(query, tuple(parameters))
+        rows = cursor.fetchall()
     except mariadb.Error as e:
-        print(f"Error connecting to MariaDB Platform: {e}")
-        exit(1)
-    
-    # Get the cursor to the database
-    cursor = connection.cursor()
+        print(f"Could not read the vegetation time series: {e}", file = sys.stderr)
+        return {}
+
+    # The keys of the classes are in ascending order of their thresholds, like the columns of the counts
+    keys = generate_stats.getClassKeys()
+
+    class_counts = {}
+    for (ndvi_data_path, total_pixels, *counts) in rows:
+        class_counts[ndvi_data_path] = { key: int(count) for key, count in zip(keys, counts) }
+        class_counts[ndvi_data_path]["total_pixels"] = int(total_pixels)
 
+    return class_counts
+
+
+# Function to check whether the date of an image matches any of the dates given on the command line.
+# A date is given either as YYYY-MM-DD, YYYY-MM or YYYY. If no dates are given, every date matches.
+def matchesDates(date, dates: list[str]) -> bool:
+    return not dates or any(str(date).startswith(selected_date) for selected_date in dates)
+
+
+# Function to get the number of pixels of every NDVI class from class counts, keyed by the output name of the class
+def getClassPixels(class_counts: dict[str: int]) -> dict[str: int]:
+    return { name: class_counts[os.environ.get(variable)] for variable, name in NDVI_CLASS_NAMES.items() }
+
+
+# Function to summarize the class counts of a single image as pixel counts and percentages of every class
+def summarizeClassCounts(class_counts: dict[str: int]) -> dict:
+    class_pixels = getClassPixels(class_counts)
+    total_pixels = class_counts["total_pixels"]
+
+    summary = { "total_pixels": total_pixels }
+    for name, pixels in class_pixels.items():
+        summary[f"{name}_pixels"] = pixels
+        summary[f"{name}_percent"] = round(pixels / total_pixels * 100, 4)
+
+    vegetated_pixels = class_pixels["thick_vegetation"] + class_pixels["moderate_vegetation"] + class_pixels["sparse_vegetation"]
+    summary["vegetated_percent"] = round(vegetated_pixels / total_pixels * 100, 4)
+
+    return summary
+
+
+# Function to summarize the change in the class counts between two images as the percentage change of every class.
+# A positive change is an increase in the cover of the class.
+def summarizeChange(class_counts_start: dict[str: int], class_counts_end: dict[str: int]) -> dict:
+    class_pixels_start = getClassPixels(class_counts_start)
+    class_pixels_end = getClassPixels(class_counts_end)
+
+    # Function to calculate a percentage change which is None when there was nothing to begin with
+    def percentChange(start: int, end: int) -> float:
+        return round((end - start) / start * 100, 4) if start > 0 else None
+
+    summary = {}
+    for name in NDVI_CLASS_NAMES.values():
+        summary[f"{name}_change_percent"] = percentChange(class_pixels_start[name], class_pixels_end[name])
+
+    vegetated_names = ("thick_vegetation", "moderate_vegetation", "sparse_vegetation")
+    summary["vegetated_change_percent"] = percentChange(
+        sum(class_pixels_start[name] for name in vegetated_names),
+        sum(class_pixels_end[name] for name in vegetated_names)
+    )
+
+    return summary
+
+
+# Function to run the selected mode over the selected areas and dates without any prompts.
+# Class counts are read from the vegetation time series table. Those of images missing from the table are
+# calculated once per image in a pool of worker processes shared by all the areas and dates.
+# Returns the output records, one dictionary per row.
+def runBatch(cursor, mode: str, area_names: list[str], dates: list[str], workers: int, raster_dir: str = None) -> list[dict]:
+    scenes = fetchScenes(cursor, area_names)
+    for area_name, area_scenes in scenes.items():
+        if(len(area_scenes) == 0):
+            print(f"No NDVI data found for area {area_name}", file = sys.stderr)
+        scenes[area_name] = [(date, ndvi_data_path) for (date, ndvi_data_path) in area_scenes if matchesDates(date, dates)]
+
+    # The inference section does not use the 2022 data as it is not correct
+    if(mode in ("series", "forecast")):
+        for area_name, area_scenes in scenes.items():
+            scenes[area_name] = [(date, ndvi_data_path) for (date, ndvi_data_path) in area_scenes if date.year != 2022]
+
+    # Pairs of consecutive images of every area compared in the change mode
+    pairs = {
+        area_name: list(zip(area_scenes, area_scenes[1:]))
+        for area_name, area_scenes in scenes.items()
+    }
+
+    class_counts = fetchClassCounts(cursor, area_names)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+        ndvi_data_paths = sorted(set(
+            ndvi_data_path for area_scenes in scenes.values() for (date, ndvi_data_path) in area_scenes
+            if ndvi_data_path not in class_counts
+        ))
+        class_counts.update(zip(ndvi_data_paths, executor.map(generate_stats.loadClassCounts, ndvi_data_paths)))
+
+        # Transition rasters are only calculated if a directory is given to store them in
+        transitions = {}
+        if(mode == "change" and raster_dir is not None):
+            os.makedirs(raster_dir, exist_ok = True)
+            futures = {}
+            for area_name, area_pairs in pairs.items():
+                for ((date_start, path_start), (date_end, path_end)) in area_pairs:
+                    raster_filename = os.path.join(raster_dir, f"{area_name}_{date_start}_{date_end}.npy")
+                    futures[(area_name, date_start, date_end)] = (
+                        raster_filename,
+                        executor.submit(generate_change.detectChange, path_start, path_end, raster_filename)
+                    )
+
+            transitions = { key: (raster_filename, future.result()) for key, (raster_filename, future) in futures.items() }
+
+    records = []
+    for area_name, area_scenes in scenes.items():
+        if(mode == "stats"):
+            for (date, ndvi_data_path) in area_scenes:
+                records.append({ "area": area_name, "date": str(date), **summarizeClassCounts(class_counts[ndvi_data_path]) })
+
+        elif(mode == "change"):
+            for ((date_start, path_start), (date_end, path_end)) in pairs[area_name]:
+                record = {
+                    "area": area_name,
+                    "start_date": str(date_start),
+                    "end_date": str(date_end),
+                    **summarizeChange(class_counts[path_start], class_counts[path_end])
+                }
+
+                if((area_name, date_start, date_end) in transitions):
+                    raster_filename, transition_matrix = transitions[(area_name, date_start, date_end)]
+                    record["transition_raster"] = raster_filename
+                    record["changed_percent"] = round((transition_matrix.sum() - np.trace(transition_matrix)) / transition_matrix.sum() * 100, 4)
+
+                records.append(record)
+
+        elif(mode in ("series", "forecast")):
+            # Here, we consider only moderate and thick vegetation, like the interactive inference option
+            for (date, ndvi_data_path) in area_scenes:
+                class_pixels = getClassPixels(class_counts[ndvi_data_path])
+                records.append({
+                    "area": area_name,
+                    "ds": str(date)[0:7],
+                    "y": class_pixels["moderate_vegetation"] + class_pixels["thick_vegetation"]
+                })
+
+    if(mode == "forecast" and len(records) > 0):
+        if(generate_inference is None):
+            raise ImportError("The Prophet library is required to forecast. Use the series mode and run generate_inference.py from WSL instead.")
+
+        table = generate_inference.inferAreas(records, workers = workers)
+        records = table.to_dict("records")
+
+    return records
+
+
+# Function to write the output records as JSON or CSV
+def writeRecords(records: list[dict], output_format: str, file) -> None:
+    if(output_format == "json"):
+        json.dump(records, file, indent = 2)
+        file.write("\n")
+        return
+
+    # The columns are the union of the keys of all the records, in order of first appearance
+    fieldnames = list(dict.fromkeys(key for record in records for key in record))
+    writer = csv.DictWriter(file, fieldnames = fieldnames)
+    writer.writeheader()
+    writer.writerows(records)
+
+
+# Function to run the interactive menu. This is used when no mode is given on the command line.
+def runInteractive(cursor) -> None:
     print("Choose an option below:")
     print("1. Generate statistics for a particular year")
     print("2. Generate statistics for the change between 2 years")
@@ -47,7 +286,7 @@ if(__name__ == "__main__"):
 
         # After the area has been chosen, present the years for which data is available for the chosen area
         cursor.execute(
-            "SELECT date, ndvi_data_path FROM STORED_DATA_INFO WHERE area_id = (SELECT area_id FROM AREAS WHERE area_name = ?) AND ndvi_generated = ?",
+            AREA_SCENES_QUERY,
             (areas[choice_area - 1], 1)
         )
         results = []
@@ -64,11 +303,12 @@ if(__name__ == "__main__"):
         # Generate the path to NDVI matrix corresponding to the year selected
         ndvi_matrix_path: str = results[choice_date - 1][1]
 
-        # Load the NDVI matrix
-        ndvi: np.ndarray = np.load(file = os.path.join(ndvi_matrix_path, "ndvi_matrix.npy"))
+        # Get the class counts of the NDVI matrix from its stored histogram and derive both the vegetation and land cover from them.
+        # The matrix itself is only read if the histogram is missing or cannot answer the current thresholds.
+        class_counts = generate_stats.loadClassCounts(ndvi_matrix_path)
 
         # Calculate vegetation cover
-        vegetation_stats = generate_stats.calculateVegetationCover(ndvi)
+        vegetation_stats = generate_stats.calculateVegetationCover(class_counts = class_counts)
 
         # Sparse vegetation cover
         sparse_vegetation_percent = "{:.2f}".format(vegetation_stats[os.environ.get("NDVI_SPARSE_VEGETATION")] / vegetation_stats["total_pixels"] * 100)
@@ -87,13 +327,16 @@ if(__name__ == "__main__"):
         print(f"\nVegetated Area: {total_vegetation} %")
 
         # Calculate land cover
-        land_stats = generate_stats.calculateLandCover(ndvi)
+        land_stats = generate_stats.calculateLandCover(class_counts = class_counts)
         no_vegetation_percent = "{:.2f}".format(land_stats[os.environ.get("NDVI_NO_VEGETATION")] / land_stats["total_pixels"] * 100)
         print(f"Non Vegetated Area: {no_vegetation_percent} %")
 
         # Print the bar chart
         combined_stats = { **vegetation_stats, **land_stats }
         generate_stats.plotBarVegetation(combined_stats)
+
+        # Plot a preview of the NDVI of the image from its overviews
+        generate_stats.plotNDVIPreview(ndvi_matrix_path)
     
 
     # Generate statistics for the change between 2 years
@@ -113,7 +356,7 @@ if(__name__ == "__main__"):
 
         # After the area has been chosen, present the years for which data is available for the chosen area
         cursor.execute(
-            "SELECT date, ndvi_data_path FROM STORED_DATA_INFO WHERE area_id = (SELECT area_id FROM AREAS WHERE area_name = ?) AND ndvi_generated = ?",
+            AREA_SCENES_QUERY,
             (areas[choice_area - 1], 1)
         )
         results = []
@@ -134,13 +377,13 @@ if(__name__ == "__main__"):
         ndvi_matrix_path1: str = results[choice_date1 - 1][1]
         ndvi_matrix_path2: str = results[choice_date2 - 1][1]
 
-        # Load the NDVI matrices
-        ndvi_start: np.ndarray = np.load(file = os.path.join(ndvi_matrix_path1, "ndvi_matrix.npy"))
-        ndvi_end: np.ndarray = np.load(file = os.path.join(ndvi_matrix_path2, "ndvi_matrix.npy"))
+        # Get the class counts of each NDVI matrix from its stored histogram and derive both the vegetation and land cover from them
+        class_counts_start = generate_stats.loadClassCounts(ndvi_matrix_path1)
+        class_counts_end = generate_stats.loadClassCounts(ndvi_matrix_path2)
 
         # Calculate vegetation cover
-        vegetation_stats_start = generate_stats.calculateVegetationCover(ndvi_start)
-        vegetation_stats_end = generate_stats.calculateVegetationCover(ndvi_end)
+        vegetation_stats_start = generate_stats.calculateVegetationCover(class_counts = class_counts_start)
+        vegetation_stats_end = generate_stats.calculateVegetationCover(class_counts = class_counts_end)
 
         # Calculate change vegetation cover for sparse vegetation
         if(vegetation_stats_start[os.environ.get("NDVI_SPARSE_VEGETATION")] > vegetation_stats_end[os.environ.get("NDVI_SPARSE_VEGETATION")]):
@@ -187,8 +430,8 @@ if(__name__ == "__main__"):
         print(f"{deforestation_or_reforestation} {change_in_total_cover} %")
         
         # Calculate land cover
-        land_stats_start = generate_stats.calculateLandCover(ndvi_start)
-        land_stats_end = generate_stats.calculateLandCover(ndvi_end)
+        land_stats_start = generate_stats.calculateLandCover(class_counts = class_counts_start)
+        land_stats_end = generate_stats.calculateLandCover(class_counts = class_counts_end)
 
         total_barren_start = land_stats_start[os.environ.get("NDVI_NO_VEGETATION")]
         total_barren_end = land_stats_end[os.environ.get("NDVI_NO_VEGETATION")]
@@ -206,6 +449,16 @@ if(__name__ == "__main__"):
         combined_stats_end = { **vegetation_stats_end, **land_stats_end }
         generate_stats.plotBarVegetationCombined(combined_stats_start, combined_stats_end, [choice_of_years[choice_date1-1], choice_of_years[choice_date2-1]])
 
+        # Find where the vegetation changed by comparing the class of every pixel at both dates.
+        # This writes a raster of the class transition of every pixel and a summary table of the transitions.
+        transitions = generate_change.detectChange(ndvi_matrix_path1, ndvi_matrix_path2)
+        generate_change.writeChangeSummary(transitions)
+        generate_change.printChangeSummary(transitions)
+
+        analyzer_path = os.path.dirname(os.path.abspath(__file__))
+        print(f"\nTransition raster: {os.path.join(analyzer_path, generate_change.TRANSITION_RASTER_FILENAME)}")
+        print(f"Transition summary: {os.path.join(analyzer_path, generate_change.TRANSITION_SUMMARY_FILENAME)}")
+
 
     # Generate inference for future time
     elif(choice_main == 3):
@@ -222,11 +475,15 @@ if(__name__ == "__main__"):
         
         choice_area = int(input("Choice: "))
 
+        # Get the vegetation time series of the chosen area, as stored by the ndvi-generator
+        series_class_counts = fetchClassCounts(cursor, [areas[choice_area - 1]])
+
         # After the area has been chosen, get the years for which data is available for the chosen area
         cursor.execute(
-            "SELECT date, ndvi_data_path FROM STORED_DATA_INFO WHERE area_id = (SELECT area_id FROM AREAS WHERE area_name = ?) AND ndvi_generated = ?",
+            AREA_SCENES_QUERY,
             (areas[choice_area - 1], 1)
         )
+        results = cursor.fetchall()
 
         # This dictionary will be sent to the inference section to be converted into a Pandas dataframe.
         # This structure reflects the format expected by Prophet library - 2 columns, 1 for timestamp (ds)
@@ -239,7 +496,7 @@ if(__name__ == "__main__"):
         print("\nGenerating Vegetation Data for Images:")
         output_csv = "ds,y\n"
 
-        for (date, ndvi_data_path) in cursor:
+        for (date, ndvi_data_path) in results:
             # Ignore the 2022 data as it is not correct
             if(date.year == 2022):
                 continue
@@ -254,11 +511,12 @@ if(__name__ == "__main__"):
             # We want to infer the amount of land under vegetation cover.
             # So we will only calculate forest cover.
 
-            # Load the NDVI matrix
-            ndvi: np.ndarray = np.load(file = os.path.join(ndvi_data_path, "ndvi_matrix.npy"))
-
-            # Calculate vegetation cover
-            vegetation_stats = generate_stats.calculateVegetationCover(ndvi)
+            # Calculate vegetation cover from the time series table, or from the histogram stored alongside
+            # the NDVI matrix if the image is missing from the table
+            class_counts = series_class_counts.get(ndvi_data_path)
+            if(class_counts is None):
+                class_counts = generate_stats.loadClassCounts(ndvi_data_path)
+            vegetation_stats = generate_stats.calculateVegetationCover(class_counts = class_counts)
 
             # Here, we consider only moderate and thick vegetation
             total_vegetation = vegetation_stats[os.environ.get("NDVI_MODERATE_VEGETATION")] + vegetation_stats[os.environ.get("NDVI_THICK_VEGETATION")]
@@ -269,15 +527,97 @@ if(__name__ == "__main__"):
             # Add data to CSV string
             output_csv += f"{year}-{month},{str(total_vegetation)}\n"
         
-        # Output the CSV file for importing into the inference section
+        # Send over dictionary for inference if the Prophet library is available.
+        # Fitted models are cached, so a repeat forecast of an unchanged area does not fit the model again.
+        if(generate_inference is not None):
+            generate_inference.infer(prophet_compatible_dict)
+            return
+
+        # Otherwise output the CSV file for importing into the inference section
         with open("inference_csv.tmp.csv", "w") as file:
             file.write(output_csv)
         
         print("\nCSV file exported. Now run generate_inference.py from WSL to perform inference.")
         print("This is a workaround as the Prophet library used is not compatible with Windows.")
-        print("This will be soon removed when the application will be ported to Docker.")
-        
-        # Send over dictionary for inference
-        # This method will not work until application is ported to Docker.
-        # Until then, call generate_inference manually from WSL.
-        # generate_inference.infer(prophet_compatible_dict)
\ No newline at end of file
+
+
+if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--mode",
+        choices = MODES,
+        help = "Run non-interactively in the given mode. Without this, the interactive menu is shown."
+    )
+
+    parser.add_argument(
+        "--area",
+        action = "append",
+        default = [],
+        help = "Name of an area to analyze. Can be given multiple times. Defaults to all the areas in the database."
+    )
+
+    parser.add_argument(
+        "--date",
+        action = "append",
+        default = [],
+        help = "Date of the images to analyze as YYYY-MM-DD, YYYY-MM or YYYY. Can be given multiple times. Defaults to all the dates."
+    )
+
+    parser.add_argument(
+        "--format",
+        choices = ("json", "csv"),
+        default = "json",
+        help = "Format of the output"
+    )
+
+    parser.add_argument(
+        "--output",
+        help = "File to write the output to. Defaults to the standard output."
+    )
+
+    parser.add_argument(
+        "--workers",
+        type = int,
+        default = os.cpu_count(),
+        help = "Number of worker processes used to analyze the images"
+    )
+
+    parser.add_argument(
+        "--raster_dir",
+        help = "Directory to store the class transition raster of every pair of images in, in the change mode"
+    )
+
+    args = parser.parse_args()
+
+    # Setup connection to database
+    try:
+        connection = mariadb.connect(
+            user = os.environ.get("MYSQL_USER"),
+            password = os.environ.get("MYSQL_PASSWORD"),
+            host = os.environ.get("MYSQL_HOST"),
+            port = int(os.environ.get("MYSQL_PORT")),
+            database = os.environ.get("MYSQL_DATABASE")
+        )
+    except mariadb.Error as e:
+        print(f"Error connecting to MariaDB Platform: {e}")
+        exit(1)
+    
+    # Get the cursor to the database
+    cursor = connection.cursor()
+
+    if(args.mode is None):
+        runInteractive(cursor)
+    else:
+        records = runBatch(cursor, args.mode, args.area, args.date, args.workers, args.raster_dir)
+
+        if(args.output is None):
+            writeRecords(records, args.format, sys.stdout)
+        else:
+            with open(args.output, "w", newline = "") as file:
+                writeRecords(records, args.format, file)
+
+    connection.close()
+
+    # Sum up the measurements of the stages of this and earlier runs, including those of the worker processes
+    instrumentation.writePrometheus()
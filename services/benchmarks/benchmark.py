@@ -0,0 +1,359 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# The modules under benchmark are imported from the ndvi-generator, the analyzer and the modules shared by them.
+# Run this from the virtual environment of the ndvi-generator, which has every package they need.
+SERVICES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(SERVICES_PATH, "common"))
+sys.path.append(os.path.join(SERVICES_PATH, "ndvi-generator"))
+sys.path.append(os.path.join(SERVICES_PATH, "analyzer"))
+
+import ndvi_generator
+import ndvi_storage
+import visualizations
+from object_storage import ObjectStorage
+import generate_stats
+
+# Benchmark of the NDVI calculation, the statistics, the visualizations and the storage of NDVI matrices on
+# synthetic Sentinel-2 scenes of several sizes. It only needs the CPU and does not connect to the database.
+#
+# The red (B04) and near infrared (B08) bands of every scene are generated from a fixed seed, so every run
+# benchmarks the same data. They are stored in the data directory and reused by later runs. Every benchmark
+# runs in a fresh process with its inputs already in memory. It is first run a number of times without being
+# timed, to warm up the caches, the page cache and the lazily initialized state of the libraries, and then
+# timed over a number of runs, of which the fastest and the median are reported. It is then run once more
+# while tracing memory allocations, to report the peak memory allocated by the benchmark itself. This covers
+# the arrays allocated by NumPy and OpenCV, but not the internal buffers of native libraries.
+#
+# The results can be saved as a baseline, and later runs can be compared against it. A benchmark which is
+# slower, or uses more memory, than its baseline by more than the tolerance is reported as a regression. The
+# fastest run is compared, as it is the least affected by other work on the machine, and small benchmarks
+# must also be slower by more than an absolute amount, so that the jitter of the timer is not reported as a
+# regression.
+
+# Sizes of the synthetic scenes. A full Sentinel-2 tile at 10 m resolution has 10980 rows and columns.
+DEFAULT_SIZES = (1024, 4096, 10980)
+
+# Version of the synthetic scenes. Stored scenes of another version are generated again.
+SCENE_VERSION = 1
+
+# Number of rows of the synthetic scene generated at a time
+SCENE_BLOCK_ROWS = 1024
+
+# Increase in time below which a benchmark is never reported as a regression
+TIME_SLACK_MS = 5
+
+# Increase in peak memory below which a benchmark is never reported as a regression
+MEMORY_SLACK_MB = 16
+
+# The NDVI classes are read from the .env file. These are the thresholds given in the README, used
+# if there is no .env file.
+DEFAULT_THRESHOLDS = {
+    "NDVI_THICK_VEGETATION": "0.6",
+    "NDVI_MODERATE_VEGETATION": "0.4",
+    "NDVI_SPARSE_VEGETATION": "0.1",
+    "NDVI_NO_VEGETATION": "-1.0"
+}
+for variable, threshold in DEFAULT_THRESHOLDS.items():
+    os.environ.setdefault(variable, threshold)
+
+
+# Function to get the path of a band of a synthetic scene in the data directory
+def getScenePath(data_dir: str, size: int, name: str) -> str:
+    return os.path.join(data_dir, f"scene_v{SCENE_VERSION}_{size}_{name}.npy")
+
+
+# Function to generate the bands of a synthetic scene and the NDVI matrix calculated from them.
+# The vegetation of the scene varies smoothly, as a sum of waves of random direction and phase, from bare soil
+# to thick vegetation, so the pixels are spread over all the NDVI classes. The reflectance of both bands follows
+# the vegetation, with added noise, and is stored as 16 bit integers like in Sentinel-2 L1C products.
+# The scene is generated block by block, so that even a full tile is generated with little memory.
+def generateScene(data_dir: str, size: int, seed: int = 0) -> None:
+    if(all(os.path.isfile(getScenePath(data_dir, size, name)) for name in ("B04", "B08", "ndvi"))):
+        return
+
+    os.makedirs(data_dir, exist_ok = True)
+    generator = np.random.default_rng(seed)
+    waves = [
+        (generator.uniform(2, 12) * np.pi / size, generator.uniform(0, np.pi), generator.uniform(0, 2 * np.pi))
+        for _ in range(4)
+    ]
+
+    # The bands are written under partial filenames and renamed once complete
+    partial_paths = { name: getScenePath(data_dir, size, name) + ".partial" for name in ("B04", "B08", "ndvi") }
+    band_red = np.lib.format.open_memmap(partial_paths["B04"], mode = "w+", dtype = np.uint16, shape = (size, size))
+    band_nir = np.lib.format.open_memmap(partial_paths["B08"], mode = "w+", dtype = np.uint16, shape = (size, size))
+    ndvi = np.lib.format.open_memmap(partial_paths["ndvi"], mode = "w+", dtype = np.float32, shape = (size, size))
+
+    columns = np.arange(size, dtype = np.float32)[np.newaxis, :]
+    for start in range(0, size, SCENE_BLOCK_ROWS):
+        stop = min(start + SCENE_BLOCK_ROWS, size)
+        rows = np.arange(start, stop, dtype = np.float32)[:, np.newaxis]
+
+        vegetation = np.zeros((stop - start, size), dtype = np.float32)
+        for (frequency, direction, phase) in waves:
+            vegetation += np.sin(frequency * (np.cos(direction) * columns + np.sin(direction) * rows) + phase, dtype = np.float32)
+        vegetation = np.clip(0.5 + vegetation / 4, 0, 1)
+
+        noise_red = generator.standard_normal(vegetation.shape, dtype = np.float32) * 150
+        noise_nir = generator.standard_normal(vegetation.shape, dtype = np.float32) * 150
+        band_red[start:stop] = np.clip(400 + 2600 * (1 - vegetation) + noise_red, 0, 10000)
+        band_nir[start:stop] = np.clip(800 + 3500 * vegetation + noise_nir, 0, 10000)
+
+    # The NDVI matrix used by the other benchmarks is calculated with the reference backend
+    ndvi_generator.generateNDVI(band_red, band_nir, output = ndvi, backend = "numpy")
+
+    for matrix in (band_red, band_nir, ndvi):
+        matrix.flush()
+    del band_red, band_nir, ndvi
+
+    for name, partial_path in partial_paths.items():
+        os.replace(partial_path, getScenePath(data_dir, size, name))
+
+
+def _benchmarkNDVI(inputs: dict, work_dir: str) -> None:
+    ndvi_generator.generateNDVI(inputs["B04"], inputs["B08"], output = inputs["output"])
+
+
+def _benchmarkStats(inputs: dict, work_dir: str) -> None:
+    generate_stats.calculateVegetationCover(inputs["ndvi"])
+    generate_stats.calculateLandCover(inputs["ndvi"])
+
+
+def _benchmarkContinuous(inputs: dict, work_dir: str) -> None:
+    visualizations.visualizeNDVIContinuous(inputs["ndvi"])
+
+
+def _benchmarkCategorical(inputs: dict, work_dir: str) -> None:
+    visualizations.visualizeNDVICategorical(inputs["ndvi"])
+
+
+def _benchmarkStorageNpy(inputs: dict, work_dir: str) -> None:
+    ObjectStorage.storeMatrix(inputs["ndvi"], work_dir, "ndvi_matrix.npy")
+    ObjectStorage.loadMatrix(os.path.join(work_dir, "ndvi_matrix.npy"), mmap_mode = None)
+
+
+def _benchmarkStorageCompact(inputs: dict, work_dir: str) -> None:
+    ndvi_storage.storeCompactMatrix(inputs["ndvi"], os.path.join(work_dir, "ndvi_matrix.npz"), "int16")
+    ObjectStorage.loadMatrix(os.path.join(work_dir, "ndvi_matrix.npz"))
+
+
+# The benchmarks, along with the inputs each of them needs and the function which runs it
+BENCHMARKS = {
+    "ndvi": { "inputs": ("B04", "B08", "output"), "function": _benchmarkNDVI },
+    "stats": { "inputs": ("ndvi",), "function": _benchmarkStats },
+    "visualize_continuous": { "inputs": ("ndvi",), "function": _benchmarkContinuous },
+    "visualize_categorical": { "inputs": ("ndvi",), "function": _benchmarkCategorical },
+    "storage_npy": { "inputs": ("ndvi",), "function": _benchmarkStorageNpy },
+    "storage_int16": { "inputs": ("ndvi",), "function": _benchmarkStorageCompact }
+}
+
+
+# Function to run a benchmark on a scene. This runs in a fresh process.
+# Returns the times of the fastest and the median run in seconds and the peak memory allocated by a run in bytes.
+def runBenchmark(name: str, size: int, data_dir: str, repeat: int, warmup: int) -> tuple[float, float, int]:
+    inputs = {}
+    for input_name in BENCHMARKS[name]["inputs"]:
+        if(input_name == "output"):
+            inputs[input_name] = np.zeros((size, size), dtype = np.float32)
+        else:
+            inputs[input_name] = np.load(getScenePath(data_dir, size, input_name))
+
+    work_dir = tempfile.mkdtemp(prefix = "ndvi_benchmark_")
+    try:
+        for _ in range(warmup):
+            BENCHMARKS[name]["function"](inputs, work_dir)
+
+        times = []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            BENCHMARKS[name]["function"](inputs, work_dir)
+            times.append(time.perf_counter() - start)
+
+        # Tracing slows down allocations, so the memory is measured in a separate run which is not timed
+        tracemalloc.start()
+        BENCHMARKS[name]["function"](inputs, work_dir)
+        (_, peak_memory) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    return (min(times), statistics.median(times), peak_memory)
+
+
+# Function to describe the machine and the configuration the benchmarks ran on.
+# Results are only comparable with a baseline from the same environment.
+def getEnvironment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "ndvi_backend": ndvi_generator.getBackend()
+    }
+
+
+# Function to run every benchmark on every size of scene. Every benchmark runs in its own process.
+# Returns a list of results, one dictionary per benchmark and size.
+def runBenchmarks(names: list[str], sizes: list[int], data_dir: str, repeat: int, warmup: int) -> list[dict]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    for size in sizes:
+        print(f"Preparing the synthetic scene of {size} x {size} pixels", file = sys.stderr)
+        generateScene(data_dir, size)
+
+        for name in names:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+                (seconds, median_seconds, peak_memory) = executor.submit(runBenchmark, name, size, data_dir, repeat, warmup).result()
+
+            results.append({
+                "benchmark": name,
+                "size": size,
+                "seconds": round(seconds, 6),
+                "median_seconds": round(median_seconds, 6),
+                "megapixels_per_second": round(size * size / 1e6 / seconds, 3),
+                "peak_memory_mb": round(peak_memory / (1024 * 1024), 1)
+            })
+            print(f"{name} ({size}): {seconds * 1000:.1f} ms (median {median_seconds * 1000:.1f} ms)", file = sys.stderr)
+
+    return results
+
+
+# Function to compare results with a baseline. Adds the baseline time and memory, and the change from them,
+# to every result which has a baseline, and flags the results slower or larger than the baseline by more than
+# the tolerance and by more than TIME_SLACK_MS or MEMORY_SLACK_MB. Returns the number of regressions.
+def compareResults(results: list[dict], baseline: dict, tolerance: float) -> int:
+    baseline_results = { (result["benchmark"], result["size"]): result for result in baseline["results"] }
+
+    regressions = 0
+    for result in results:
+        baseline_result = baseline_results.get((result["benchmark"], result["size"]))
+        if(baseline_result is None):
+            continue
+
+        result["baseline_seconds"] = baseline_result["seconds"]
+        result["time_change_percent"] = round((result["seconds"] / baseline_result["seconds"] - 1) * 100, 1)
+        time_limit = max(baseline_result["seconds"] * (1 + tolerance), baseline_result["seconds"] + TIME_SLACK_MS / 1000)
+        result["regression"] = result["seconds"] > time_limit
+
+        if(baseline_result.get("peak_memory_mb") is not None):
+            result["baseline_peak_memory_mb"] = baseline_result["peak_memory_mb"]
+            memory_limit = max(baseline_result["peak_memory_mb"] * (1 + tolerance), baseline_result["peak_memory_mb"] + MEMORY_SLACK_MB)
+            result["regression"] = result["regression"] or result["peak_memory_mb"] > memory_limit
+
+        regressions += int(result["regression"])
+
+    return regressions
+
+
+# Function to print the results as a table, along with the comparison with the baseline if there is one
+def printResults(results: list[dict]) -> None:
+    print(f"\n{'Benchmark':<24}{'Size':>7}{'Time (ms)':>12}{'Median (ms)':>13}{'MP/s':>10}{'Peak (MB)':>11}{'Baseline (ms)':>15}{'Change':>9}")
+    for result in results:
+        line = f"{result['benchmark']:<24}{result['size']:>7}{result['seconds'] * 1000:>12.1f}{result['median_seconds'] * 1000:>13.1f}{result['megapixels_per_second']:>10.1f}{result['peak_memory_mb']:>11.1f}"
+
+        if("baseline_seconds" in result):
+            line += f"{result['baseline_seconds'] * 1000:>15.1f}{result['time_change_percent']:>+8.1f}%"
+            if(result["regression"]):
+                line += "  REGRESSION"
+
+        print(line)
+
+
+if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--sizes",
+        type = int,
+        nargs = "+",
+        default = list(DEFAULT_SIZES),
+        help = "Number of rows and columns of the synthetic scenes"
+    )
+
+    parser.add_argument(
+        "--benchmarks",
+        nargs = "+",
+        choices = list(BENCHMARKS),
+        default = list(BENCHMARKS),
+        help = "Benchmarks to run. Defaults to all of them."
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type = int,
+        default = 7,
+        help = "Number of timed runs of each benchmark. The fastest and the median run are reported."
+    )
+
+    parser.add_argument(
+        "--warmup",
+        type = int,
+        default = 1,
+        help = "Number of runs of each benchmark before the timed runs, which are not timed"
+    )
+
+    parser.add_argument(
+        "--data_dir",
+        default = os.path.join(tempfile.gettempdir(), "ndvi_benchmark_scenes"),
+        help = "Directory where the synthetic scenes are stored and reused between runs"
+    )
+
+    parser.add_argument(
+        "--save",
+        help = "JSON file to save the results to, to be used as the baseline of later runs"
+    )
+
+    parser.add_argument(
+        "--compare",
+        help = "JSON file of the baseline to compare the results with. Exits with status 1 if any benchmark regressed."
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type = float,
+        default = 0.15,
+        help = "Fraction by which a benchmark may be slower, or use more memory, than its baseline before it is reported as a regression"
+    )
+
+    args = parser.parse_args()
+
+    baseline = None
+    if(args.compare):
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    environment = getEnvironment()
+    results = runBenchmarks(args.benchmarks, args.sizes, args.data_dir, args.repeat, args.warmup)
+
+    regressions = 0
+    if(baseline is not None):
+        changed = [key for key, value in environment.items() if baseline["environment"].get(key) != value]
+        if(len(changed) > 0):
+            print(f"\nThe baseline was recorded in a different environment ({', '.join(changed)}), so the comparison may not be meaningful")
+        regressions = compareResults(results, baseline, args.tolerance)
+
+    printResults(results)
+
+    if(args.save):
+        with open(args.save, "w") as file:
+            json.dump({ "environment": environment, "repeat": args.repeat, "warmup": args.warmup, "results": results }, file, indent = 2)
+            file.write("\n")
+        print(f"\nResults saved to {args.save}")
+
+    if(regressions > 0):
+        print(f"\n{regressions} benchmarks regressed by more than {args.tolerance * 100:.0f} %")
+        exit(1)
@@ -0,0 +1,418 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import datetime
+import functools
+import inspect
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# The resource module is only available on Unix, and psutil is optional. Without either, the peak memory
+# and the bytes read and written are not recorded.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# This module records how much time and memory every stage of the services takes, and is shared by all of them.
+# A stage is measured by wrapping it with measure() (or a function with the instrumented() decorator). For every
+# run of a stage, a record is appended to {METRICS_DIR}/{service}.jsonl with the wall time, the CPU time of the
+# process and of the thread running the stage, the CPU time of subprocesses which finished during the stage, the
+# peak resident memory of the process during the stage, and the bytes read from and written to storage by the process.
+# Records carry labels (like the scene being processed) which are inherited by the stages nested inside them.
+# writePrometheus() then sums up the records of every stage into {METRICS_DIR}/{service}.prom, in the text format
+# read by the textfile collector of the Prometheus node exporter. The sums are kept in memory, and every call only
+# reads the records appended since the last one. Once the records file grows beyond RECORDS_MAX_BYTES, it is moved to
+# {service}.jsonl.1 (replacing the one moved before), so a process started later sums up the records from there on,
+# which Prometheus sees as a reset of the counters.
+#
+# Nothing is recorded unless METRICS_DIR is set in the .env file. Stages running at the same time in several threads
+# of a process share its counters, so their process CPU time and bytes overlap. The thread CPU time is that of the
+# stage alone, but leaves out threads started by the stage (like those of the NDVI calculation).
+#
+# The CPU time of a subprocess is only known once it has finished and been waited for, and it is then counted for
+# every stage of the process running at that moment, whichever of them started it. Subprocesses waited for by the
+# stage which runs them (like the GDAL commands) are counted for that stage, but the workers of a process pool are
+# only waited for when the pool is shut down, so their CPU time is counted for the stage which shuts the pool down
+# (or for none, if no stage is running then), and not for the stages which sent them work.
+#
+# On Linux, the peak resident memory is that of the stage: the peak of the process is reset when a stage starts or
+# ends, after being added to the peak of every stage still running, so stages running at the same time share their
+# peaks but a stage is not charged for the memory of an earlier one. Elsewhere the peak resident memory of the
+# process since it started is recorded, and peak_rss_scope in the record is "process" instead of "stage".
+
+METRIC_PREFIX = "nature_preservation_stage"
+
+# Size of the records file of a service beyond which it is moved aside once its records have been summed up
+RECORDS_MAX_BYTES = 64 * 1024 * 1024
+
+_service = "service"
+_labels = contextvars.ContextVar("instrumentation_labels", default = {})
+_write_lock = threading.Lock()
+
+# The sums of the records of every stage read so far by writePrometheus, and the file and position up to which they were read
+_totals_lock = threading.Lock()
+_totals = {}
+_records_file_id = None
+_records_offset = 0
+
+# The stages of this process which are running, whose peak memory is updated whenever the peak of the process is reset
+_peak_lock = threading.Lock()
+_running_peaks = []
+
+
+# Function to set the name of the service under which the records of this process are stored
+def setService(name: str) -> None:
+    global _service
+    _service = name
+
+
+# Function to get the directory where the records are stored. Returns None if nothing is recorded.
+def getMetricsDir() -> str:
+    return os.environ.get("METRICS_DIR") or None
+
+
+def getRecordsPath() -> str:
+    return os.path.join(getMetricsDir(), f"{_service}.jsonl")
+
+
+def getPrometheusPath() -> str:
+    return os.path.join(getMetricsDir(), f"{_service}.prom")
+
+
+# Function to read the bytes read from and written to storage by this process so far.
+# Returns None for both if they are not available on this platform.
+def _readIOCounters() -> tuple[int, int]:
+    if(psutil is not None):
+        try:
+            counters = psutil.Process().io_counters()
+            return (counters.read_bytes, counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(":") for line in file.read().splitlines())
+        return (int(counters["read_bytes"]), int(counters["write_bytes"]))
+    except (OSError, KeyError, ValueError):
+        return (None, None)
+
+
+# Function to get the peak resident memory of this process since it started in bytes, or None if it is not available
+def _getPeakRSS() -> int:
+    if(resource is not None):
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+    if(psutil is not None):
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss)
+
+    return None
+
+
+# Function to read the peak resident memory of this process since it was last reset in bytes, from /proc on Linux.
+# Returns None if it is not available.
+def _readHighWaterMark() -> int:
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if(line.startswith("VmHWM:")):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+# Function to reset the peak resident memory of this process to its current resident memory.
+# Returns False if it cannot be reset on this platform.
+def _resetHighWaterMark() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Function to check once whether the peak resident memory can be measured per stage on this platform
+@functools.lru_cache(maxsize = None)
+def _canMeasureStagePeaks() -> bool:
+    return _readHighWaterMark() is not None and _resetHighWaterMark()
+
+
+# Class which holds the peak resident memory of a running stage
+class _StagePeak:
+    def __init__(self):
+        self.peak_rss = 0
+
+
+# Function to add the peak of the process since its last reset to the peaks of all the running stages, and then
+# reset it. Must be called with _peak_lock held.
+def _collectPeaks() -> None:
+    peak_rss = _readHighWaterMark() or 0
+    for stage_peak in _running_peaks:
+        stage_peak.peak_rss = max(stage_peak.peak_rss, peak_rss)
+    _resetHighWaterMark()
+
+
+# Function to start measuring the peak resident memory of a stage.
+# Returns None if it can only be measured for the whole process on this platform.
+def _startStagePeak() -> _StagePeak:
+    if(not _canMeasureStagePeaks()):
+        return None
+
+    stage_peak = _StagePeak()
+    with _peak_lock:
+        _collectPeaks()
+        _running_peaks.append(stage_peak)
+    return stage_peak
+
+
+# Function to stop measuring the peak resident memory of a stage and get it in bytes.
+# Without a stage peak, the peak of the process since it started is returned instead.
+def _endStagePeak(stage_peak: _StagePeak) -> int:
+    if(stage_peak is None):
+        return _getPeakRSS()
+
+    with _peak_lock:
+        _collectPeaks()
+        _running_peaks.remove(stage_peak)
+    return stage_peak.peak_rss
+
+
+# Function to get the CPU time of the subprocesses of this process which have finished so far
+def _getChildrenCPU() -> float:
+    if(resource is None):
+        return 0.0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _subtract(end: int, start: int) -> int:
+    return None if end is None or start is None else end - start
+
+
+# Function to append a record to the records of the service.
+# Every record is written with a single call in append mode, so records of several processes are not interleaved.
+def _writeRecord(record: dict) -> None:
+    line = json.dumps(record, default = str) + "\n"
+    with _write_lock:
+        os.makedirs(getMetricsDir(), exist_ok = True)
+        with open(getRecordsPath(), "a") as file:
+            file.write(line)
+
+
+# Context manager which adds labels to the records of all the stages measured inside it, without measuring anything
+@contextlib.contextmanager
+def labels(**new_labels):
+    token = _labels.set({ **_labels.get(), **new_labels })
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+# Context manager which measures a stage and records it with the given labels, along with the labels of the
+# stages it is nested in. A stage which raises an exception is recorded as failed.
+@contextlib.contextmanager
+def measure(stage: str, **new_labels):
+    if(getMetricsDir() is None):
+        yield
+        return
+
+    stage_labels = { **_labels.get(), **new_labels }
+    token = _labels.set(stage_labels)
+
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_thread_cpu = time.thread_time()
+    start_children_cpu = _getChildrenCPU()
+    (start_read, start_written) = _readIOCounters()
+    stage_peak = _startStagePeak()
+
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _labels.reset(token)
+        (end_read, end_written) = _readIOCounters()
+        peak_rss = _endStagePeak(stage_peak)
+
+        _writeRecord({
+            "time": start_time.isoformat(),
+            "service": _service,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "stage": stage,
+            "labels": stage_labels,
+            "wall_seconds": round(time.perf_counter() - start_wall, 6),
+            "cpu_seconds": round(time.process_time() - start_cpu, 6),
+            "thread_cpu_seconds": round(time.thread_time() - start_thread_cpu, 6),
+            "children_cpu_seconds": round(_getChildrenCPU() - start_children_cpu, 6),
+            "peak_rss_bytes": peak_rss,
+            "peak_rss_scope": "process" if stage_peak is None else "stage",
+            "read_bytes": _subtract(end_read, start_read),
+            "written_bytes": _subtract(end_written, start_written),
+            "failed": failed
+        })
+
+
+# Decorator which measures every call of a function (or coroutine function) as the given stage
+def instrumented(stage: str, **stage_labels):
+    def decorate(function):
+        if(inspect.iscoroutinefunction(function)):
+            @functools.wraps(function)
+            async def measuredCoroutine(*args, **kwargs):
+                with measure(stage, **stage_labels):
+                    return await function(*args, **kwargs)
+            return measuredCoroutine
+
+        @functools.wraps(function)
+        def measuredFunction(*args, **kwargs):
+            with measure(stage, **stage_labels):
+                return function(*args, **kwargs)
+        return measuredFunction
+
+    return decorate
+
+
+# Function to read all the records of the service
+def readRecords() -> list[dict]:
+    if(getMetricsDir() is None or not os.path.isfile(getRecordsPath())):
+        return []
+
+    records = []
+    with open(getRecordsPath()) as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line which was still being written when another process was stopped
+                continue
+
+    return records
+
+
+# Function to read the complete records in a file from the given position.
+# Returns the records and the position after the last complete one, so a record still being written is read next time.
+def _readRecordsFrom(path: str, offset: int) -> tuple[list[dict], int]:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = file.read()
+    data = data[:data.rfind(b"\n") + 1]
+
+    records = []
+    for line in data.decode(errors = "replace").splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A line which was left partially written when another process was stopped
+            continue
+
+    return (records, offset + len(data))
+
+
+# Function to add a record to the sums of its stage. Must be called with _totals_lock held.
+def _addRecord(record: dict) -> None:
+    stage = _totals.setdefault(record["stage"], {
+        "runs": 0, "failures": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "children_cpu_seconds": 0.0,
+        "read_bytes": 0, "written_bytes": 0, "peak_rss_bytes": 0
+    })
+    stage["runs"] += 1
+    stage["failures"] += int(record["failed"])
+    for name in ("wall_seconds", "cpu_seconds", "children_cpu_seconds", "read_bytes", "written_bytes"):
+        stage[name] += record.get(name) or 0
+    stage["peak_rss_bytes"] = max(stage["peak_rss_bytes"], record.get("peak_rss_bytes") or 0)
+
+
+# Function to add the records appended to the records file since the last call to the sums, and to move the file
+# aside once it has grown beyond RECORDS_MAX_BYTES. If the file was moved aside by another process, the new file is
+# read from the start. Must be called with _totals_lock held.
+def _updateTotals() -> None:
+    global _records_file_id, _records_offset
+
+    try:
+        stat = os.stat(getRecordsPath())
+    except FileNotFoundError:
+        return
+
+    if((stat.st_dev, stat.st_ino) != _records_file_id or stat.st_size < _records_offset):
+        _records_file_id = (stat.st_dev, stat.st_ino)
+        _records_offset = 0
+
+    (records, _records_offset) = _readRecordsFrom(getRecordsPath(), _records_offset)
+    for record in records:
+        _addRecord(record)
+
+    if(_records_offset < RECORDS_MAX_BYTES):
+        return
+
+    # Records appended by other processes between the read above and the move are read from the moved file.
+    # The file cannot be moved while another process has it open on Windows, in which case it is moved next time.
+    rotated_path = f"{getRecordsPath()}.1"
+    with _write_lock:
+        try:
+            os.replace(getRecordsPath(), rotated_path)
+        except OSError:
+            return
+
+    (records, _) = _readRecordsFrom(rotated_path, _records_offset)
+    for record in records:
+        _addRecord(record)
+    _records_file_id = None
+    _records_offset = 0
+
+
+# Function to sum up the records of every stage of the service into the Prometheus text file.
+# Times and bytes are written as counters summed over all the records, and the peak memory as a gauge holding
+# the largest peak of any record. The file is replaced in a single rename, so readers never see it partially written.
+def writePrometheus() -> str:
+    if(getMetricsDir() is None):
+        return None
+
+    with _totals_lock:
+        _updateTotals()
+        totals = { stage_name: dict(stage) for stage_name, stage in _totals.items() }
+
+    metrics = [
+        ("runs_total", "counter", "Number of times the stage ran", "runs"),
+        ("failures_total", "counter", "Number of times the stage failed", "failures"),
+        ("wall_seconds_total", "counter", "Wall time spent in the stage", "wall_seconds"),
+        ("cpu_seconds_total", "counter", "CPU time of the process spent in the stage", "cpu_seconds"),
+        ("children_cpu_seconds_total", "counter", "CPU time of the subprocesses run by the stage", "children_cpu_seconds"),
+        ("read_bytes_total", "counter", "Bytes read from storage during the stage", "read_bytes"),
+        ("written_bytes_total", "counter", "Bytes written to storage during the stage", "written_bytes"),
+        ("peak_rss_bytes", "gauge", "Largest peak resident memory of a process during a run of the stage", "peak_rss_bytes")
+    ]
+
+    lines = []
+    for (name, metric_type, description, key) in metrics:
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+        for stage_name, stage in sorted(totals.items()):
+            lines.append(f'{METRIC_PREFIX}_{name}{{service="{_service}",stage="{stage_name}"}} {round(stage[key], 6)}')
+
+    partial_path = f"{getPrometheusPath()}.{os.getpid()}.partial"
+    with open(partial_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(partial_path, getPrometheusPath())
+
+    return getPrometheusPath()
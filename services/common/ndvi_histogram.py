@@ -0,0 +1,76 @@
+import os
+import numpy as np
+
+# This module holds the NDVI classes and the histogram stored alongside every NDVI matrix, and is shared by the
+# ndvi-generator, which builds the histogram, and the analyzer, which answers class counts from it without
+# reading the matrix.
+
+# The NDVI classes in ascending order of their lower thresholds, given by these variables in the .env file
+NDVI_CLASS_VARIABLES = ("NDVI_NO_VEGETATION", "NDVI_SPARSE_VEGETATION", "NDVI_MODERATE_VEGETATION", "NDVI_THICK_VEGETATION")
+
+# Filename of the histogram stored alongside every NDVI matrix
+HISTOGRAM_FILENAME = "ndvi_histogram.npz"
+
+# Edges of the histogram stored alongside every NDVI matrix. These are all the multiples of 0.001 between
+# -1 and 1, so the class counts for any thresholds with up to 3 decimal places can be answered from the
+# histogram. The thresholds in use when the histogram is built are added to these.
+HISTOGRAM_GRID = np.round(np.linspace(-1.0, 1.0, 2001), 3)
+
+# Number of rows of the matrix counted at a time when no other block size is given
+DEFAULT_BLOCK_ROWS = 512
+
+
+# Function to read the class thresholds from the .env file in ascending order
+def getClassThresholds() -> list[float]:
+    return [float(os.environ.get(variable)) for variable in NDVI_CLASS_VARIABLES]
+
+
+# Function to get the thresholds as a string which identifies the class counts calculated with them in the database
+def getThresholdsKey() -> str:
+    return ",".join(repr(threshold) for threshold in getClassThresholds())
+
+
+# Function to get the edges of the histogram stored alongside every NDVI matrix
+def getHistogramEdges() -> np.ndarray:
+    return np.union1d(HISTOGRAM_GRID, getClassThresholds())
+
+
+# Function to calculate the histogram of an NDVI matrix, reading it block by block, so the matrix can be memory
+# mapped or any other array which can be sliced into blocks of rows. The edges of the stored histogram are used
+# unless other edges are given. Index 0 of the counts holds the pixels below the first edge and index i holds the
+# pixels greater than or equal to edge i - 1 and less than edge i. NaN pixels are not counted in any bin.
+def computeHistogram(ndvi: np.ndarray, edges: np.ndarray = None, block_rows: int = DEFAULT_BLOCK_ROWS) -> dict[str: np.ndarray]:
+    if(edges is None):
+        edges = getHistogramEdges()
+    counts = np.zeros(len(edges) + 1, dtype = np.int64)
+
+    for start in range(0, ndvi.shape[0], max(1, block_rows)):
+        block = ndvi[start:start + block_rows]
+        counts += np.bincount(np.digitize(block, edges).ravel(), minlength = len(edges) + 1)
+
+        # NaN pixels are placed in the highest bin by digitize, but they do not belong to any bin
+        if(np.issubdtype(block.dtype, np.floating)):
+            counts[-1] -= np.count_nonzero(np.isnan(block))
+
+    return {
+        "edges": np.asarray(edges),
+        "counts": counts,
+        "total_pixels": np.array(ndvi.size, dtype = np.int64)
+    }
+
+
+# Function to count the pixels of every NDVI class from a histogram in O(number of bins), in the order of
+# NDVI_CLASS_VARIABLES. A pixel belongs to a class if its value is greater than or equal to the threshold of that
+# class and less than the threshold of the next higher class. Returns None if any of the thresholds is not an edge
+# of the histogram, as the counts for such a threshold cannot be calculated exactly.
+def classifyHistogram(histogram: dict[str: np.ndarray]) -> list[int]:
+    thresholds = getClassThresholds()
+    if(not np.all(np.isin(thresholds, histogram["edges"]))):
+        return None
+    positions = np.searchsorted(histogram["edges"], thresholds)
+
+    # Number of pixels greater than or equal to each edge, and then to each threshold
+    at_least = np.cumsum(histogram["counts"][::-1])[::-1]
+    at_least_threshold = np.append(at_least[positions + 1], 0)
+
+    return [int(at_least_threshold[i] - at_least_threshold[i + 1]) for i in range(len(thresholds))]
@@ -0,0 +1,219 @@
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+import numpy as np
+
+# This module implements a compact storage format for NDVI matrices. It is shared by the ndvi-generator,
+# which stores matrices in it, and the analyzer, which reads them.
+# NDVI values lie in [-1, 1], so 8 (or even 4) bytes per pixel is far more precision than is needed.
+# The matrix is stored either as int16 scaled by 10000 (a precision of 0.0001) or as float16, split
+# into chunks of rows which are compressed separately. The file is a regular .npz archive containing
+# one array per chunk along with the metadata required to decode it, so it can also be opened with np.load.
+
+# Encodings supported by the compact format
+ENCODINGS = ("int16", "float16")
+
+# The int16 encoding stores round((value - offset) / scale). NaN values are stored as nodata.
+INT16_SCALE = 1.0 / 10000
+INT16_OFFSET = 0.0
+INT16_NODATA = -32768
+
+# Number of rows of the matrix compressed together in a single chunk
+DEFAULT_CHUNK_ROWS = 256
+
+
+# Function to write a single array as a member of the archive
+def _writeArray(archive: zipfile.ZipFile, name: str, array: np.ndarray) -> None:
+    with archive.open(name + ".npy", "w", force_zip64 = True) as file:
+        np.lib.format.write_array(file, np.asanyarray(array), allow_pickle = False)
+
+
+# Function to encode a block of NDVI values
+def _encode(block: np.ndarray, encoding: str) -> np.ndarray:
+    if(encoding == "float16"):
+        return block.astype(np.float16)
+
+    # Values outside the range of the encoding (like outliers of indices other than NDVI) are clipped to it
+    encoded = np.rint((block - INT16_OFFSET) / INT16_SCALE)
+    np.clip(encoded, INT16_NODATA + 1, np.iinfo(np.int16).max, out = encoded)
+    encoded[np.isnan(encoded)] = INT16_NODATA
+    return encoded.astype(np.int16)
+
+
+# Function to decode a block of NDVI values into float32
+def decodeChunk(block: np.ndarray, scale: float, offset: float, nodata) -> np.ndarray:
+    if(block.dtype == np.float16):
+        return block.astype(np.float32)
+
+    decoded = block.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    decoded[block == nodata] = np.nan
+    return decoded
+
+
+# Function to store an NDVI matrix in the compact format.
+# The matrix is read chunk by chunk, so it can also be a memory mapped array.
+def storeCompactMatrix(matrix: np.ndarray, filename: str, encoding: str = "int16", chunk_rows: int = DEFAULT_CHUNK_ROWS) -> None:
+    if(encoding not in ENCODINGS):
+        raise ValueError(f"Unknown encoding {encoding}. Supported encodings are {', '.join(ENCODINGS)}")
+
+    if(encoding == "int16"):
+        scale, offset, nodata = INT16_SCALE, INT16_OFFSET, INT16_NODATA
+    else:
+        scale, offset, nodata = 1.0, 0.0, np.nan
+
+    with zipfile.ZipFile(filename, "w", compression = zipfile.ZIP_DEFLATED, compresslevel = 1) as archive:
+        _writeArray(archive, "encoding", np.array(encoding))
+        _writeArray(archive, "shape", np.array(matrix.shape, dtype = np.int64))
+        _writeArray(archive, "chunk_rows", np.array(chunk_rows, dtype = np.int64))
+        _writeArray(archive, "scale", np.array(scale, dtype = np.float64))
+        _writeArray(archive, "offset", np.array(offset, dtype = np.float64))
+        _writeArray(archive, "nodata", np.array(nodata, dtype = np.float64))
+
+        for index, start in enumerate(range(0, matrix.shape[0], chunk_rows)):
+            _writeArray(archive, f"chunk_{index:06d}", _encode(np.asarray(matrix[start:start + chunk_rows]), encoding))
+
+
+# Class to read a matrix stored in the compact format lazily. Slicing a range of rows decodes only the chunks
+# holding those rows, so the matrix can be read block by block like a memory mapped array without decoding it
+# into memory. The last decoded chunk is kept, as blocks which are not aligned to chunks start in the middle of one.
+class CompactMatrix:
+    dtype = np.dtype(np.float32)
+    ndim = 2
+
+    def __init__(self, filename: str):
+        self.archive = np.load(filename)
+        self.shape = tuple(int(size) for size in self.archive["shape"])
+        self.size = int(np.prod(self.shape))
+        self.chunk_rows = int(self.archive["chunk_rows"])
+        self.scale = float(self.archive["scale"])
+        self.offset = float(self.archive["offset"])
+        self.nodata = self.archive["nodata"]
+        self.cached_index = None
+        self.cached_chunk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _chunk(self, index: int) -> np.ndarray:
+        if(self.cached_index != index):
+            self.cached_chunk = decodeChunk(self.archive[f"chunk_{index:06d}"], self.scale, self.offset, self.nodata)
+            self.cached_index = index
+        return self.cached_chunk
+
+    # Function to decode the rows from start up to stop
+    def read(self, start: int, stop: int) -> np.ndarray:
+        start = max(0, start)
+        stop = min(stop, self.shape[0])
+        if(stop <= start):
+            return np.empty((0, self.shape[1]), dtype = np.float32)
+
+        first_chunk = start // self.chunk_rows
+        last_chunk = (stop - 1) // self.chunk_rows
+        if(first_chunk == last_chunk):
+            block = self._chunk(first_chunk)
+        else:
+            block = np.concatenate([self._chunk(index) for index in range(first_chunk, last_chunk + 1)], axis = 0)
+
+        offset = start - first_chunk * self.chunk_rows
+        return block[offset:offset + stop - start]
+
+    # Only ranges of rows with a step of 1 can be sliced
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        if(not isinstance(rows, slice) or rows.step not in (None, 1)):
+            raise TypeError("A compact matrix can only be sliced by a range of rows")
+
+        (start, stop, _) = rows.indices(self.shape[0])
+        return self.read(start, stop)
+
+
+# Function to load an NDVI matrix stored in the compact format as a float32 matrix in memory
+def loadCompactMatrix(filename: str) -> np.ndarray:
+    with CompactMatrix(filename) as compact_matrix:
+        matrix = np.empty(compact_matrix.shape, dtype = np.float32)
+        for start in range(0, compact_matrix.shape[0], compact_matrix.chunk_rows):
+            matrix[start:start + compact_matrix.chunk_rows] = compact_matrix.read(start, start + compact_matrix.chunk_rows)
+
+    return matrix
+
+
+# Function to check whether a complete matrix in the compact format is stored in the given file.
+# Only the list of members of the archive is read.
+def isCompactMatrix(filename: str) -> bool:
+    try:
+        with np.load(filename) as archive:
+            shape = tuple(archive["shape"])
+            chunk_rows = int(archive["chunk_rows"])
+            chunks = len(range(0, shape[0], chunk_rows))
+            return len(shape) == 2 and all(f"chunk_{index:06d}" in archive.files for index in range(chunks))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return False
+
+
+# Benchmark of the compact format against plain .npy files.
+# A synthetic NDVI matrix is written and read back in each format and the throughput and file sizes are printed.
+if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--size",
+        type = int,
+        default = 4096,
+        help = "Number of rows and columns of the synthetic NDVI matrix"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type = int,
+        default = 3,
+        help = "Number of times each measurement is repeated. The fastest run is reported."
+    )
+
+    args = parser.parse_args()
+
+    # Synthetic NDVI matrix calculated from random 8 bit bands, similar to the matrices produced by the generator
+    generator = np.random.default_rng(0)
+    band_red = generator.integers(0, 256, (args.size, args.size)).astype(np.float32)
+    band_nir = generator.integers(0, 256, (args.size, args.size)).astype(np.float32)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        matrix = np.nan_to_num((band_nir - band_red) / (band_nir + band_red), nan = -1.0).astype(np.float32)
+    del band_red, band_nir
+
+    megabytes = matrix.size * 4 / (1024 * 1024)
+    print(f"Matrix: {args.size} x {args.size} ({megabytes:.1f} MB as float32)")
+    print(f"{'Format':<12}{'Size (MB)':>12}{'Write (MB/s)':>16}{'Read (MB/s)':>16}{'Max error':>12}")
+
+    formats = [
+        ("npy", ".npy", lambda filename: np.save(filename, matrix), lambda filename: np.load(filename)),
+        ("int16", ".npz", lambda filename: storeCompactMatrix(matrix, filename, "int16"), loadCompactMatrix),
+        ("float16", ".npz", lambda filename: storeCompactMatrix(matrix, filename, "float16"), loadCompactMatrix)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for (name, extension, store, load) in formats:
+            filename = os.path.join(directory, "ndvi_matrix" + extension)
+
+            write_time = float("inf")
+            read_time = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                store(filename)
+                write_time = min(write_time, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                loaded = load(filename)
+                read_time = min(read_time, time.perf_counter() - start)
+
+            size = os.path.getsize(filename) / (1024 * 1024)
+            error = float(np.nanmax(np.abs(loaded - matrix)))
+            print(f"{name:<12}{size:>12.1f}{megabytes / write_time:>16.1f}{megabytes / read_time:>16.1f}{error:>12.6f}")
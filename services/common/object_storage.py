@@ -0,0 +1,111 @@
+import os
+import numpy as np
+
+import ndvi_storage
+
+
+# This class stores objects to the disk.
+# This decreases the execution time of the program as intermediate calculations
+# can be saved to the disk and does not need to be recalculated at each run.
+class ObjectStorage:
+    # Suffix of matrices which are still being written. A matrix is renamed to its final
+    # filename with finalizeMatrix only once all the outputs of its scene are complete.
+    PARTIAL_SUFFIX = ".partial"
+
+    # Extensions of matrices stored as plain .npy files and in the compact format (see ndvi_storage)
+    NPY_EXTENSION = ".npy"
+    COMPACT_EXTENSION = ".npz"
+
+    @staticmethod
+    def storeMatrix(matrix: np.ndarray, path: str, filename: str) -> None:
+        os.makedirs(path, exist_ok = True)
+        with open(os.path.join(path, filename), "wb") as file:
+            np.save(file = file, arr = matrix, allow_pickle = False)
+
+    # Creates a matrix in object storage which is memory mapped to its file.
+    # Results can be written into this matrix block by block without holding the full matrix in memory.
+    @staticmethod
+    def createMatrix(path: str, filename: str, shape: tuple, dtype: np.dtype = np.float32) -> np.memmap:
+        os.makedirs(path, exist_ok = True)
+        return np.lib.format.open_memmap(os.path.join(path, filename), mode = "w+", dtype = dtype, shape = shape)
+    
+    # Loads a matrix from object storage.
+    # By default the matrix is memory mapped read-only, so only the parts which are accessed are read from disk.
+    # Pass mmap_mode = None to read the whole matrix into memory.
+    # Matrices in the compact format are decoded into float32 and are always read into memory.
+    @staticmethod
+    def loadMatrix(filename: str, mmap_mode: str = "r") -> np.ndarray:
+        if(filename.endswith(ObjectStorage.COMPACT_EXTENSION)):
+            return ndvi_storage.loadCompactMatrix(filename)
+
+        loaded_matrix: np.ndarray = np.load(file = filename, mmap_mode = mmap_mode)
+        return loaded_matrix
+
+    # Stores a set of named arrays as a single .npz file
+    @staticmethod
+    def storeArrays(arrays: dict[str: np.ndarray], path: str, filename: str) -> None:
+        os.makedirs(path, exist_ok = True)
+        with open(os.path.join(path, filename), "wb") as file:
+            np.savez(file, **arrays)
+
+    # Moves a partially written .npy matrix to its final filename in the storage format given by the
+    # NDVI_STORAGE_FORMAT environment variable. This is either "npy" (the default) to keep the matrix
+    # as it is, or one of the encodings of the compact format ("int16" or "float16"), in which case the
+    # matrix is converted and stored with the compact extension instead. Returns the final filename.
+    @staticmethod
+    def finalizeMatrix(path: str, filename: str, storage_format: str = None) -> str:
+        if(storage_format is None):
+            storage_format = os.environ.get("NDVI_STORAGE_FORMAT", "npy")
+
+        name = os.path.splitext(filename)[0]
+        partial_path = os.path.join(path, filename + ObjectStorage.PARTIAL_SUFFIX)
+
+        if(storage_format == "npy"):
+            final_filename = name + ObjectStorage.NPY_EXTENSION
+            stale_filename = name + ObjectStorage.COMPACT_EXTENSION
+            os.replace(partial_path, os.path.join(path, final_filename))
+        else:
+            final_filename = name + ObjectStorage.COMPACT_EXTENSION
+            stale_filename = name + ObjectStorage.NPY_EXTENSION
+            compact_partial_path = os.path.join(path, final_filename + ObjectStorage.PARTIAL_SUFFIX)
+
+            matrix = np.load(file = partial_path, mmap_mode = "r")
+            ndvi_storage.storeCompactMatrix(matrix, compact_partial_path, storage_format)
+            del matrix
+
+            # The compact file keeps the modification time of the matrix it was converted from,
+            # so that files derived from the matrix (like its histogram) are not considered older than it.
+            modification_time = os.path.getmtime(partial_path)
+            os.utime(compact_partial_path, (modification_time, modification_time))
+
+            os.replace(compact_partial_path, os.path.join(path, final_filename))
+            os.remove(partial_path)
+
+        # Remove the matrix stored in the other format by an earlier run, if any
+        if(os.path.exists(os.path.join(path, stale_filename))):
+            os.remove(os.path.join(path, stale_filename))
+
+        return final_filename
+
+    # Checks whether a complete and readable matrix is stored at the given location.
+    # Only the header (or the list of chunks of a compact matrix) is read, so this is cheap even for full scenes.
+    @staticmethod
+    def isMatrixStored(path: str, filename: str) -> bool:
+        if(filename.endswith(ObjectStorage.COMPACT_EXTENSION)):
+            return ndvi_storage.isCompactMatrix(os.path.join(path, filename))
+
+        try:
+            matrix = np.load(file = os.path.join(path, filename), mmap_mode = "r")
+        except (OSError, ValueError):
+            return False
+
+        return matrix.ndim == 2 and matrix.size > 0
+
+    # Finds the filename under which a complete matrix with the given name is stored, in either format.
+    # Returns None if the matrix is not stored.
+    @staticmethod
+    def findMatrix(path: str, name: str) -> str:
+        for extension in (ObjectStorage.NPY_EXTENSION, ObjectStorage.COMPACT_EXTENSION):
+            if(ObjectStorage.isMatrixStored(path, name + extension)):
+                return name + extension
+        return None
@@ -0,0 +1,208 @@
+import argparse
+import datetime
+import os
+import random
+import statistics
+import time
+from dotenv import load_dotenv
+import mariadb
+
+load_dotenv()
+
+# Benchmark of the lookups made by the services on a synthetic catalog of images.
+# The catalog is created in a separate database with the columns of the current schema but without any of the
+# indexes, every query is timed, and then the indexes are added by running the ALTER TABLE statements of the
+# migrations which add them, and every query is timed again. The database is dropped at the end.
+
+BENCHMARK_DATABASE = "nature_preservation_benchmark"
+
+# The migrations which add the indexes, in the order in which they are run
+INDEX_MIGRATIONS = ("001_indexes.sql", "002_leases.sql")
+
+# The tables with all the columns of db_setup.sql, but without any of the indexes added by the migrations
+TABLES = [
+    """CREATE TABLE AREAS(
+        area_id INT AUTO_INCREMENT,
+        area_name VARCHAR(255) NOT NULL,
+        PRIMARY KEY(area_id)
+    )""",
+    """CREATE TABLE STORED_DATA_INFO(
+        id INT AUTO_INCREMENT,
+        area_id INT REFERENCES AREAS(area_id),
+        date DATE NOT NULL,
+        sat_data_path VARCHAR(255) NOT NULL,
+        ndvi_generated TINYINT DEFAULT 0,
+        ndvi_data_path VARCHAR(255),
+        lease_owner VARCHAR(128),
+        lease_expires DATETIME,
+        attempts INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(id)
+    )"""
+]
+
+# The queries made by the services, with the same text as in the services. Each is given with a function which
+# returns random parameters for it. Updates are rolled back after they are timed, so they do not change the catalog.
+QUERIES = {
+    "ndvi-generator: pending images": (
+        "SELECT id, area_id, date, sat_data_path FROM STORED_DATA_INFO WHERE ndvi_generated = ? AND (lease_expires IS NULL OR lease_expires < NOW())",
+        lambda area_name: (0,)
+    ),
+    "ndvi-generator: claim images": (
+        "UPDATE STORED_DATA_INFO SET lease_owner = ?, lease_expires = NOW() + INTERVAL ? SECOND, attempts = attempts + 1 "
+        "WHERE ndvi_generated = ? AND attempts < ? AND (lease_expires IS NULL OR lease_expires < NOW()) "
+        "ORDER BY id LIMIT ?",
+        lambda area_name: ("benchmark", 600, 0, 3, 4)
+    ),
+    "analyzer: images of an area": (
+        "SELECT STORED_DATA_INFO.date, STORED_DATA_INFO.ndvi_data_path FROM STORED_DATA_INFO "
+        "JOIN AREAS ON AREAS.area_id = STORED_DATA_INFO.area_id "
+        "WHERE AREAS.area_name = ? AND STORED_DATA_INFO.ndvi_generated = ? ORDER BY STORED_DATA_INFO.date",
+        lambda area_name: (area_name, 1)
+    ),
+    "image-fetcher: area lookup": (
+        "SELECT area_id, area_name FROM AREAS WHERE area_name IN (?)",
+        lambda area_name: (area_name,)
+    )
+}
+
+
+# Function to read the statements which add the indexes from the migrations. Only the ALTER TABLE statements are
+# run, as the checks for duplicates and the selection of the database do not apply to the benchmark database.
+def readIndexStatements() -> list[str]:
+    statements = []
+    for migration in INDEX_MIGRATIONS:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations", migration)) as file:
+            lines = [line for line in file.read().splitlines() if not line.strip().startswith("--")]
+
+        for statement in "\n".join(lines).split(";"):
+            if(statement.strip().upper().startswith("ALTER TABLE")):
+                statements.append(statement.strip())
+
+    return statements
+
+
+# Function to fill the tables with a synthetic catalog.
+# Every area has the same number of images on distinct dates, and a fraction of the images are not processed yet.
+def createCatalog(connection, cursor, rows: int, areas: int, pending_fraction: float, batch_size: int = 10000) -> list[str]:
+    area_names = [f"area_{index:06d}" for index in range(areas)]
+    cursor.executemany("INSERT INTO AREAS (area_name) VALUES (?)", [(area_name,) for area_name in area_names])
+    connection.commit()
+
+    generator = random.Random(0)
+    start_date = datetime.date(2016, 1, 1)
+    batch = []
+    for index in range(rows):
+        area_id = index % areas + 1
+        date = start_date + datetime.timedelta(days = 5 * (index // areas))
+        ndvi_generated = 0 if generator.random() < pending_fraction else 1
+        sat_data_path = f"/data/sat/{area_id}/{date}"
+        ndvi_data_path = f"/data/ndvi/{area_id}/{date}" if ndvi_generated else None
+        batch.append((area_id, date, sat_data_path, ndvi_generated, ndvi_data_path))
+
+        if(len(batch) == batch_size or index == rows - 1):
+            cursor.executemany(
+                "INSERT INTO STORED_DATA_INFO (area_id, date, sat_data_path, ndvi_generated, ndvi_data_path) VALUES (?, ?, ?, ?, ?)",
+                batch
+            )
+            connection.commit()
+            batch = []
+
+    return area_names
+
+
+# Function to time every query. Returns a dictionary from the name of every query to its median time in milliseconds.
+def timeQueries(connection, cursor, area_names: list[str], repeat: int) -> dict[str: float]:
+    generator = random.Random(1)
+    timings = {}
+    for name, (query, getParameters) in QUERIES.items():
+        durations = []
+        for _ in range(repeat):
+            parameters = getParameters(generator.choice(area_names))
+            start = time.perf_counter()
+            cursor.execute(query, parameters)
+            if(query.startswith("UPDATE")):
+                durations.append((time.perf_counter() - start) * 1000)
+                connection.rollback()
+            else:
+                cursor.fetchall()
+                durations.append((time.perf_counter() - start) * 1000)
+
+        timings[name] = statistics.median(durations)
+
+    return timings
+
+
+if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type = int,
+        default = 1000000,
+        help = "Number of images in the synthetic catalog"
+    )
+
+    parser.add_argument(
+        "--areas",
+        type = int,
+        default = 10000,
+        help = "Number of areas in the synthetic catalog"
+    )
+
+    parser.add_argument(
+        "--pending",
+        type = float,
+        default = 0.01,
+        help = "Fraction of the images which have not been processed by the ndvi-generator"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type = int,
+        default = 20,
+        help = "Number of times each query is run. The median time is reported."
+    )
+
+    args = parser.parse_args()
+
+    # Connect to the database server. The benchmark uses its own database.
+    try:
+        connection = mariadb.connect(
+            user = os.environ.get("MYSQL_USER"),
+            password = os.environ.get("MYSQL_PASSWORD"),
+            host = os.environ.get("MYSQL_HOST"),
+            port = int(os.environ.get("MYSQL_PORT"))
+        )
+    except mariadb.Error as e:
+        print(f"Error connecting to MariaDB Platform: {e}")
+        exit(1)
+
+    cursor = connection.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {BENCHMARK_DATABASE}")
+    cursor.execute(f"CREATE DATABASE {BENCHMARK_DATABASE}")
+    cursor.execute(f"USE {BENCHMARK_DATABASE}")
+
+    try:
+        for table in TABLES:
+            cursor.execute(table)
+
+        print(f"Creating a catalog of {args.rows} images of {args.areas} areas")
+        start = time.perf_counter()
+        area_names = createCatalog(connection, cursor, args.rows, args.areas, args.pending)
+        print(f"Created in {time.perf_counter() - start:.1f} s")
+
+        timings_before = timeQueries(connection, cursor, area_names, args.repeat)
+
+        start = time.perf_counter()
+        for statement in readIndexStatements():
+            cursor.execute(statement)
+        print(f"Indexes added in {time.perf_counter() - start:.1f} s\n")
+
+        timings_after = timeQueries(connection, cursor, area_names, args.repeat)
+
+        print(f"{'Query':<42}{'Before (ms)':>14}{'After (ms)':>14}{'Speedup':>10}")
+        for name in QUERIES:
+            print(f"{name:<42}{timings_before[name]:>14.2f}{timings_after[name]:>14.2f}{timings_before[name] / timings_after[name]:>9.1f}x")
+    finally:
+        cursor.execute(f"DROP DATABASE IF EXISTS {BENCHMARK_DATABASE}")
+        connection.close()
@@ -8,11 +8,16 @@ USE nature_preservation;
 CREATE TABLE AREAS(
     area_id INT AUTO_INCREMENT,
     area_name VARCHAR(255) NOT NULL,
-    PRIMARY KEY(area_id)
+    PRIMARY KEY(area_id),
+    UNIQUE KEY area_name (area_name)
 );
 
 -- This table contains information about what years of data are available per area,
--- Where the raw satellite data are available and where the processed NDVI data are available
+-- Where the raw satellite data are available and where the processed NDVI data are available.
+-- There is a single image per area and date. The indexes serve the lookups of the images of an area
+-- by the analyzer and of the images which have not been processed yet by the ndvi-generator.
+-- The lease columns record which ndvi-generator worker has claimed an image and until when, and how
+-- many times the image has been claimed.
 CREATE TABLE STORED_DATA_INFO(
     id INT AUTO_INCREMENT,
     area_id INT REFERENCES AREAS(area_id),
@@ -20,5 +25,39 @@ CREATE TABLE STORED_DATA_INFO(
     sat_data_path VARCHAR(255) NOT NULL,
     ndvi_generated TINYINT DEFAULT 0,
     ndvi_data_path VARCHAR(255),
-    PRIMARY KEY(id)
+    lease_owner VARCHAR(128),
+    lease_expires DATETIME,
+    attempts INT NOT NULL DEFAULT 0,
+    PRIMARY KEY(id),
+    UNIQUE KEY area_date (area_id, date),
+    INDEX area_generated_date (area_id, ndvi_generated, date),
+    INDEX ndvi_generated (ndvi_generated, lease_expires)
+);
+
+-- This table contains the spectral indices (NDVI, EVI, SAVI, NDWI) calculated for every image
+-- and where the matrix of each index is stored
+CREATE TABLE SPECTRAL_INDEX_INFO(
+    id INT AUTO_INCREMENT,
+    data_id INT REFERENCES STORED_DATA_INFO(id),
+    index_name VARCHAR(16) NOT NULL,
+    index_data_path VARCHAR(255) NOT NULL,
+    PRIMARY KEY(id),
+    UNIQUE(data_id, index_name)
+);
+
+-- This table contains the number of pixels in every NDVI class for every image, so that the vegetation
+-- time series of an area can be read without reading its NDVI matrices. It is updated by the ndvi-generator
+-- as images are processed. The thresholds the classes were counted with are stored along with the counts.
+CREATE TABLE VEGETATION_SERIES(
+    data_id INT REFERENCES STORED_DATA_INFO(id),
+    area_id INT REFERENCES AREAS(area_id),
+    date DATE NOT NULL,
+    thresholds VARCHAR(64) NOT NULL,
+    total_pixels BIGINT NOT NULL,
+    no_vegetation_pixels BIGINT NOT NULL,
+    sparse_vegetation_pixels BIGINT NOT NULL,
+    moderate_vegetation_pixels BIGINT NOT NULL,
+    thick_vegetation_pixels BIGINT NOT NULL,
+    PRIMARY KEY(data_id),
+    INDEX(area_id, date)
 );
@@ -0,0 +1,31 @@
+-- Script which merges duplicate areas and images, so that 001_indexes.sql can add the unique constraints.
+-- This is not a migration and is only run by hand, after reviewing the duplicates listed by 001_indexes.sql,
+-- as it removes rows: areas with the same name are merged into the area with the lowest id, and only a single
+-- image is kept for every area and date. The records of the removed images in SPECTRAL_INDEX_INFO and
+-- VEGETATION_SERIES are removed by 003_spectral_indices.sql and 004_vegetation_series.sql, which are run again
+-- afterwards if they were already applied. The files of the removed images are left on disk.
+
+-- Select the database
+USE nature_preservation;
+
+START TRANSACTION;
+
+-- Merge areas with the same name into the area with the lowest id so that the names can be made unique
+UPDATE STORED_DATA_INFO
+    JOIN AREAS AS DUPLICATE_AREAS ON DUPLICATE_AREAS.area_id = STORED_DATA_INFO.area_id
+    JOIN (SELECT area_name, MIN(area_id) AS area_id FROM AREAS GROUP BY area_name) AS FIRST_AREAS
+        ON FIRST_AREAS.area_name = DUPLICATE_AREAS.area_name
+    SET STORED_DATA_INFO.area_id = FIRST_AREAS.area_id
+    WHERE STORED_DATA_INFO.area_id <> FIRST_AREAS.area_id;
+
+DELETE DUPLICATE_AREAS FROM AREAS AS DUPLICATE_AREAS
+    JOIN AREAS AS FIRST_AREAS ON FIRST_AREAS.area_name = DUPLICATE_AREAS.area_name AND FIRST_AREAS.area_id < DUPLICATE_AREAS.area_id;
+
+-- Keep a single image per area and date. The image whose NDVI has been generated is kept if there is one,
+-- otherwise the image which was added last.
+DELETE DUPLICATE_IMAGES FROM STORED_DATA_INFO AS DUPLICATE_IMAGES
+    JOIN STORED_DATA_INFO AS KEPT_IMAGES
+        ON KEPT_IMAGES.area_id = DUPLICATE_IMAGES.area_id AND KEPT_IMAGES.date = DUPLICATE_IMAGES.date
+    WHERE (KEPT_IMAGES.ndvi_generated, KEPT_IMAGES.id) > (DUPLICATE_IMAGES.ndvi_generated, DUPLICATE_IMAGES.id);
+
+COMMIT;
@@ -0,0 +1,34 @@
+-- Migration for databases created with an earlier version of db_setup.sql.
+-- This adds the indexes used by the lookups of the image-fetcher, the ndvi-generator and the analyzer, and the
+-- unique constraints on the area names and on the images of an area and date. Every statement can be run again safely.
+
+-- Select the database
+USE nature_preservation;
+
+-- The unique constraints cannot be added while there are duplicate areas or images. These are listed first,
+-- and the migration then stops without changing anything. They can be merged with merge_duplicates.sql in the
+-- database directory after checking the list, and the migration run again.
+SELECT area_name, COUNT(*) AS areas, GROUP_CONCAT(area_id ORDER BY area_id) AS area_ids
+    FROM AREAS GROUP BY area_name HAVING COUNT(*) > 1;
+
+SELECT area_id, date, COUNT(*) AS images, GROUP_CONCAT(id ORDER BY id) AS image_ids
+    FROM STORED_DATA_INFO GROUP BY area_id, date HAVING COUNT(*) > 1;
+
+DELIMITER //
+BEGIN NOT ATOMIC
+    IF EXISTS (SELECT 1 FROM AREAS GROUP BY area_name HAVING COUNT(*) > 1) THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'AREAS has duplicate area names. Review them and run merge_duplicates.sql first.';
+    END IF;
+    IF EXISTS (SELECT 1 FROM STORED_DATA_INFO GROUP BY area_id, date HAVING COUNT(*) > 1) THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'STORED_DATA_INFO has several images of an area and date. Review them and run merge_duplicates.sql first.';
+    END IF;
+END //
+DELIMITER ;
+
+ALTER TABLE AREAS
+    ADD UNIQUE KEY IF NOT EXISTS area_name (area_name);
+
+ALTER TABLE STORED_DATA_INFO
+    ADD UNIQUE KEY IF NOT EXISTS area_date (area_id, date),
+    ADD INDEX IF NOT EXISTS area_generated_date (area_id, ndvi_generated, date),
+    ADD INDEX IF NOT EXISTS ndvi_generated (ndvi_generated);
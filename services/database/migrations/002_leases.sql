@@ -0,0 +1,16 @@
+-- Migration for databases created before the ndvi-generator worker daemon was added.
+-- This adds the columns in which the daemon records which worker has claimed an image, until when,
+-- and how many times the image has been claimed. Every statement can be run again safely.
+
+-- Select the database
+USE nature_preservation;
+
+ALTER TABLE STORED_DATA_INFO
+    ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(128),
+    ADD COLUMN IF NOT EXISTS lease_expires DATETIME,
+    ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+
+-- The pending images are looked up along with their leases
+ALTER TABLE STORED_DATA_INFO
+    DROP INDEX IF EXISTS ndvi_generated,
+    ADD INDEX ndvi_generated (ndvi_generated, lease_expires);
@@ -0,0 +1,20 @@
+-- Migration for databases created before the ndvi-generator calculated several spectral indices.
+-- This adds the table in which the ndvi-generator records where the matrix of every index of an image is
+-- stored. Every statement can be run again safely.
+
+-- Select the database
+USE nature_preservation;
+
+-- This table contains the spectral indices (NDVI, EVI, SAVI, NDWI) calculated for every image
+-- and where the matrix of each index is stored
+CREATE TABLE IF NOT EXISTS SPECTRAL_INDEX_INFO(
+    id INT AUTO_INCREMENT,
+    data_id INT REFERENCES STORED_DATA_INFO(id),
+    index_name VARCHAR(16) NOT NULL,
+    index_data_path VARCHAR(255) NOT NULL,
+    PRIMARY KEY(id),
+    UNIQUE(data_id, index_name)
+);
+
+-- Remove the records of images which no longer exist, like those removed by merge_duplicates.sql
+DELETE FROM SPECTRAL_INDEX_INFO WHERE data_id NOT IN (SELECT id FROM STORED_DATA_INFO);
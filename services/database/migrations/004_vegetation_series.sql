@@ -0,0 +1,30 @@
+-- Migration for databases created before the vegetation time series was stored in the database.
+-- This adds the table in which the ndvi-generator records the number of pixels in every NDVI class for every
+-- image. Every statement can be run again safely. Images processed before the table was added are classified
+-- from their histograms by the analyzer until they are processed again.
+
+-- Select the database
+USE nature_preservation;
+
+-- This table contains the number of pixels in every NDVI class for every image (see db_setup.sql)
+CREATE TABLE IF NOT EXISTS VEGETATION_SERIES(
+    data_id INT REFERENCES STORED_DATA_INFO(id),
+    area_id INT REFERENCES AREAS(area_id),
+    date DATE NOT NULL,
+    thresholds VARCHAR(64) NOT NULL,
+    total_pixels BIGINT NOT NULL,
+    no_vegetation_pixels BIGINT NOT NULL,
+    sparse_vegetation_pixels BIGINT NOT NULL,
+    moderate_vegetation_pixels BIGINT NOT NULL,
+    thick_vegetation_pixels BIGINT NOT NULL,
+    PRIMARY KEY(data_id),
+    INDEX(area_id, date)
+);
+
+-- Remove the records of images which no longer exist, like those removed by merge_duplicates.sql,
+-- and move the series of merged areas
+DELETE FROM VEGETATION_SERIES WHERE data_id NOT IN (SELECT id FROM STORED_DATA_INFO);
+UPDATE VEGETATION_SERIES
+    JOIN STORED_DATA_INFO ON STORED_DATA_INFO.id = VEGETATION_SERIES.data_id
+    SET VEGETATION_SERIES.area_id = STORED_DATA_INFO.area_id
+    WHERE VEGETATION_SERIES.area_id <> STORED_DATA_INFO.area_id;
@@ -1,31 +1,347 @@
 import argparse
+import asyncio
+import csv
+import glob
 import os
+import re
 import shutil
 import subprocess
+import sys
+import tempfile
 from dotenv import load_dotenv
 import mariadb
 
+# The instrumentation module is shared by all the services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import instrumentation
+
 load_dotenv()
+instrumentation.setService("image-fetcher")
+
+# Bands which are copied from the satellite data.
+# In the multi-band image, the bands are stored in this order.
+BANDS = ["B02", "B03", "B04", "B08"]
+
+# Filename of the multi-band Cloud-Optimized GeoTIFF
+MULTIBAND_FILENAME = "bands.tif"
+
+
+# Function to get the band of a satellite image file.
+# Returns None if the file is not one of the bands which are copied.
+def getBand(image: str) -> str:
+    name, extension = os.path.splitext(image)
+    band = name[-3:]
+    if(extension == ".jp2" and band in BANDS):
+        return band
+    return None
+
+
+# Function to run a GDAL command as an asynchronous subprocess, so that the event loop keeps starting
+# and copying other bands while it runs. Raises CalledProcessError with the output of the command if it fails.
+# Every command is measured as a stage named after the GDAL program.
+async def runCommand(command: list[str]) -> None:
+    with instrumentation.measure(command[0]):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    if(process.returncode != 0):
+        raise subprocess.CalledProcessError(process.returncode, command, stdout.decode(errors = "replace"), stderr.decode(errors = "replace"))
+
+
+# Function to generate the command which crops an image to the given coordinates.
+# The image is also reprojected to Web Mercator.
+def cropCommand(input_file: str, output_file: str, crop_coords: list[str], output_format: str = None) -> list[str]:
+    command = ["gdalwarp", "-te"]
+    for coord in crop_coords:
+        command.append(coord)
+    command.append("-te_srs")
+    command.append("EPSG:4326")
+    command.append("-t_srs")
+    command.append("EPSG:3857")
+    if(output_format is not None):
+        command.append("-of")
+        command.append(output_format)
+    command.append(input_file)
+    command.append(output_file)
+    return command
+
+
+# Function to copy a single band to the output path, cropping it if crop coordinates are specified.
+# A band which is not cropped is copied in a thread so that the copy does not block the event loop.
+async def ingestBand(input_file: str, output_file: str, crop_coords: list[str] = None) -> None:
+    with instrumentation.labels(band = getBand(os.path.basename(input_file))):
+        if(crop_coords):
+            await runCommand(cropCommand(input_file, output_file, crop_coords))
+        else:
+            with instrumentation.measure("copy_band"):
+                await asyncio.to_thread(shutil.copy2, input_file, output_file)
+
+
+# Function to decode a single band into an uncompressed GeoTIFF, cropping it if crop coordinates are specified.
+# These intermediate files are then stacked into the multi-band image.
+async def decodeBand(input_file: str, output_file: str, crop_coords: list[str] = None) -> None:
+    with instrumentation.labels(band = getBand(os.path.basename(input_file))):
+        if(crop_coords):
+            await runCommand(cropCommand(input_file, output_file, crop_coords, "GTiff"))
+        else:
+            await runCommand(["gdal_translate", "-of", "GTiff", input_file, output_file])
+
+
+# Function to run band jobs, each once one of the band slots shared by all the scenes is free.
+# All the jobs are waited for even if one fails, and the first error is then raised.
+async def runBandJobs(band_slots: asyncio.Semaphore, jobs: list) -> None:
+    # Function to run a single job in a band slot
+    async def run(job) -> None:
+        async with band_slots:
+            await job
+
+    results = await asyncio.gather(*[run(job) for job in jobs], return_exceptions = True)
+    for result in results:
+        if(isinstance(result, Exception)):
+            raise result
+
+
+# Function to remove the bands stored in the output path of a scene in the format which was not written by the last
+# ingest: the separate JPEG2000 files after a multi-band ingest, or the multi-band image otherwise
+def removeStaleBands(output_path: str, multiband: bool) -> None:
+    if(multiband):
+        stale_files = [image for image in os.listdir(output_path) if getBand(image) is not None]
+    else:
+        stale_files = [MULTIBAND_FILENAME] if os.path.isfile(os.path.join(output_path, MULTIBAND_FILENAME)) else []
+
+    for stale_file in stale_files:
+        os.remove(os.path.join(output_path, stale_file))
+
+
+# Function to copy the bands of the satellite data in the image path to the output path.
+# The bands are decoded (and cropped) concurrently, as decoding JPEG2000 is the most expensive part of the
+# ingest. Every gdalwarp runs as an asynchronous subprocess, and the number of bands processed at a time
+# across all the scenes is bounded by the band slots.
+# In multi-band mode, all the bands are written into a single Cloud-Optimized GeoTIFF instead
+# of separate JPEG2000 files, so that readers only need to open a single file.
+# The bands stored in the other format by an earlier ingest of the scene are removed once the new ones are written,
+# so that the ndvi-generator never reads them instead.
+async def ingestBands(image_path: str, output_path: str, band_slots: asyncio.Semaphore, crop_coords: list[str] = None, multiband: bool = False) -> None:
+    band_files = {}
+    for image in os.listdir(image_path):
+        band = getBand(image)
+        if(band is not None):
+            band_files[band] = image
+
+    if(not multiband):
+        await runBandJobs(band_slots, [
+            ingestBand(os.path.join(image_path, image), os.path.join(output_path, image), crop_coords)
+            for image in band_files.values()
+        ])
+        removeStaleBands(output_path, multiband)
+        return
+
+    missing_bands = [band for band in BANDS if band not in band_files]
+    if(len(missing_bands) > 0):
+        raise FileNotFoundError(f"Bands {', '.join(missing_bands)} not found in {image_path}")
+
+    with tempfile.TemporaryDirectory(dir = output_path) as temporary_path:
+        decoded_files = [os.path.join(temporary_path, f"{band}.tif") for band in BANDS]
+
+        await runBandJobs(band_slots, [
+            decodeBand(os.path.join(image_path, band_files[band]), decoded_file, crop_coords)
+            for band, decoded_file in zip(BANDS, decoded_files)
+        ])
+
+        # Stack the bands in a virtual dataset and write it as a Cloud-Optimized GeoTIFF
+        stacked_file = os.path.join(temporary_path, "bands.vrt")
+        await runCommand(["gdalbuildvrt", "-separate", stacked_file] + decoded_files)
+        await runCommand([
+            "gdal_translate", "-of", "COG",
+            "-co", "COMPRESS=DEFLATE",
+            "-co", "PREDICTOR=YES",
+            "-co", "NUM_THREADS=ALL_CPUS",
+            stacked_file,
+            os.path.join(output_path, MULTIBAND_FILENAME)
+        ])
+
+    # The separate files are only removed from the output path, never from the satellite data ingested
+    if(not os.path.samefile(image_path, output_path)):
+        removeStaleBands(output_path, multiband)
+
+
+# Function to generate the path where the bands of a scene are stored
+def getOutputPath(area: str, date: str) -> str:
+    return os.path.join(os.environ.get("SAT_STORAGE_BASE_DIR"), area, date)
+
+
+# Function to copy the bands of a single scene to its output path.
+# Returns the scene along with its output path so that it can be registered in the database.
+async def ingestScene(area: str, date: str, image_path: str, band_slots: asyncio.Semaphore, crop_coords: list[str] = None, multiband: bool = False) -> tuple[str, str, str]:
+    output_path = getOutputPath(area, date)
+    os.makedirs(output_path, exist_ok = True)
+
+    # Copy bands 2, 3, 4, and 8 of the input images to the output path.
+    # In the process, if crop coordinates are specified, then crop the images and copy.
+    with instrumentation.measure("ingest_scene", scene = f"{area}/{date}"):
+        await ingestBands(image_path, output_path, band_slots, crop_coords, multiband)
+
+    return (area, date, output_path)
+
+
+# Function to find the sensing date and the image folder of a Sentinel-2 SAFE directory.
+# The name of a SAFE directory looks like S2A_MSIL1C_20210215T043851_N0209_R033_T45RWK_20210215T064606.SAFE,
+# where the third field is the sensing time. The images are in the IMG_DATA folder within the GRANULE folder.
+# Raises ValueError if the name does not hold a sensing time.
+def parseSafeDirectory(safe_path: str) -> tuple[str, str]:
+    name = os.path.splitext(os.path.basename(os.path.normpath(safe_path)))[0]
+    fields = name.split("_")
+    if(len(fields) < 3 or re.fullmatch(r"\d{8}T\d{6}", fields[2]) is None):
+        raise ValueError(f"{safe_path} is not named like a Sentinel-2 SAFE directory")
+    sensing_time = fields[2]
+    date = f"{sensing_time[0:4]}-{sensing_time[4:6]}-{sensing_time[6:8]}"
+
+    image_paths = glob.glob(os.path.join(safe_path, "GRANULE", "*", "IMG_DATA"))
+    if(len(image_paths) != 1):
+        raise FileNotFoundError(f"Expected a single IMG_DATA folder in {safe_path}, found {len(image_paths)}")
+
+    return date, image_paths[0]
+
+
+# Function to read the scenes to ingest from a manifest.
+# The manifest is a CSV file with the columns area, date, image_path and optionally crop_coords,
+# where the crop coordinates are separated by spaces.
+def readManifest(manifest_path: str) -> list[tuple[str, str, str, list[str]]]:
+    scenes = []
+    with open(manifest_path, newline = "") as file:
+        for row in csv.DictReader(file):
+            crop_coords = (row.get("crop_coords") or "").split()
+            scenes.append((row["area"], row["date"], row["image_path"], crop_coords or None))
+
+    return scenes
+
+
+# Function to find the scenes to ingest in a directory tree.
+# The tree contains a folder per area, named after the area, holding the SAFE directories of that area.
+# The crop coordinates of an area are read from a crop_coords.txt file in its folder if present,
+# otherwise the default crop coordinates are used. SAFE directories which cannot be parsed are reported and skipped.
+def findScenes(batch_path: str, default_crop_coords: list[str] = None) -> list[tuple[str, str, str, list[str]]]:
+    scenes = []
+    for area in sorted(os.listdir(batch_path)):
+        area_path = os.path.join(batch_path, area)
+        if(not os.path.isdir(area_path)):
+            continue
+
+        crop_coords = default_crop_coords
+        crop_coords_path = os.path.join(area_path, "crop_coords.txt")
+        if(os.path.isfile(crop_coords_path)):
+            with open(crop_coords_path) as file:
+                crop_coords = file.read().split()
+
+        for safe_directory in sorted(os.listdir(area_path)):
+            if(safe_directory.endswith(".SAFE")):
+                try:
+                    date, image_path = parseSafeDirectory(os.path.join(area_path, safe_directory))
+                except (ValueError, FileNotFoundError) as e:
+                    print(f"Skipping {os.path.join(area_path, safe_directory)}: {e}")
+                    continue
+                scenes.append((area, date, image_path, crop_coords))
+
+    return scenes
+
+
+# Function to keep a single scene for every area and date.
+# Scenes of the same area and date would be written to the same output path at the same time, so only the last
+# one listed is kept and the others are reported. For SAFE directories this is the one processed last, as they
+# are listed in order of their names, which end with the processing time.
+def removeDuplicateScenes(scenes: list[tuple[str, str, str, list[str]]]) -> list[tuple[str, str, str, list[str]]]:
+    unique_scenes = {}
+    for scene in scenes:
+        (area, date, image_path, crop_coords) = scene
+        if((area, date) in unique_scenes):
+            print(f"Skipping {unique_scenes[(area, date)][2]} for {area} on {date}, as {image_path} is also listed for it")
+        unique_scenes[(area, date)] = scene
+
+    return list(unique_scenes.values())
+
+
+# Function to ingest many scenes concurrently in a single event loop.
+# At most scene_workers scenes are ingested at a time, and at most workers bands are processed at a time
+# across all of them, so the bands of the next scene start as soon as those of the last one finish.
+async def ingestScenesAsync(scenes: list[tuple[str, str, str, list[str]]], scene_workers: int, workers: int, multiband: bool) -> list[tuple[str, str, str]]:
+    scene_slots = asyncio.Semaphore(max(1, scene_workers))
+    band_slots = asyncio.Semaphore(max(1, workers))
+    ingested_scenes = []
+
+    # Function to ingest a single scene once one of the scene slots is free, reporting it if it fails
+    async def ingest(area: str, date: str, image_path: str, crop_coords: list[str]) -> None:
+        async with scene_slots:
+            try:
+                ingested_scenes.append(await ingestScene(area, date, image_path, band_slots, crop_coords, multiband))
+            except Exception as e:
+                print(f"Error ingesting {image_path} for {area} on {date}: {e}")
+
+    await asyncio.gather(*[ingest(*scene) for scene in scenes])
+
+    return ingested_scenes
+
+
+# Function to ingest many scenes concurrently.
+# Returns the scenes which were ingested successfully. A scene which fails is reported and skipped
+# so that the other scenes are still ingested.
+def ingestScenes(scenes: list[tuple[str, str, str, list[str]]], scene_workers: int = 1, workers: int = len(BANDS), multiband: bool = False) -> list[tuple[str, str, str]]:
+    return asyncio.run(ingestScenesAsync(scenes, scene_workers, workers, multiband))
+
+
+# Function to register ingested scenes in the database in a single transaction.
+# The areas are inserted with an atomic upsert which leaves existing areas untouched, so concurrent runs
+# registering the same area never create duplicates. All the ids are then looked up in one query and all
+# the scenes are upserted with a single batched statement. A scene which is ingested again for the same
+# area and date replaces the earlier one, and its NDVI is generated again, as its bands were overwritten
+# even if they were written to the same path.
+@instrumentation.instrumented("register_scenes")
+def registerScenes(connection, cursor, scenes: list[tuple[str, str, str]]) -> None:
+    if(len(scenes) == 0):
+        return
+
+    area_names = sorted(set(area for (area, date, output_path) in scenes))
+
+    # Add the areas to database if not already present
+    cursor.executemany(
+        "INSERT INTO AREAS (area_name) VALUES (?) ON DUPLICATE KEY UPDATE area_name = area_name",
+        [(area,) for area in area_names]
+    )
+
+    # Get the ids of all the areas
+    placeholders = ", ".join(["?"] * len(area_names))
+    cursor.execute(f"SELECT area_id, area_name FROM AREAS WHERE area_name IN ({placeholders})", tuple(area_names))
+    area_ids = { area_name: area_id for (area_id, area_name) in cursor.fetchall() }
+
+    # Add the new image path data to database
+    cursor.executemany(
+        "INSERT INTO STORED_DATA_INFO (area_id, date, sat_data_path) VALUES (?, ?, ?) "
+        "ON DUPLICATE KEY UPDATE ndvi_generated = 0, attempts = 0, sat_data_path = VALUES(sat_data_path)",
+        [(area_ids[area], date, output_path) for (area, date, output_path) in scenes]
+    )
+
+    # Commit the changes made to the database
+    connection.commit()
 
-parser = argparse.ArgumentParser()
 
 if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
     # Add the arguments for loading new data
     parser.add_argument(
         "--area",
-        required = True,
         help = "Area where the input image belongs"
     )
 
     parser.add_argument(
         "--date",
-        required = True,
         help = "Date on which the image was taken. The format should be YYYY-MM-DD"
     )
 
     parser.add_argument(
         "--image_path",
-        required = True,
         help = "Path where the input image is located"
     )
 
@@ -35,8 +351,50 @@ if(__name__ == "__main__"):
         nargs = '+'
     )
 
+    parser.add_argument(
+        "--manifest",
+        help = "CSV file with the columns area, date, image_path and optionally crop_coords, listing the scenes to ingest"
+    )
+
+    parser.add_argument(
+        "--batch_path",
+        help = "Directory with a folder per area containing the SAFE directories of that area, all of which are ingested"
+    )
+
+    parser.add_argument(
+        "--scene_workers",
+        type = int,
+        default = 2,
+        help = "Maximum number of scenes ingested concurrently in batch mode"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type = int,
+        default = len(BANDS),
+        help = "Maximum number of bands processed concurrently, across all the scenes being ingested"
+    )
+
+    parser.add_argument(
+        "--multiband",
+        action = "store_true",
+        help = f"Store all the bands in a single Cloud-Optimized GeoTIFF ({MULTIBAND_FILENAME}) instead of separate JPEG2000 files"
+    )
+
     args = parser.parse_args()
 
+    # Collect the scenes to ingest, either from the batch arguments or the single scene arguments
+    if(args.manifest):
+        scenes = readManifest(args.manifest)
+    elif(args.batch_path):
+        scenes = findScenes(args.batch_path, args.crop_coords)
+    elif(args.area and args.date and args.image_path):
+        scenes = [(args.area, args.date, args.image_path, args.crop_coords)]
+    else:
+        parser.error("either --manifest, --batch_path, or all of --area, --date and --image_path are required")
+
+    scenes = removeDuplicateScenes(scenes)
+
     # Setup connection to database
     try:
         connection = mariadb.connect(
@@ -53,66 +411,18 @@ if(__name__ == "__main__"):
     # Get the cursor to the database
     cursor = connection.cursor()
 
-    # Generate the output path
-    output_path = os.path.join(os.environ.get("SAT_STORAGE_BASE_DIR"), args.area, args.date)
-    os.makedirs(output_path, exist_ok = True)
+    # Copy the bands of all the scenes, then register the ones which succeeded in the database together
+    ingested_scenes = ingestScenes(scenes, args.scene_workers, args.workers, args.multiband)
+    registerScenes(connection, cursor, ingested_scenes)
 
-    # Iterate over the images in the input path and copy the images to the output path.
-    # In the process, if crop coordinates are specified, then crop the images and copy.
-    for image in os.listdir(args.image_path):
-        if(args.crop_coords):
-            # Convert the coords list from string to floats
-            # crop_coords = list(map(float, args.crop_coords))
-
-            # Copy only bands 2, 3, 4, and 8
-            if(image.endswith("B02.jp2") or image.endswith("B03.jp2") or image.endswith("B04.jp2") or image.endswith("B08.jp2")):
-                # Generate the command to be executed
-                command = ["gdalwarp", "-te"]
-                for coord in args.crop_coords:
-                    command.append(coord)
-                command.append("-te_srs")
-                command.append("EPSG:4326")
-                command.append("-t_srs")
-                command.append("EPSG:3857")
-                command.append(os.path.join(args.image_path, image))
-                command.append(os.path.join(output_path, image))
-
-                # Execute the command
-                subprocess.run(
-                    command,
-                    capture_output = True,
-                    text = True,
-                    check = True
-                )
-        
-        else:
-            # Copy only bands 2, 3, 4, and 8
-            if(image.endswith("B02.jp2") or image.endswith("B03.jp2") or image.endswith("B04.jp2") or image.endswith("B08.jp2")):
-                shutil.copy2(os.path.join(args.image_path, image), output_path)
-        
-    
-    # Add the area to database if not already present
-    cursor.execute("SELECT area_id FROM AREAS WHERE area_name = ?", (args.area,))
-
-    rowcount = 0
-    for (area_id,) in cursor:
-        rowcount += 1
-
-    if(rowcount == 0):
-        cursor.execute("INSERT INTO AREAS (area_name) VALUES (?)", (args.area,))
-        area_id = cursor.lastrowid
-    else:
-        for (id,) in cursor:
-            area_id = id
-    
-    # Add the new image path data to database
-    cursor.execute(
-        "INSERT INTO STORED_DATA_INFO (area_id, date, sat_data_path) VALUES (?, ?, ?)",
-        (area_id, args.date, output_path)
-    )
-
-    # Commit the changes made to the database
-    connection.commit()
+    print(f"Ingested {len(ingested_scenes)} of {len(scenes)} scenes")
 
     # Close the connection to the database
     connection.close()
+
+    # Sum up the measurements of the stages of this and earlier runs
+    instrumentation.writePrometheus()
+
+    # Report failure if any of the scenes could not be ingested
+    if(len(ingested_scenes) < len(scenes)):
+        exit(1)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# This module caches decoded satellite bands on the local disk, so that every band is only decoded once.
+# Decoding a JPEG2000 band is far slower than the NDVI calculation itself, and the same bands are decoded
+# again whenever a scene is processed again (for example to calculate other spectral indices).
+# A decoded band is stored as a raw .npy file at its full bit depth and is read back memory mapped, so reading
+# a cached band copies nothing until the pixels are used. Cached bands are keyed by the path, size and
+# modification time of the file they were decoded from, so a band is decoded again whenever its file changes.
+# The least recently used bands are removed once the cache grows beyond BAND_CACHE_MAX_MB megabytes
+# (BAND_CACHE_MAX_MB in the .env file, 0 disables the cache). The cache is stored in BAND_CACHE_DIR.
+
+DEFAULT_BAND_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ndvi_band_cache")
+DEFAULT_BAND_CACHE_MAX_MB = 4096
+
+
+# Function to calculate the key of the cached band decoded from the given file.
+# A file holding several bands is given the name of the band as well.
+def getBandKey(filename: str, band: str = "") -> str:
+    stat = os.stat(filename)
+    identity = f"{os.path.abspath(filename)}|{band}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+# Function to remove the least recently used bands from the cache until it fits within the given size.
+# Other processes may be using the cache at the same time, so bands which have already been removed are ignored.
+# On POSIX systems, a band which is still memory mapped by a process stays readable by it after it is removed.
+# On Windows, a band which is memory mapped cannot be removed, so it is skipped and removed by a later eviction.
+def evictBands(cache_dir: str, max_bytes: float, keep_filename: str = None) -> None:
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if(not filename.endswith(".npy") or filename == keep_filename):
+            continue
+
+        try:
+            stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        except OSError:
+            continue
+
+    total_bytes = sum(size for (_, size, _) in entries)
+    if(keep_filename is not None and os.path.isfile(os.path.join(cache_dir, keep_filename))):
+        total_bytes += os.path.getsize(os.path.join(cache_dir, keep_filename))
+
+    for (_, size, filename) in sorted(entries):
+        if(total_bytes <= max_bytes):
+            break
+
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # The band is in use (or cannot be removed for another reason) and still takes up space
+            continue
+        total_bytes -= size
+
+
+# Function to load a band, decoding it with the given function only if it is not already in the cache.
+# The decode function is called without arguments and returns the band at its full bit depth.
+# Returns the band memory mapped from the cache, or the decoded band itself if the cache is disabled.
+def loadBand(filename: str, decode, band: str = "") -> np.ndarray:
+    cache_dir = os.environ.get("BAND_CACHE_DIR", DEFAULT_BAND_CACHE_DIR)
+    max_bytes = float(os.environ.get("BAND_CACHE_MAX_MB", DEFAULT_BAND_CACHE_MAX_MB)) * 1024 * 1024
+    if(max_bytes <= 0):
+        return decode()
+
+    cached_filename = getBandKey(filename, band) + ".npy"
+    cached_path = os.path.join(cache_dir, cached_filename)
+
+    if(os.path.isfile(cached_path)):
+        try:
+            image = np.load(cached_path, mmap_mode = "r")
+
+            # Mark the band as recently used
+            os.utime(cached_path)
+            return image
+        except (OSError, ValueError):
+            # The band was removed by another process or is damaged, so it is decoded again
+            pass
+
+    image = decode()
+    if(image is None):
+        raise ValueError(f"Could not decode {filename}")
+
+    # The band is written under a name unique to this process and then renamed, so that other
+    # processes never read a partially written band
+    os.makedirs(cache_dir, exist_ok = True)
+    partial_path = f"{cached_path}.{os.getpid()}.partial"
+    with open(partial_path, "wb") as file:
+        np.save(file, image)
+    os.replace(partial_path, cached_path)
+
+    evictBands(cache_dir, max_bytes, keep_filename = cached_filename)
+
+    return np.load(cached_path, mmap_mode = "r")
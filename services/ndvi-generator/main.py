@@ -1,41 +1,628 @@
+import argparse
+import concurrent.futures
 import numpy as np
 import cv2
-import GPUtil
 from dotenv import load_dotenv
 import os
+import signal
+import socket
+import time
+import sys
+import uuid
 import mariadb
 
+import band_cache
 import ndvi_generator
+import overviews
+import pipeline
+import spectral_indices
 import visualizations
 
+# The modules in common are shared by all the services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import instrumentation
+import ndvi_histogram
+from object_storage import ObjectStorage
+
 load_dotenv()
+instrumentation.setService("ndvi-generator")
 
-# Check whether GPU is available and set flag accordingly
-available_gpu_list = GPUtil.getAvailable()
+# The GDAL Python bindings are only needed to read the multi-band images written by the image-fetcher
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
 
-if(len(available_gpu_list) == 0):
-    gpu_available: bool = False
-else:
-    gpu_available: bool = True
-    import cupy as cp
+# Filename of the multi-band Cloud-Optimized GeoTIFF written by the image-fetcher and the order of its bands
+MULTIBAND_FILENAME = "bands.tif"
+MULTIBAND_BANDS = ["B02", "B03", "B04", "B08"]
 
 
-# This class stores objects to the disk.
-# This decreases the execution time of the program as intermediate calculations
-# can be saved to the disk and does not need to be recalculated at each run.
-class ObjectStorage:
-    @staticmethod
-    def storeMatrix(matrix: np.ndarray, path: str, filename: str) -> None:
-        os.makedirs(path, exist_ok = True)
-        np.save(file = os.path.join(path, filename), arr = matrix, allow_pickle = False)
-    
-    @staticmethod
-    def loadMatrix(filename: str) -> np.ndarray:
-        loaded_matrix: np.ndarray = np.load(file = filename)
-        return loaded_matrix
+# Function to get the spectral indices calculated for every scene.
+# NDVI is always calculated. Other indices are added with the SPECTRAL_INDICES environment variable.
+def getIndexNames() -> list[str]:
+    index_names = spectral_indices.getRequestedIndices()
+    return ["ndvi"] + [name for name in index_names if name != "ndvi"]
+
+
+# The processing of a scene is split into stages, which pass the state of the scene from one to the next as a
+# dictionary. processScene runs the stages one after the other, and the pipeline (see pipeline.py) runs the stages
+# of different scenes concurrently. The NDVI matrix is renamed to its final filename at the very end of the
+# last stage, so its presence marks the scene as complete.
+
+# Size of the reads with which the files of the bands of a scene are prefetched
+PREFETCH_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+# Function to read the files of memory mapped bands through once, so that their pages are in the page cache when
+# the bands are used. The pages belong to the page cache of the operating system, which can reclaim them under
+# memory pressure, rather than to this process, so the bands of a scene waiting in a queue hold no memory of their own.
+def prefetchBands(bands: dict[str: np.ndarray]) -> None:
+    buffer = bytearray(PREFETCH_CHUNK_BYTES)
+    for image in bands.values():
+        if(isinstance(image, np.memmap) and image.filename is not None):
+            with open(image.filename, "rb", buffering = 0) as file:
+                while(file.readinto(buffer) > 0):
+                    pass
+
+
+# Function to read the bands of a scene needed by all the requested spectral indices.
+# The bands stay memory mapped from the band cache and are read as they are used by the calculation.
+# With prefetch = True, their files are also read through here (see prefetchBands).
+def readScene(id: int, area_id: int, date, sat_data_path: str, prefetch: bool = False) -> dict:
+    index_names = getIndexNames()
+    with instrumentation.measure("read", scene = id):
+        bands = readBands(sat_data_path, spectral_indices.getRequiredBands(index_names))
+        if(prefetch):
+            prefetchBands(bands)
+
+    return {
+        "id": id,
+        "save_path": getSavePath(area_id, date),
+        "index_names": index_names,
+        "bands": bands
+    }
+
+
+# Function to calculate the matrices of all the spectral indices of a scene and the histogram of its NDVI matrix.
+# The matrices are calculated block by block directly into their files in object storage, under partial filenames,
+# so that peak memory stays bounded irrespective of the size of the scene.
+def computeScene(scene: dict) -> dict:
+    bands = scene.pop("bands")
+    shape = bands["B04"].shape
+
+    with instrumentation.measure("compute", scene = scene["id"]):
+        matrices = {
+            name: ObjectStorage.createMatrix(scene["save_path"], f"{name}_matrix.npy" + ObjectStorage.PARTIAL_SUFFIX, shape)
+            for name in scene["index_names"]
+        }
+
+        # Generate the NDVI matrix with the backend chosen by ndvi_generator (on the GPU if one is available).
+        # If other indices are requested, all the indices are instead calculated together in a single pass over the bands,
+        # with NDVI calculated from the intermediate results it shares with the other indices.
+        if(len(scene["index_names"]) == 1):
+            with instrumentation.measure("ndvi_compute"):
+                ndvi_generator.generateNDVI(bands["B04"], bands["B08"], output = matrices["ndvi"])
+        else:
+            with instrumentation.measure("spectral_indices_compute"):
+                spectral_indices.computeIndices(bands, matrices)
+
+        with instrumentation.measure("store_matrix"):
+            for matrix in matrices.values():
+                matrix.flush()
+
+        scene["matrices"] = matrices
+        with instrumentation.measure("histogram"):
+            scene["histogram"] = ndvi_histogram.computeHistogram(matrices["ndvi"], block_rows = ndvi_generator.blockRows(matrices["ndvi"].shape[1]))
+
+    return scene
+
+
+# Function to render the visualizations of the NDVI matrix of a scene and its pyramid of overviews
+def renderScene(scene: dict) -> dict:
+    save_path = scene["save_path"]
+    ndvi = scene["matrices"]["ndvi"]
+
+    with instrumentation.measure("render", scene = scene["id"]):
+        # Generate NDVI image and overlay with colors according to continuous values
+        with instrumentation.measure("visualize_continuous"):
+            ndvi_vis_continuous = visualizations.visualizeNDVIContinuous(ndvi)
+            cv2.imwrite(os.path.join(save_path, "ndvi_continuous.jpg"), ndvi_vis_continuous)
+
+        # Generate NDVI image and overlay with colors according to categorical values
+        with instrumentation.measure("visualize_categorical"):
+            ndvi_vis_categorical = visualizations.visualizeNDVICategorical(ndvi)
+            cv2.imwrite(os.path.join(save_path, "ndvi_categorical.jpg"), ndvi_vis_categorical)
+        del ndvi_vis_continuous, ndvi_vis_categorical
+
+        # Build the pyramid of downsampled overviews of the matrix and both visualizations for fast previews
+        with instrumentation.measure("overviews"):
+            overviews.buildOverviews(ndvi, save_path)
+
+    return scene
+
+
+# Function to store the histogram of a scene and move its matrices to their final filenames.
+# Returns the id of the scene, the path where the NDVI data has been stored, the filenames of the matrices
+# of all the indices and the class counts of the scene, so that the database can be updated accordingly.
+def persistScene(scene: dict) -> tuple[int, str, dict[str: str], tuple[int]]:
+    save_path = scene["save_path"]
+
+    with instrumentation.measure("persist", scene = scene["id"]):
+        # Store the histogram of the matrix alongside it so that the analyzer can get class counts without reading the matrix.
+        # The class counts of the scene are also added to the vegetation time series of its area in the database.
+        ObjectStorage.storeArrays(scene["histogram"], save_path, ndvi_histogram.HISTOGRAM_FILENAME)
+        class_counts = getHistogramClassCounts(scene["histogram"])
+
+        # Release the matrices before renaming them, as a memory mapped file cannot be renamed on Windows.
+        # The NDVI matrix is renamed last. Once renamed, its presence marks the scene as complete.
+        del scene["matrices"]
+        filenames = {}
+        for name in reversed(scene["index_names"]):
+            with instrumentation.measure("finalize_matrix", index = name):
+                filenames[name] = ObjectStorage.finalizeMatrix(save_path, f"{name}_matrix.npy")
+
+    return (scene["id"], save_path, filenames, class_counts)
+
+
+# Function to generate the NDVI matrix and its visualizations for a single scene, along with the matrices of
+# any other spectral indices requested, by running all the stages of the processing one after the other.
+# This runs either in the main process or in a worker process.
+def processScene(id: int, area_id: int, date, sat_data_path: str) -> tuple[int, str, dict[str: str], tuple[int]]:
+    return persistScene(renderScene(computeScene(readScene(id, area_id, date, sat_data_path))))
+
+
+# Function to get the last time a file was written or replaced. The change time is included, as files copied
+# or extracted with their original modification time still get a new change time.
+def getChangeTime(path: str) -> float:
+    stat = os.stat(path)
+    return max(stat.st_mtime, stat.st_ctime)
+
+
+# Function to find the files holding the given bands of a scene. Returns a dictionary from band name to file.
+# If the image-fetcher stored the scene as a multi-band image, every band is held by that image, unless the scene
+# was ingested again as separate JPEG2000 files after the image was written. Raises FileNotFoundError if a band is missing.
+def findBandFiles(sat_data_path: str, bands: list[str] = ("B04", "B08")) -> dict[str: str]:
+    band_files = {}
+    for image_file in os.listdir(sat_data_path):
+        for band in bands:
+            if(image_file.endswith(f"{band}.jp2")):
+                band_files[band] = os.path.join(sat_data_path, image_file)
+
+    multiband_path = os.path.join(sat_data_path, MULTIBAND_FILENAME)
+    if(os.path.isfile(multiband_path)):
+        multiband_time = getChangeTime(multiband_path)
+        if(all(getChangeTime(path) <= multiband_time for path in band_files.values())):
+            return { band: multiband_path for band in bands }
+
+    missing_bands = [band for band in bands if band not in band_files]
+    if(len(missing_bands) > 0):
+        raise FileNotFoundError(f"Bands {', '.join(missing_bands)} not found in {sat_data_path}")
+
+    return band_files
+
+
+# Function to read the images of the given bands of a scene. Returns a dictionary from band name to image.
+# Every band is read at its full bit depth (12 bit values stored as 16 bit for Sentinel-2) and is only decoded
+# once. Later reads of the same band are memory mapped from the band cache.
+# If the bands are held by a multi-band image (see findBandFiles), they are read from it with GDAL.
+# Otherwise the separate JPEG2000 files are loaded using OpenCV.
+def readBands(sat_data_path: str, bands: list[str] = ("B04", "B08")) -> dict[str: np.ndarray]:
+    band_files = findBandFiles(sat_data_path, bands)
+
+    multiband_path = os.path.join(sat_data_path, MULTIBAND_FILENAME)
+    if(multiband_path in band_files.values()):
+        if(gdal is None):
+            raise ImportError(f"The GDAL Python bindings are required to read {multiband_path}")
+
+        # Function to decode a single band of the multi-band image
+        def decodeBand(band: str) -> np.ndarray:
+            with instrumentation.measure("band_decode", band = band):
+                dataset = gdal.Open(multiband_path)
+                return dataset.GetRasterBand(MULTIBAND_BANDS.index(band) + 1).ReadAsArray()
+
+        return {
+            band: band_cache.loadBand(multiband_path, lambda: decodeBand(band), band = band)
+            for band in bands
+        }
+
+    # Function to decode a single JPEG2000 band
+    def decodeImage(image_path: str, band: str) -> np.ndarray:
+        with instrumentation.measure("band_decode", band = band):
+            return cv2.imread(image_path, cv2.IMREAD_ANYDEPTH)
+
+    # Load the images of the required bands using OpenCV
+    return {
+        band: band_cache.loadBand(image_path, lambda: decodeImage(image_path, band))
+        for band, image_path in band_files.items()
+    }
+
+
+# Function to generate the path in object storage where the NDVI data of a scene is stored
+def getSavePath(area_id: int, date) -> str:
+    return os.path.join(
+        os.environ.get("NDVI_STORAGE_BASE_DIR"),
+        str(area_id),
+        str(date)
+    )
+
+
+# Function to find the matrices of all the requested indices of a scene which already exist in object storage.
+# Returns None unless all the outputs of the scene are complete. This happens when an earlier run was
+# interrupted after the scene was processed but before the database was updated.
+# Outputs older than the bands of the scene are also ignored, as the scene was ingested again after they were
+# calculated (the image-fetcher stores the bands of an area and date in the same place every time).
+def findProcessedScene(save_path: str, sat_data_path: str) -> dict[str: str]:
+    image_paths = [os.path.join(save_path, "ndvi_continuous.jpg"), os.path.join(save_path, "ndvi_categorical.jpg")]
+    if(not all(os.path.isfile(image_path) for image_path in image_paths)):
+        return None
+
+    filenames = {}
+    for name in getIndexNames():
+        filenames[name] = ObjectStorage.findMatrix(save_path, f"{name}_matrix")
+        if(filenames[name] is None):
+            return None
+
+    # If the bands cannot be found, the scene cannot be processed again, so the outputs are kept
+    try:
+        band_files = findBandFiles(sat_data_path, spectral_indices.getRequiredBands(getIndexNames()))
+    except OSError:
+        return filenames
+
+    output_paths = image_paths + [os.path.join(save_path, filename) for filename in filenames.values()]
+    if(min(os.path.getmtime(path) for path in output_paths) < max(getChangeTime(path) for path in band_files.values())):
+        return None
+
+    return filenames
+
+
+# Function to get the total number of pixels followed by the number of pixels of every NDVI class from a histogram.
+# Returns None if the histogram was built with other thresholds.
+def getHistogramClassCounts(histogram: dict[str: np.ndarray]) -> tuple[int]:
+    class_counts = ndvi_histogram.classifyHistogram(histogram)
+    if(class_counts is None):
+        return None
+
+    return (int(histogram["total_pixels"]), *class_counts)
+
+
+# Function to get the class counts of a scene which was already processed from the histogram stored alongside
+# its NDVI matrix. If the histogram is missing or was built with other thresholds, it is built again from the matrix.
+def getSceneClassCounts(save_path: str) -> tuple[int]:
+    histogram_path = os.path.join(save_path, ndvi_histogram.HISTOGRAM_FILENAME)
+    if(os.path.isfile(histogram_path)):
+        with np.load(histogram_path) as histogram:
+            class_counts = getHistogramClassCounts(histogram)
+        if(class_counts is not None):
+            return class_counts
+
+    ndvi = ObjectStorage.loadMatrix(os.path.join(save_path, ObjectStorage.findMatrix(save_path, "ndvi_matrix")))
+    histogram = ndvi_histogram.computeHistogram(ndvi, block_rows = ndvi_generator.blockRows(ndvi.shape[1]))
+    ObjectStorage.storeArrays(histogram, save_path, ndvi_histogram.HISTOGRAM_FILENAME)
+    return getHistogramClassCounts(histogram)
+
+
+# Function to mark scenes as processed in the database and commit the change.
+# Both the columns of every scene are updated in a single batched statement, and the matrices of
+# the spectral indices of every scene are registered in another. The class counts of every scene
+# are added to the vegetation time series of its area in a third statement.
+@instrumentation.instrumented("update_database")
+def updateDatabase(connection, cursor, processed_scenes: list[tuple[int, str, dict[str: str], tuple[int]]]) -> None:
+    if(len(processed_scenes) == 0):
+        return
+
+    cursor.executemany(
+        "UPDATE STORED_DATA_INFO SET ndvi_generated = ?, ndvi_data_path = ? WHERE id = ?",
+        [(1, save_path, id) for (id, save_path, filenames, class_counts) in processed_scenes]
+    )
+    # Databases set up before the table of the spectral indices was added do not have it (see
+    # migrations/003_spectral_indices.sql). The scenes are then still marked as processed, as the path of
+    # their NDVI matrix is stored in STORED_DATA_INFO.
+    try:
+        cursor.executemany(
+            "INSERT INTO SPECTRAL_INDEX_INFO (data_id, index_name, index_data_path) VALUES (?, ?, ?) "
+            "ON DUPLICATE KEY UPDATE index_data_path = VALUES(index_data_path)",
+            [
+                (id, name, os.path.join(save_path, filename))
+                for (id, save_path, filenames, class_counts) in processed_scenes
+                for name, filename in filenames.items()
+            ]
+        )
+    except mariadb.Error as e:
+        print(f"Could not update the spectral indices: {e}")
+
+    # The area and date of every scene are copied from its row so that the series of an area can be read in date order
+    # with a single indexed query. The thresholds are stored so that counts for other thresholds are never mixed up.
+    # Databases set up before the table was added do not have it (see migrations/004_vegetation_series.sql). The scenes
+    # are then still marked as processed, as the analyzer classifies every image missing from the table from its histogram.
+    try:
+        cursor.executemany(
+            "INSERT INTO VEGETATION_SERIES (data_id, area_id, date, thresholds, total_pixels, no_vegetation_pixels, "
+            "sparse_vegetation_pixels, moderate_vegetation_pixels, thick_vegetation_pixels) "
+            "SELECT id, area_id, date, ?, ?, ?, ?, ?, ? FROM STORED_DATA_INFO WHERE id = ? "
+            "ON DUPLICATE KEY UPDATE thresholds = VALUES(thresholds), total_pixels = VALUES(total_pixels), "
+            "no_vegetation_pixels = VALUES(no_vegetation_pixels), sparse_vegetation_pixels = VALUES(sparse_vegetation_pixels), "
+            "moderate_vegetation_pixels = VALUES(moderate_vegetation_pixels), thick_vegetation_pixels = VALUES(thick_vegetation_pixels)",
+            [
+                (ndvi_histogram.getThresholdsKey(), *class_counts, id)
+                for (id, save_path, filenames, class_counts) in processed_scenes
+            ]
+        )
+    except mariadb.Error as e:
+        print(f"Could not update the vegetation time series: {e}")
+
+    connection.commit()
+
+
+# Function run in every process of a pool of the given number of workers before it processes any scene.
+# The fused backend calculates NDVI in a thread per CPU core by default, so unless NDVI_THREADS is set,
+# the cores are split between the workers instead of every worker starting a thread per core.
+def initializeWorker(workers: int) -> None:
+    if("NDVI_THREADS" not in os.environ):
+        os.environ["NDVI_THREADS"] = str(max(1, (os.cpu_count() or 1) // workers))
+
+
+# Function to process all the scenes, yielding the result of each scene which succeeded as soon as it finishes.
+# With more than one worker, the scenes are processed concurrently in a pool of processes.
+# A scene which fails is reported and skipped so that the results of the other scenes are not lost.
+def processScenes(scenes: list, workers: int = 1):
+    if(workers <= 1):
+        for scene in scenes:
+            try:
+                yield processScene(*scene)
+            except Exception as e:
+                print(f"Error processing scene {scene[0]} ({scene[3]}): {e}")
+
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = initializeWorker, initargs = (workers,)) as executor:
+        futures = { executor.submit(processScene, *scene): scene for scene in scenes }
+
+        for future in concurrent.futures.as_completed(futures):
+            scene = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error processing scene {scene[0]} ({scene[3]}): {e}")
+                continue
+
+            yield result
+
+
+# Number of threads which run every stage of the pipeline. NDVI is already calculated by several threads
+# (or on the GPU), so a single scene is calculated at a time, while reading and rendering wait on the disk.
+PIPELINE_STAGE_WORKERS = { "read": 2, "compute": 1, "render": 2, "persist": 1 }
+
+
+# Function to process all the scenes in a pipeline of stages running concurrently (see pipeline.py), calling
+# on_result with the result of each scene which succeeded as soon as it finishes. The files of the bands of a scene
+# are read through by the read stage, so that the calculation never waits on the disk. At most queue_size scenes
+# wait between two stages. Their bands stay memory mapped, so a waiting scene holds little memory, unless the band
+# cache is disabled, in which case it holds its decoded bands. A scene which fails is reported and skipped.
+def processScenesPipelined(scenes: list, on_result, queue_size: int = 2, report_seconds: float = 0) -> list[pipeline.StageMetrics]:
+    stages = [
+        pipeline.Stage("read", lambda scene: readScene(*scene, prefetch = True), PIPELINE_STAGE_WORKERS["read"]),
+        pipeline.Stage("compute", computeScene, PIPELINE_STAGE_WORKERS["compute"]),
+        pipeline.Stage("render", renderScene, PIPELINE_STAGE_WORKERS["render"]),
+        pipeline.Stage("persist", persistScene, PIPELINE_STAGE_WORKERS["persist"])
+    ]
+    sat_data_paths = { scene[0]: scene[3] for scene in scenes }
+
+    # Function to report a scene which failed in any of the stages
+    def reportError(id: int, e: Exception) -> None:
+        print(f"Error processing scene {id} ({sat_data_paths[id]}): {e}")
+
+    return pipeline.runPipeline([(scene[0], scene) for scene in scenes], stages, on_result, reportError, queue_size, report_seconds)
+
+
+# Number of times a scene is claimed by the worker daemon before it is given up on
+MAX_ATTEMPTS = 3
+
+
+# Function to claim up to the given number of pending scenes for a worker in a single atomic statement.
+# A scene is claimed by setting its lease to the worker until the lease expires. Scenes leased by other workers
+# are skipped until their lease expires, so a scene whose worker died is claimed again by another worker.
+# The database clock is used for the leases, so the clocks of the nodes do not need to agree.
+def claimScenes(connection, cursor, owner: str, count: int, lease_seconds: int) -> list[tuple]:
+    cursor.execute(
+        "UPDATE STORED_DATA_INFO SET lease_owner = ?, lease_expires = NOW() + INTERVAL ? SECOND, attempts = attempts + 1 "
+        "WHERE ndvi_generated = ? AND attempts < ? AND (lease_expires IS NULL OR lease_expires < NOW()) "
+        "ORDER BY id LIMIT ?",
+        (owner, lease_seconds, 0, MAX_ATTEMPTS, count)
+    )
+    connection.commit()
+
+    if(cursor.rowcount == 0):
+        return []
+
+    cursor.execute(
+        "SELECT id, area_id, date, sat_data_path FROM STORED_DATA_INFO WHERE lease_owner = ? AND ndvi_generated = ? AND lease_expires > NOW()",
+        (owner, 0)
+    )
+    return cursor.fetchall()
+
+
+# Function to extend the leases of all the scenes a worker is still processing
+def renewLeases(connection, cursor, owner: str, lease_seconds: int) -> None:
+    cursor.execute(
+        "UPDATE STORED_DATA_INFO SET lease_expires = NOW() + INTERVAL ? SECOND WHERE lease_owner = ? AND ndvi_generated = ?",
+        (lease_seconds, owner, 0)
+    )
+    connection.commit()
+
+
+# Function to give up the lease of a scene, so that it can be claimed again straight away
+def releaseLease(connection, cursor, owner: str, id: int) -> None:
+    cursor.execute(
+        "UPDATE STORED_DATA_INFO SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+        (id, owner)
+    )
+    connection.commit()
+
+
+# Function run in every process of the pool of the worker daemon before it processes any scene.
+# The workers ignore SIGINT and SIGTERM, which are also sent to them when the daemon is stopped from a terminal or
+# a service manager, so that they finish the scenes they are processing while the daemon stops.
+def initializeDaemonWorker(workers: int) -> None:
+    initializeWorker(workers)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+# Function to run the worker daemon. The daemon keeps claiming pending scenes and processing them in a pool of
+# worker processes, and polls the database for new scenes when it has free workers. Any number of daemons on
+# any number of nodes can run against the same database, as every scene is only ever leased to one of them.
+# The daemon stops claiming scenes on SIGINT or SIGTERM and exits once the scenes it has claimed are finished.
+# If the database cannot be reached, the error is reported and the database is tried again after poll_seconds.
+# The results of the scenes which finished in the meantime are kept until they are recorded.
+def runDaemon(connection, cursor, workers: int, lease_seconds: int, poll_seconds: float) -> None:
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    print(f"Worker {owner} started with {workers} processes")
+
+    # The daemon runs for a long time, so the connection is reestablished if the database restarts
+    connection.auto_reconnect = True
+
+    stopping = False
+
+    # Function to stop claiming new scenes when the daemon is asked to stop
+    def stop(signal_number, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        print("Stopping once the claimed scenes are finished")
+
+    last_renewal = time.monotonic()
+    last_export = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = initializeDaemonWorker, initargs = (workers,)) as executor:
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        futures = {}
+
+        # Results of the scenes which finished, and ids of the scenes which failed, which are not recorded yet
+        finished_scenes = []
+        failed_ids = []
+
+        while(not stopping or len(futures) > 0 or len(finished_scenes) > 0 or len(failed_ids) > 0):
+            database_available = True
+            try:
+                # Claim as many scenes as there are free workers
+                if(not stopping and len(futures) < workers):
+                    # The scenes claimed earlier which are still being processed or recorded are returned again, and are skipped
+                    claimed_ids = set(id for (id, _) in futures.values()) | set(scene[0] for scene in finished_scenes) | set(failed_ids)
+                    for (id, area_id, date, sat_data_path) in claimScenes(connection, cursor, owner, workers - len(futures), lease_seconds):
+                        if(id in claimed_ids):
+                            continue
+
+                        # The outputs of a scene may be complete already if an earlier worker stopped before updating the database
+                        save_path = getSavePath(area_id, date)
+                        filenames = findProcessedScene(save_path, sat_data_path)
+                        if(filenames is not None):
+                            finished_scenes.append((id, save_path, filenames, getSceneClassCounts(save_path)))
+                            continue
+
+                        futures[executor.submit(processScene, id, area_id, date, sat_data_path)] = (id, sat_data_path)
+
+                # Record the scenes which finished, and give up the leases of those which failed
+                if(len(finished_scenes) > 0):
+                    updateDatabase(connection, cursor, finished_scenes)
+                    for (id, *_) in finished_scenes:
+                        print(f"Processed scene {id}")
+                    finished_scenes = []
+
+                for id in failed_ids:
+                    releaseLease(connection, cursor, owner, id)
+                failed_ids = []
+
+                # Keep the leases of the scenes being processed from expiring
+                if(time.monotonic() - last_renewal > lease_seconds / 3):
+                    renewLeases(connection, cursor, owner, lease_seconds)
+                    last_renewal = time.monotonic()
+            except mariadb.Error as e:
+                database_available = False
+                print(f"Database error: {e}. Retrying in {poll_seconds} s")
+                try:
+                    connection.rollback()
+                except mariadb.Error:
+                    pass
+
+            # The daemon only finishes when it is stopped, so the measurements of the stages are summed up as it runs,
+            # at the same interval as the leases are renewed
+            if(time.monotonic() - last_export > lease_seconds / 3):
+                try:
+                    instrumentation.writePrometheus()
+                except OSError as e:
+                    print(f"Could not write the measurements: {e}")
+                last_export = time.monotonic()
+
+            # Wait for a scene to finish, or until it is time to poll the database again.
+            # Without any scene being processed, there is nothing to wait for but the next poll.
+            if(len(futures) == 0):
+                if(not stopping or not database_available):
+                    time.sleep(poll_seconds)
+                continue
+
+            done, _ = concurrent.futures.wait(futures, timeout = poll_seconds, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (id, sat_data_path) = futures.pop(future)
+                try:
+                    finished_scenes.append(future.result())
+                except Exception as e:
+                    print(f"Error processing scene {id} ({sat_data_path}): {e}")
+                    failed_ids.append(id)
 
 
 if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--workers",
+        type = int,
+        default = 1,
+        help = "Number of scenes to process concurrently, each in its own process"
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action = "store_true",
+        help = "Process the scenes in a pipeline which reads, calculates, renders and stores different scenes at the same time"
+    )
+
+    parser.add_argument(
+        "--queue_size",
+        type = int,
+        default = 2,
+        help = "Maximum number of scenes waiting between two stages of the pipeline. A waiting scene holds little memory, as its bands are memory mapped from the band cache, unless the cache is disabled (BAND_CACHE_MAX_MB=0), in which case it holds its decoded bands."
+    )
+
+    parser.add_argument(
+        "--report_seconds",
+        type = float,
+        default = 0,
+        help = "Interval at which the queue depth of every stage of the pipeline is printed. 0 prints the measurements only at the end."
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action = "store_true",
+        help = "Keep running and process new scenes as they are added, claiming them so that several workers can run at once"
+    )
+
+    parser.add_argument(
+        "--lease_seconds",
+        type = int,
+        default = 600,
+        help = "Duration of the lease on a scene claimed by the daemon. The lease is renewed while the scene is processed."
+    )
+
+    parser.add_argument(
+        "--poll_seconds",
+        type = float,
+        default = 2,
+        help = "Interval at which the daemon checks for new scenes"
+    )
+
+    args = parser.parse_args()
+
     # Connect to database
     try:
         connection = mariadb.connect(
@@ -52,71 +639,50 @@ if(__name__ == "__main__"):
     # Get the cursor to the database
     cursor = connection.cursor()
     
-    # Get the images which have not been processed.
-    # Images that have not been processed will have a 0 in their 'ndvi_generated' field.
-    # Else it will have a 1.
-    cursor.execute("SELECT id, area_id, date, sat_data_path FROM STORED_DATA_INFO WHERE ndvi_generated = ?", (0,))
-
-    # This will contain the information about every image calculated so that database can be updated accordingly
-    database_update = []
-
-    # Iterate over each tuple
-    for (id, area_id, date, sat_data_path) in cursor:
-        # List all the image files in the required directory
-        image_files = os.listdir(sat_data_path)
-
-        # Iterate over all the image files and choose only bands 4 and 8.
-        # Load the chosen images using OpenCV.
-        for image_file in image_files:
-            if(image_file.endswith("B04.jp2")):
-                band_red_image = cv2.imread(os.path.join(sat_data_path, image_file), cv2.IMREAD_GRAYSCALE)
-
-            elif(image_file.endswith("B08.jp2")):
-                band_nir_image = cv2.imread(os.path.join(sat_data_path, image_file), cv2.IMREAD_GRAYSCALE)
-
-        # Generate the NDVI matrix.
-        # This ndvi variable will be a np.ndarray if no GPU is available.
-        # But if GPU is available, then it will be cp.ndarray.
-        ndvi = ndvi_generator.generateNDVI(band_red_image, band_nir_image)
-
-        # If executing on GPU, bring the matrix to CPU memory and free GPU memory
-        if(gpu_available == True):
-            ndvi = cp.asnumpy(ndvi)
-            cp.get_default_memory_pool().free_all_blocks()
-        
-        # Store the NDVI matrix to object storage
-        save_path = os.path.join(
-            os.environ.get("NDVI_STORAGE_BASE_DIR"),
-            str(area_id),
-            str(date)
+    if(args.daemon):
+        runDaemon(connection, cursor, args.workers, args.lease_seconds, args.poll_seconds)
+    else:
+        # Get the images which have not been processed.
+        # Images that have not been processed will have a 0 in their 'ndvi_generated' field.
+        # Else it will have a 1.
+        # Images currently leased by a worker daemon are left to it.
+        cursor.execute(
+            "SELECT id, area_id, date, sat_data_path FROM STORED_DATA_INFO WHERE ndvi_generated = ? AND (lease_expires IS NULL OR lease_expires < NOW())",
+            (0,)
         )
+        scenes = cursor.fetchall()
 
-        # Store the matrix to object storage
-        ObjectStorage.storeMatrix(ndvi, save_path, "ndvi_matrix.npy")
+        # Scenes whose outputs are already complete in object storage are not processed again.
+        # This lets an interrupted run resume where it stopped.
+        pending_scenes = []
+        resumed_scenes = []
+        for (id, area_id, date, sat_data_path) in scenes:
+            save_path = getSavePath(area_id, date)
+            filenames = findProcessedScene(save_path, sat_data_path)
+            if(filenames is not None):
+                resumed_scenes.append((id, save_path, filenames, getSceneClassCounts(save_path)))
+            else:
+                pending_scenes.append((id, area_id, date, sat_data_path))
 
-        database_update.append((id, save_path))
+        if(len(resumed_scenes) > 0):
+            print(f"Found {len(resumed_scenes)} scenes already processed in object storage")
+        updateDatabase(connection, cursor, resumed_scenes)
 
-        # Generate NDVI image and overlay with colors according to continuous values
-        ndvi_vis_continuous = visualizations.visualizeNDVIContinuous(ndvi)
-        cv2.imwrite(os.path.join(save_path, "ndvi_continuous.jpg"), ndvi_vis_continuous)
-
-        # Generate NDVI image and overlay with colors according to categorical values
-        ndvi_vis_categorical = visualizations.visualizeNDVICategorical(ndvi)
-        cv2.imwrite(os.path.join(save_path, "ndvi_categorical.jpg"), ndvi_vis_categorical)
-
-    # Update the database to reflect that images have been processed
-    for (id, save_path) in database_update:
-        # Update database indicating that NDVI images have been calculated
-        cursor.execute("UPDATE STORED_DATA_INFO SET ndvi_generated = ? WHERE id = ?", (1, id))
-
-        # Update database indicating where the NDVI files have been stored
-        cursor.execute(
-            "UPDATE STORED_DATA_INFO SET ndvi_data_path = ? WHERE id = ?",
-            (save_path, id)
-        )
-    
-    # Commit the changes to the database
-    connection.commit()
+        # Update the database as soon as each scene has been processed so that finished work is never lost.
+        # The database is only ever updated from this process.
+        if(args.pipeline):
+            processScenesPipelined(
+                pending_scenes,
+                lambda processed_scene: updateDatabase(connection, cursor, [processed_scene]),
+                args.queue_size,
+                args.report_seconds
+            )
+        else:
+            for processed_scene in processScenes(pending_scenes, args.workers):
+                updateDatabase(connection, cursor, [processed_scene])
 
     # Close the connection to the database
     connection.close()
+
+    # Sum up the measurements of the stages of this and earlier runs, including those of the worker processes
+    instrumentation.writePrometheus()
@@ -1,56 +1,270 @@
-import GPUtil
+import argparse
+import concurrent.futures
+import functools
+import importlib.util
+import os
+import time
 import numpy as np
 np.seterr(invalid = "ignore")
 
-# Check if GPU is available and set flag accordingly
-available_gpu_list = GPUtil.getAvailable()
 
-if(len(available_gpu_list) == 0):
-    gpu_available: bool = False
-else:
-    gpu_available: bool = True
+# Upper limit on the memory used by the temporary arrays while calculating NDVI.
+# This can be overridden with the NDVI_BLOCK_MEMORY_MB environment variable.
+DEFAULT_BLOCK_MEMORY_MB = 64
+
+# Bytes of temporary memory needed per pixel of a block: the two bands and their sum in float32
+# and the mask of the pixels where the sum is zero.
+_BLOCK_BYTES_PER_PIXEL = 13
+
+
+# NDVI is calculated by one of a number of backends. Each backend is registered with a function which
+# checks whether it can be used on this machine and a kernel which calculates the NDVI of a block of rows
+# of the red and near infrared bands into a float32 block of the output. All the kernels follow the same
+# definition: (nir - red) / (nir + red), with -1 where both bands are zero.
+_backends = {}
+
+# Order in which the backends are tried when no backend is forced
+BACKEND_PRIORITY = ["cupy", "fused", "numexpr", "numpy"]
+
+
+# Function to register a backend
+def registerBackend(name: str, isAvailable, kernel, release = None) -> None:
+    _backends[name] = {
+        "isAvailable": isAvailable,
+        "kernel": kernel,
+        "release": release
+    }
+
+
+# Function to choose the backend used to calculate NDVI.
+# The NDVI_BACKEND environment variable forces a backend. Otherwise the first available backend
+# in BACKEND_PRIORITY is chosen. The choice is made once, on first use, so importing this module
+# does not probe the machine for a GPU.
+@functools.lru_cache(maxsize = None)
+def getBackend() -> str:
+    forced_backend = os.environ.get("NDVI_BACKEND")
+    if(forced_backend):
+        if(forced_backend not in _backends):
+            raise ValueError(f"Unknown NDVI backend {forced_backend}. Available backends are {', '.join(_backends)}")
+        if(not _backends[forced_backend]["isAvailable"]()):
+            raise RuntimeError(f"NDVI backend {forced_backend} is not available on this machine")
+        return forced_backend
+
+    for name in BACKEND_PRIORITY:
+        if(name in _backends and _backends[name]["isAvailable"]()):
+            return name
+
+    return "numpy"
+
+
+# NumPy backend. This is always available.
+# The bands are only read: the calculation is done in float32 inside the ufuncs and written into the output
+# block, so the bands of the caller are never modified and read-only (for example memory mapped) bands work.
+def _numpyKernel(band_red_block: np.ndarray, band_nir_block: np.ndarray, output_block: np.ndarray) -> None:
+    denominator = np.add(band_nir_block, band_red_block, dtype = np.float32)
+    np.subtract(band_nir_block, band_red_block, out = output_block, dtype = np.float32)
+    zero_denominator = denominator == 0
+    np.divide(output_block, denominator, out = output_block, where = ~zero_denominator)
+
+    # Pixels where both bands are zero have no defined NDVI, so they are set to -1
+    output_block[zero_denominator] = -1.0
+
+
+registerBackend("numpy", lambda: True, _numpyKernel)
+
+
+# Number of pixels processed together by the fused kernel. This is small enough for the band values,
+# the denominator and the result of a tile to stay in the CPU cache, so the steps of the calculation
+# together make a single pass over memory.
+_FUSED_TILE_PIXELS = 32768
+
+
+# Function to calculate NDVI of a range of rows in tiles which fit in the CPU cache.
+# The bands are converted to float32 inside the ufuncs, so no converted copies of the bands are made,
+# and the result is written directly into the output. The scratch buffers are reused for every tile.
+def _fusedRows(band_red_block: np.ndarray, band_nir_block: np.ndarray, output_block: np.ndarray) -> None:
+    width = max(1, output_block.shape[1])
+    tile_rows = max(1, _FUSED_TILE_PIXELS // width)
+    denominator_buffer = np.empty((tile_rows, output_block.shape[1]), dtype = np.float32)
+    zero_buffer = np.empty((tile_rows, output_block.shape[1]), dtype = bool)
+
+    for start in range(0, output_block.shape[0], tile_rows):
+        stop = min(start + tile_rows, output_block.shape[0])
+        band_red_tile = band_red_block[start:stop]
+        band_nir_tile = band_nir_block[start:stop]
+        output_tile = output_block[start:stop]
+        denominator = denominator_buffer[:stop - start]
+        zero_denominator = zero_buffer[:stop - start]
+
+        np.add(band_nir_tile, band_red_tile, out = denominator, dtype = np.float32)
+        np.subtract(band_nir_tile, band_red_tile, out = output_tile, dtype = np.float32)
+        np.equal(denominator, 0, out = zero_denominator)
+        np.divide(output_tile, denominator, out = output_tile, where = ~zero_denominator)
+
+        # Pixels where both bands are zero have no defined NDVI, so they are set to -1
+        output_tile[zero_denominator] = -1.0
+
+
+# Number of threads used by the fused kernel.
+# This can be overridden with the NDVI_THREADS environment variable.
+@functools.lru_cache(maxsize = None)
+def _fusedThreads() -> int:
+    return max(1, int(os.environ.get("NDVI_THREADS", os.cpu_count() or 1)))
+
+
+@functools.lru_cache(maxsize = None)
+def _fusedExecutor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(max_workers = _fusedThreads())
+
+
+# Fused NumPy backend. The rows of the block are split between a pool of threads, as NumPy releases
+# the GIL while running ufuncs, and every thread calculates its rows with _fusedRows.
+def _fusedKernel(band_red_block: np.ndarray, band_nir_block: np.ndarray, output_block: np.ndarray) -> None:
+    threads = min(_fusedThreads(), output_block.shape[0])
+    if(threads <= 1):
+        _fusedRows(band_red_block, band_nir_block, output_block)
+        return
+
+    bounds = np.linspace(0, output_block.shape[0], threads + 1).astype(int)
+    futures = [
+        _fusedExecutor().submit(_fusedRows, band_red_block[start:stop], band_nir_block[start:stop], output_block[start:stop])
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+
+
+registerBackend("fused", lambda: True, _fusedKernel)
+
+
+# NumExpr backend. This evaluates the whole expression in a single multithreaded pass over the block.
+# It is used if the numexpr package is installed.
+def _numexprKernel(band_red_block: np.ndarray, band_nir_block: np.ndarray, output_block: np.ndarray) -> None:
+    import numexpr
+
+    numexpr.evaluate(
+        "where(nir + red == 0, -1, (nir - red) / (nir + red))",
+        local_dict = {
+            "red": np.asarray(band_red_block, dtype = np.float32),
+            "nir": np.asarray(band_nir_block, dtype = np.float32)
+        },
+        out = output_block,
+        casting = "same_kind"
+    )
+
+
+registerBackend("numexpr", lambda: importlib.util.find_spec("numexpr") is not None, _numexprKernel)
+
+
+# CuPy backend. Every block is copied to the GPU, calculated there and copied back to the output.
+# It is used if cupy is installed and a GPU is available. The GPU is only detected when the backend is chosen.
+def _isCupyAvailable() -> bool:
+    if(importlib.util.find_spec("cupy") is None or importlib.util.find_spec("GPUtil") is None):
+        return False
+
+    import GPUtil
+    return len(GPUtil.getAvailable()) > 0
+
+
+def _cupyKernel(band_red_block: np.ndarray, band_nir_block: np.ndarray, output_block: np.ndarray) -> None:
     import cupy as cp
 
+    # Load the block into GPU memory
+    band_red_block = cp.asarray(band_red_block, dtype = cp.float32)
+    band_nir_block = cp.asarray(band_nir_block, dtype = cp.float32)
 
-# Function to calculate NDVI on the GPU
-def _computeOnGPU(band_red_image: np.ndarray, band_nir_image: np.ndarray):
-    # Load the images into GPU memory
-    band_red_image = cp.array(band_red_image, dtype = cp.int32)
-    band_nir_image = cp.array(band_nir_image, dtype = cp.int32)
+    # Calculate NDVI of the block. Pixels where both bands are zero are set to -1.
+    denominator = band_nir_block + band_red_block
+    ndvi_block = cp.where(denominator == 0, -1.0, (band_nir_block - band_red_block) / denominator).astype(cp.float32)
 
-    # Calculate NDVI matrix
-    ndvi_image = (band_nir_image - band_red_image) / (band_nir_image + band_red_image)
+    output_block[...] = cp.asnumpy(ndvi_block)
 
-    # Substitute the NaN values with -1
-    cp.nan_to_num(ndvi_image, copy = False, nan = -1.0)
 
-    # Delete arrays which are not required any more
-    del band_red_image
-    del band_nir_image
+def _cupyRelease() -> None:
+    import cupy as cp
     cp.get_default_memory_pool().free_all_blocks()
 
-    return ndvi_image
 
+registerBackend("cupy", _isCupyAvailable, _cupyKernel, _cupyRelease)
+
+
+# Function to calculate the number of rows processed at a time so that the temporary arrays
+# of a block stay within the memory limit
+def blockRows(width: int, block_memory_mb: float = None) -> int:
+    if(block_memory_mb is None):
+        block_memory_mb = float(os.environ.get("NDVI_BLOCK_MEMORY_MB", DEFAULT_BLOCK_MEMORY_MB))
+
+    block_memory = int(block_memory_mb * 1024 * 1024)
+    return max(1, block_memory // (max(1, width) * _BLOCK_BYTES_PER_PIXEL))
+
+
+# Function to calculate the NDVI matrix of the red and near infrared bands using the chosen backend.
+# The bands are read block by block (so they can also be memory mapped or otherwise lazily loaded arrays)
+# and the result of each block is written into the output matrix. Only the temporaries of a single block
+# exist at any point of time, so the extra memory used is bounded irrespective of the size of the scene.
+# The result is written into the output matrix if one is given (for example, a memory mapped file in
+# object storage), otherwise a new float32 matrix is allocated.
+def generateNDVI(band_red_image: np.ndarray, band_nir_image: np.ndarray, output: np.ndarray = None, block_memory_mb: float = None, backend: str = None) -> np.ndarray:
+    if(output is None):
+        output = np.empty(band_red_image.shape, dtype = np.float32)
+
+    backend = _backends[backend or getBackend()]
+    rows = blockRows(band_red_image.shape[1], block_memory_mb)
+
+    for start in range(0, band_red_image.shape[0], rows):
+        stop = min(start + rows, band_red_image.shape[0])
+        backend["kernel"](band_red_image[start:stop], band_nir_image[start:stop], output[start:stop])
+
+    # Free the memory held by the backend, if any
+    if(backend["release"] is not None):
+        backend["release"]()
+
+    return output
+
+
+# Benchmark of the NDVI backends.
+# Synthetic bands are generated and the NDVI is calculated with the chosen backend (or every available
+# backend) and the throughput is printed in megapixels per second.
+if(__name__ == "__main__"):
+    parser = argparse.ArgumentParser()
 
-# Function to calculate NDVI on the CPU
-def _computeOnCPU(band_red_image: np.ndarray, band_nir_image: np.ndarray) -> np.ndarray:
-    band_red_image = band_red_image.astype(dtype = np.int32)
-    band_nir_image = band_nir_image.astype(dtype = np.int32)
+    parser.add_argument(
+        "--size",
+        type = int,
+        default = 4096,
+        help = "Number of rows and columns of the synthetic bands"
+    )
 
-    # Calculate NDVI
-    ndvi_image = (band_nir_image - band_red_image) / (band_nir_image + band_red_image)
+    parser.add_argument(
+        "--repeat",
+        type = int,
+        default = 3,
+        help = "Number of times each backend is run. The fastest run is reported."
+    )
 
-    # Substitute the NaN values with -1
-    np.nan_to_num(ndvi_image, copy = False, nan = -1.0)
+    parser.add_argument(
+        "--all",
+        action = "store_true",
+        help = "Benchmark every available backend instead of only the chosen one"
+    )
 
-    return ndvi_image
+    args = parser.parse_args()
 
+    generator = np.random.default_rng(0)
+    band_red_image = generator.integers(0, 256, (args.size, args.size), dtype = np.uint8)
+    band_nir_image = generator.integers(0, 256, (args.size, args.size), dtype = np.uint8)
+    output = np.empty(band_red_image.shape, dtype = np.float32)
+    megapixels = band_red_image.size / 1e6
 
-def generateNDVI(band_red_image: np.ndarray, band_nir_image: np.ndarray) -> np.ndarray:
+    chosen_backend = getBackend()
+    print(f"Chosen backend: {chosen_backend}")
 
-    if not gpu_available:
-        ndvi_image = _computeOnCPU(band_red_image, band_nir_image)
-    else:
-        ndvi_image = _computeOnGPU(band_red_image, band_nir_image)
+    names = [name for name in _backends if _backends[name]["isAvailable"]()] if args.all else [chosen_backend]
+    for name in names:
+        elapsed = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            generateNDVI(band_red_image, band_nir_image, output = output, backend = name)
+            elapsed = min(elapsed, time.perf_counter() - start)
 
-    return ndvi_image
+        print(f"{name:<10}{megapixels / elapsed:>10.1f} MP/s ({elapsed * 1000:.1f} ms for {megapixels:.1f} MP)")
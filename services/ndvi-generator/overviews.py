@@ -0,0 +1,76 @@
+import cv2
+import os
+import numpy as np
+
+import visualizations
+
+# This module builds a pyramid of downsampled overviews of the NDVI matrix of a scene and of both its
+# visualizations, so that previews of a whole area can be shown without reading the full resolution data.
+# Every level halves the rows and columns of the level above it. The NDVI matrix of a level is the mean of
+# blocks of 2 x 2 pixels of the level above, and the visualizations of a level are rendered from its matrix.
+# The overviews are stored in a directory next to the NDVI matrix, with the factor by which each level is
+# downsampled in its filename (ndvi_matrix_4.npy, ndvi_continuous_4.jpg and ndvi_categorical_4.jpg for 1/4).
+# The analyzer reads the coarsest level which meets the resolution of a preview (see loadNDVIOverview).
+
+OVERVIEW_DIRECTORY = "overviews"
+
+# Factors by which the levels of the pyramid are downsampled
+OVERVIEW_FACTORS = (2, 4, 8, 16)
+
+# Number of rows of the downsampled matrix calculated at a time. This bounds the temporary memory used
+# when the level above is a memory mapped full resolution matrix.
+OVERVIEW_BLOCK_ROWS = 512
+
+
+# Function to get the filename of a level of the pyramid
+def getOverviewFilename(name: str, factor: int, extension: str) -> str:
+    return f"{name}_{factor}{extension}"
+
+
+# Function to downsample a matrix by 2 in both directions by taking the mean of blocks of 2 x 2 pixels.
+# An odd last row or column is averaged with itself. The matrix is read block by block, so it can also
+# be a memory mapped matrix.
+def downsampleMatrix(matrix: np.ndarray) -> np.ndarray:
+    rows, columns = matrix.shape
+    downsampled = np.empty(((rows + 1) // 2, (columns + 1) // 2), dtype = np.float32)
+
+    for start in range(0, rows, 2 * OVERVIEW_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + 2 * OVERVIEW_BLOCK_ROWS], dtype = np.float32)
+        if(block.shape[0] % 2 == 1):
+            block = np.concatenate([block, block[-1:]], axis = 0)
+        if(columns % 2 == 1):
+            block = np.concatenate([block, block[:, -1:]], axis = 1)
+
+        output = downsampled[start // 2:(start + block.shape[0]) // 2]
+        np.add(block[0::2, 0::2], block[0::2, 1::2], out = output)
+        output += block[1::2, 0::2]
+        output += block[1::2, 1::2]
+        output *= np.float32(0.25)
+
+    return downsampled
+
+
+# Function to build the pyramid of overviews of an NDVI matrix and store it in the given path.
+# Every level is calculated from the level above it, starting from the full resolution matrix.
+# Returns the factors of the levels which were built. Levels which would be smaller than a pixel are skipped.
+def buildOverviews(ndvi_image: np.ndarray, save_path: str, factors: tuple[int] = OVERVIEW_FACTORS) -> list[int]:
+    overview_path = os.path.join(save_path, OVERVIEW_DIRECTORY)
+    os.makedirs(overview_path, exist_ok = True)
+
+    level = ndvi_image
+    level_factor = 1
+    built_factors = []
+    for factor in sorted(factors):
+        while(level_factor < factor and max(level.shape) > 1):
+            level = downsampleMatrix(level)
+            level_factor *= 2
+
+        if(level_factor != factor):
+            break
+
+        np.save(os.path.join(overview_path, getOverviewFilename("ndvi_matrix", factor, ".npy")), level)
+        cv2.imwrite(os.path.join(overview_path, getOverviewFilename("ndvi_continuous", factor, ".jpg")), visualizations.visualizeNDVIContinuous(level))
+        cv2.imwrite(os.path.join(overview_path, getOverviewFilename("ndvi_categorical", factor, ".jpg")), visualizations.visualizeNDVICategorical(level))
+        built_factors.append(factor)
+
+    return built_factors
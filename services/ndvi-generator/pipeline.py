@@ -0,0 +1,176 @@
+import asyncio
+import concurrent.futures
+import time
+
+# This module runs items through a sequence of stages connected by bounded queues, so that the stages of
+# different items overlap: while one scene is being calculated, the bands of the next are read and the
+# outputs of the last are written. Every stage runs its function in its own pool of threads, driven by a
+# single asyncio event loop. The queues bound the number of items waiting between two stages, so a fast
+# stage waits for a slow one instead of holding every item in memory.
+#
+# The queue depth, throughput and busy time of every stage are measured. A stage whose input queue is
+# usually full and which is busy most of the time is the bottleneck. A stage which is often starved waits
+# on the stage before it, and a stage which is often blocked waits for room in the queue of the stage after it.
+
+# Marks the end of the items in a queue
+_END = object()
+
+
+# Class which holds a stage of the pipeline: a function called with the output of the previous stage
+# (or with an item, for the first stage) and the number of threads which run it
+class Stage:
+    def __init__(self, name: str, function, workers: int = 1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+
+
+# Class which holds the measurements of a stage
+class StageMetrics:
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.items = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    # Records the depth of the input queue of the stage
+    def sampleDepth(self, depth: int) -> None:
+        self.depth_samples += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def meanDepth(self) -> float:
+        return self.depth_total / max(self.depth_samples, 1)
+
+    # Fraction of the time the threads of the stage spent running its function
+    def utilization(self, elapsed_seconds: float) -> float:
+        return self.busy_seconds / max(elapsed_seconds * self.workers, 1e-9)
+
+    def throughput(self, elapsed_seconds: float) -> float:
+        return self.items / max(elapsed_seconds, 1e-9)
+
+
+# Function to format the measurements of all the stages as a table.
+# The stage which was busy for the largest fraction of the time is marked as the bottleneck.
+def formatMetrics(metrics: list[StageMetrics], elapsed_seconds: float) -> str:
+    bottleneck = max(metrics, key = lambda stage: stage.utilization(elapsed_seconds)).name if len(metrics) > 0 else None
+
+    lines = [
+        f"{'Stage':<10}{'Workers':>8}{'Items':>7}{'Failed':>7}{'Items/s':>9}{'Busy':>7}{'Queue':>10}{'Max':>5}{'Starved s':>11}{'Blocked s':>11}"
+    ]
+    for stage in metrics:
+        lines.append(
+            f"{stage.name:<10}{stage.workers:>8}{stage.items:>7}{stage.failures:>7}"
+            f"{stage.throughput(elapsed_seconds):>9.2f}{stage.utilization(elapsed_seconds) * 100:>6.0f}%"
+            f"{stage.meanDepth():>6.1f}/{stage.queue_size:<3}{stage.max_depth:>5}"
+            f"{stage.starved_seconds:>11.1f}{stage.blocked_seconds:>11.1f}"
+            + ("  <- bottleneck" if stage.name == bottleneck else "")
+        )
+
+    return "\n".join(lines)
+
+
+# Function to run a single thread of a stage. It takes items from the input queue until the end is reached,
+# and passes the output of the stage for every item to the output queue, or to on_result for the last stage.
+# on_result is run in result_executor, so that a slow callback does not hold up the event loop and the other stages.
+# An item which fails is passed to on_error with the exception and does not go through the later stages.
+async def _runWorker(stage: Stage, metrics: StageMetrics, executor, input_queue: asyncio.Queue, output_queue: asyncio.Queue, on_result, on_error, result_executor) -> None:
+    loop = asyncio.get_running_loop()
+
+    while(True):
+        start = time.perf_counter()
+        entry = await input_queue.get()
+        metrics.starved_seconds += time.perf_counter() - start
+        metrics.sampleDepth(input_queue.qsize())
+
+        if(entry is _END):
+            return
+
+        (key, value) = entry
+        start = time.perf_counter()
+        try:
+            output = await loop.run_in_executor(executor, stage.function, value)
+        except Exception as e:
+            metrics.busy_seconds += time.perf_counter() - start
+            metrics.failures += 1
+            on_error(key, e)
+            continue
+
+        metrics.busy_seconds += time.perf_counter() - start
+        metrics.items += 1
+
+        start = time.perf_counter()
+        if(output_queue is None):
+            await loop.run_in_executor(result_executor, on_result, output)
+        else:
+            await output_queue.put((key, output))
+        metrics.blocked_seconds += time.perf_counter() - start
+
+
+# Function to print the depth of every queue and the number of items every stage has finished, at the given interval
+async def _reportProgress(queues: list[asyncio.Queue], metrics: list[StageMetrics], report_seconds: float) -> None:
+    while(True):
+        await asyncio.sleep(report_seconds)
+        print(" | ".join(f"{stage.name}: {queue.qsize()}/{stage.queue_size} queued, {stage.items} done" for stage, queue in zip(metrics, queues)))
+
+
+# Function to run the items through the stages of the pipeline. The items are given as (key, value) pairs, where
+# the value is passed to the first stage and the key identifies the item to on_error.
+# on_result is called with the output of the last stage for every item, in a thread of its own, one item at a time,
+# so it is never called concurrently and can block (for example on a database). on_error is called from the event
+# loop, so it must not block. Returns the measurements of every stage.
+async def runPipelineAsync(items: list[tuple], stages: list[Stage], on_result, on_error, queue_size: int = 2, report_seconds: float = 0) -> list[StageMetrics]:
+    queues = [asyncio.Queue(maxsize = max(1, queue_size)) for _ in stages]
+    metrics = [StageMetrics(stage.name, stage.workers, max(1, queue_size)) for stage in stages]
+    executors = [concurrent.futures.ThreadPoolExecutor(max_workers = stage.workers, thread_name_prefix = stage.name) for stage in stages]
+    result_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "result")
+
+    # Function to run all the threads of a stage, and end the input of the next stage once they have all finished
+    async def runStage(index: int) -> None:
+        output_queue = queues[index + 1] if index + 1 < len(stages) else None
+        await asyncio.gather(*[
+            _runWorker(stages[index], metrics[index], executors[index], queues[index], output_queue, on_result, on_error, result_executor)
+            for _ in range(stages[index].workers)
+        ])
+
+        if(output_queue is not None):
+            for _ in range(stages[index + 1].workers):
+                await output_queue.put(_END)
+
+    # Function to feed the items to the first stage
+    async def feed() -> None:
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(stages[0].workers):
+            await queues[0].put(_END)
+
+    reporter = asyncio.create_task(_reportProgress(queues, metrics, report_seconds)) if report_seconds > 0 else None
+    try:
+        await asyncio.gather(feed(), *[runStage(index) for index in range(len(stages))])
+    finally:
+        if(reporter is not None):
+            reporter.cancel()
+        for executor in executors + [result_executor]:
+            executor.shutdown(wait = True)
+
+    return metrics
+
+
+# Function to run the items through the stages of the pipeline in a new event loop and print the measurements
+# of every stage at the end. See runPipelineAsync.
+def runPipeline(items: list[tuple], stages: list[Stage], on_result, on_error, queue_size: int = 2, report_seconds: float = 0) -> list[StageMetrics]:
+    start = time.perf_counter()
+    metrics = asyncio.run(runPipelineAsync(items, stages, on_result, on_error, queue_size, report_seconds))
+    elapsed_seconds = time.perf_counter() - start
+
+    print(f"\nPipeline finished in {elapsed_seconds:.1f} s")
+    print(formatMetrics(metrics, elapsed_seconds))
+
+    return metrics
@@ -0,0 +1,138 @@
+import os
+import numpy as np
+
+import ndvi_generator
+
+# This module calculates a number of spectral indices from the bands of a scene in a single pass.
+# The bands are read block by block, every band needed by any of the requested indices is converted
+# to float32 once per block, and the intermediate results shared between indices (like nir - red)
+# are calculated once per block and reused by every index which needs them.
+#
+# NDVI and NDWI are ratios and are calculated directly from the band values. NDVI is calculated from
+# the same nir - red and nir + red as SAVI and EVI, in float32 like the numpy backend of ndvi_generator,
+# so the result matches an NDVI-only run with that backend. EVI and SAVI have constant terms, so they
+# are calculated from reflectance, which is the band value multiplied by the reflectance scale
+# (REFLECTANCE_SCALE in the .env file, 0.0001 for Sentinel-2 L1C products).
+# Like NDVI, an index is set to -1 where its denominator is zero.
+
+DEFAULT_REFLECTANCE_SCALE = 0.0001
+
+# Soil brightness correction factor of SAVI
+SAVI_L = 0.5
+
+
+# Class which calculates the intermediate results of a block on first use and keeps them for the other indices
+class _BlockIntermediates:
+    def __init__(self, band_blocks: dict[str: np.ndarray], reflectance_scale: float):
+        self.band_blocks = band_blocks
+        self.reflectance_scale = np.float32(reflectance_scale)
+        self.values = {}
+
+    def get(self, name: str) -> np.ndarray:
+        if(name not in self.values):
+            self.values[name] = self._calculate(name)
+        return self.values[name]
+
+    def _calculate(self, name: str) -> np.ndarray:
+        # Band values converted to float32
+        if(name in ("B02", "B03", "B04", "B08")):
+            return np.asarray(self.band_blocks[name], dtype = np.float32)
+
+        # Band values converted to reflectance
+        if(name.startswith("reflectance_")):
+            return self.get(name[len("reflectance_"):]) * self.reflectance_scale
+
+        if(name == "nir_minus_red"):
+            return self.get("B08") - self.get("B04")
+        if(name == "nir_plus_red"):
+            return self.get("B08") + self.get("B04")
+        if(name == "green_minus_nir"):
+            return self.get("B03") - self.get("B08")
+        if(name == "green_plus_nir"):
+            return self.get("B03") + self.get("B08")
+
+        raise KeyError(f"Unknown intermediate result {name}")
+
+
+# Function to divide two arrays into the output, setting the output to -1 where the denominator is zero
+def _ratio(numerator: np.ndarray, denominator: np.ndarray, output: np.ndarray) -> None:
+    zero_denominator = denominator == 0
+    np.divide(numerator, denominator, out = output, where = ~zero_denominator)
+    output[zero_denominator] = -1.0
+
+
+def _ndvi(intermediates: _BlockIntermediates, output: np.ndarray) -> None:
+    _ratio(intermediates.get("nir_minus_red"), intermediates.get("nir_plus_red"), output)
+
+
+def _ndwi(intermediates: _BlockIntermediates, output: np.ndarray) -> None:
+    _ratio(intermediates.get("green_minus_nir"), intermediates.get("green_plus_nir"), output)
+
+
+def _savi(intermediates: _BlockIntermediates, output: np.ndarray) -> None:
+    scale = intermediates.reflectance_scale
+    numerator = intermediates.get("nir_minus_red") * (scale * np.float32(1 + SAVI_L))
+    denominator = intermediates.get("nir_plus_red") * scale + np.float32(SAVI_L)
+    _ratio(numerator, denominator, output)
+
+
+def _evi(intermediates: _BlockIntermediates, output: np.ndarray) -> None:
+    scale = intermediates.reflectance_scale
+    numerator = intermediates.get("nir_minus_red") * (scale * np.float32(2.5))
+    denominator = (
+        intermediates.get("reflectance_B08") +
+        np.float32(6) * intermediates.get("reflectance_B04") -
+        np.float32(7.5) * intermediates.get("reflectance_B02") +
+        np.float32(1)
+    )
+    _ratio(numerator, denominator, output)
+
+
+# The indices which can be calculated, along with the bands each of them needs
+INDICES = {
+    "ndvi": { "bands": ("B04", "B08"), "function": _ndvi },
+    "ndwi": { "bands": ("B03", "B08"), "function": _ndwi },
+    "savi": { "bands": ("B04", "B08"), "function": _savi },
+    "evi": { "bands": ("B02", "B04", "B08"), "function": _evi }
+}
+
+
+# Function to get the indices to calculate from the SPECTRAL_INDICES environment variable.
+# This is a comma separated list of index names and defaults to NDVI only.
+def getRequestedIndices() -> list[str]:
+    names = [name.strip().lower() for name in os.environ.get("SPECTRAL_INDICES", "ndvi").split(",") if name.strip()]
+
+    unknown_names = [name for name in names if name not in INDICES]
+    if(len(unknown_names) > 0):
+        raise ValueError(f"Unknown spectral indices {', '.join(unknown_names)}. Available indices are {', '.join(INDICES)}")
+
+    return names
+
+
+# Function to get all the bands needed to calculate the given indices
+def getRequiredBands(names: list[str]) -> list[str]:
+    return sorted(set(band for name in names for band in INDICES[name]["bands"]))
+
+
+# Function to calculate a number of indices from the bands of a scene in a single pass.
+# The bands are given as a dictionary from band name (B02, B03, B04, B08) to image, and the result of every
+# index is written into the float32 output matrix given for it in the outputs dictionary.
+def computeIndices(bands: dict[str: np.ndarray], outputs: dict[str: np.ndarray], reflectance_scale: float = None, block_memory_mb: float = None) -> dict[str: np.ndarray]:
+    if(reflectance_scale is None):
+        reflectance_scale = float(os.environ.get("REFLECTANCE_SCALE", DEFAULT_REFLECTANCE_SCALE))
+
+    shape = next(iter(outputs.values())).shape
+
+    # Every block holds more temporaries than a single NDVI calculation, so fewer rows are processed at a time
+    rows = max(1, ndvi_generator.blockRows(shape[1], block_memory_mb) // max(1, len(outputs)))
+
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+
+        band_blocks = { band: image[start:stop] for band, image in bands.items() }
+        intermediates = _BlockIntermediates(band_blocks, reflectance_scale)
+
+        for name, output in outputs.items():
+            INDICES[name]["function"](intermediates, output[start:stop])
+
+    return outputs
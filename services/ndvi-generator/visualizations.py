@@ -1,4 +1,5 @@
 import cv2
+import functools
 import os
 import numpy as np
 
@@ -40,81 +41,138 @@ def visualizeRGB(band_red_image: np.ndarray, band_green_image: np.ndarray, band_
 
 # Function to visualize the NDVI image calculated.
 # Input is a numpy array of the NDVI image (values ranging between -1 and 1).
-# Output will be a JPG file.
+# Output will be a BGR image with 8 bit channels which can be written directly as a JPG file.
 def visualizeNDVIContinuous(ndvi_image: np.ndarray) -> np.ndarray:
-    
-    band_blue_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    band_green_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    band_red_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    for row in range(ndvi_image.shape[0]):
-        for column in range(ndvi_image.shape[1]):
-
-            # Continuous
-            # If the NDVI value is less than 0, then we consider no vegetation hence the nir band is mapped to the entire red band
-            if(ndvi_image[row][column] < 0):
-                band_red_image[row][column] = 255
-
-            # If the NDVI value is greater than equal to 0 and less than 0.4, then we consider relatively less vegetation hence depending on the value of ndvi the colour varies from orange(ndvi 0) to yellow(ndvi 0.4)
-            # The red band is fixed to 255
-            #The value of green band varies from 150 to 255
-            elif(ndvi_image[row][column] >= 0 and ndvi_image[row][column] < 0.4):    
-                band_red_image[row][column] = 255
-                band_green_image[row][column] = 150 + ndvi_image[row][column] * 262.5
-
-            # If the NDVI value is greater than equal to 0.4, then we consider vegetation hence depending on the value of ndvi the colour varies from light green(ndvi 0.6) to deep green(ndvi 1)
-            else:
-                #The value of green band varies from 255 to 75
-                band_green_image[row][column] = (1 - ndvi_image[row][column]) * 300 + 75
-            
-    final_ndvi_image = cv2.merge([band_blue_image, band_green_image, band_red_image])
-            
-    return final_ndvi_image
+    edges, lookup_table = _continuousPalette()
+    return renderPalette(ndvi_image, edges, lookup_table)
 
 
 # This function produces a visualisation (image) of the NDVI matrix by assigning distinct
 # colors to each of the 4 categories of NDVI values defined in the .env file.
 def visualizeNDVICategorical(ndvi_image: np.ndarray) -> np.ndarray:
-    
-    band_blue_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    band_green_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    band_red_image = np.zeros(ndvi_image.shape, dtype = np.float32)
-    for row in range(ndvi_image.shape[0]):
-        for column in range(ndvi_image.shape[1]):
-         
-            #Categorical
-
-            # If heavy vegetation, a deep green colour is chosen
-            if(ndvi_image[row][column] >= float(os.environ.get("NDVI_THICK_VEGETATION"))):
-                band_red_image[row][column] = 1
-                band_green_image[row][column] = 133
-                band_blue_image[row][column] = 113
-            
-            # If moderate vegetation, a light green colour is chosen
-            elif(ndvi_image[row][column] >= float(os.environ.get("NDVI_MODERATE_VEGETATION"))):
-                band_red_image[row][column] = 128
-                band_green_image[row][column] = 205
-                band_blue_image[row][column] = 193
-            
-            # If sparse vegetation, a white colour is chosen
-            elif(ndvi_image[row][column] >= float(os.environ.get("NDVI_SPARSE_VEGETATION"))):
-                band_red_image[row][column] = 245
-                band_green_image[row][column] = 245
-                band_blue_image[row][column] = 245
-            
-            # If no vegetation, a light brown colour is chosen
-            elif(ndvi_image[row][column] >= float(os.environ.get("NDVI_NO_VEGETATION"))):
-                band_red_image[row][column] = 223
-                band_green_image[row][column] = 194
-                band_blue_image[row][column] = 125
-
-                # This is a dark brown colour which goes well with this color scheme.
-                # It is not required for this purpose as we are only interested with vegetation.
-                # But it has been kept here so that in the future, if a new class needs to be added
-                # which is on the negative NDVI scale, then this color can be used.
-                # band_red_image[row][column] = 166
-                # band_green_image[row][column] = 97
-                # band_blue_image[row][column] = 26      
-
-    final_ndvi_image = cv2.merge([band_blue_image, band_green_image, band_red_image])
-            
-    return final_ndvi_image
+    edges, lookup_table = _categoricalPalette()
+    return renderPalette(ndvi_image, edges, lookup_table)
+
+
+# Number of rows of the NDVI matrix rendered at a time. This bounds the size of the temporary
+# palette indices irrespective of the size of the scene.
+RENDER_BLOCK_ROWS = 512
+
+
+# Function to render an NDVI matrix using a palette.
+# The palette is given by a sorted array of NDVI values at which the colour changes (edges) and a
+# lookup table of uint8 BGR colours. Row i of the lookup table is the colour of the values which are
+# greater than or equal to exactly i edges. The last row of the lookup table is the colour of NaN values.
+# Every pixel is quantized into its palette index and the colour is written directly to the output image.
+def renderPalette(ndvi_image: np.ndarray, edges: np.ndarray, lookup_table: np.ndarray) -> np.ndarray:
+    output_image = np.empty(ndvi_image.shape + (3,), dtype = np.uint8)
+    nan_index = lookup_table.shape[0] - 1
+
+    for start in range(0, ndvi_image.shape[0], RENDER_BLOCK_ROWS):
+        block = ndvi_image[start:start + RENDER_BLOCK_ROWS]
+
+        # Quantize the block into palette indices
+        indices = np.searchsorted(edges, block, side = "right")
+        indices[np.isnan(block)] = nan_index
+
+        # Look up the colours and write them into the output image
+        np.take(lookup_table, indices, axis = 0, out = output_image[start:start + RENDER_BLOCK_ROWS])
+
+    return output_image
+
+
+# Function to calculate the colours of the continuous visualization for an array of NDVI values.
+# This is the reference definition of the colour ramp from which the palette is built. The channels
+# are calculated in float32 and converted to uint8 by rounding and saturation, exactly as OpenCV
+# does while writing a float32 image.
+# If the NDVI value is less than 0, then we consider no vegetation hence the colour is red.
+# If the NDVI value is greater than equal to 0 and less than 0.4, then we consider relatively less
+# vegetation hence depending on the value of ndvi the colour varies from orange(ndvi 0) to yellow(ndvi 0.4).
+# The red band is fixed to 255 and the green band varies from 150 to 255.
+# If the NDVI value is greater than equal to 0.4, then we consider vegetation hence depending on the value
+# of ndvi the colour varies from light green(ndvi 0.4) to deep green(ndvi 1). The green band varies from 255 to 75.
+def _continuousColours(ndvi_values: np.ndarray) -> np.ndarray:
+    colours = np.zeros(ndvi_values.shape + (3,), dtype = np.float32)
+
+    no_vegetation = ndvi_values < 0
+    less_vegetation = (ndvi_values >= 0) & (ndvi_values < 0.4)
+    vegetation = ~(no_vegetation | less_vegetation)
+
+    colours[no_vegetation, 2] = 255
+    colours[less_vegetation, 2] = 255
+    colours[less_vegetation, 1] = 150 + ndvi_values[less_vegetation] * 262.5
+    colours[vegetation, 1] = (1 - ndvi_values[vegetation]) * 300 + 75
+
+    # Convert to 8 bit in the same way as OpenCV (round half to even, saturate, NaN becomes 0)
+    colours = np.nan_to_num(colours, nan = 0.0)
+    return np.clip(np.rint(colours), 0, 255).astype(np.uint8)
+
+
+# Function to build the palette of the continuous visualization.
+# The colour ramp is sampled densely and every change of colour between two neighbouring samples is
+# narrowed down by bisection to the exact float64 value where it happens. This makes the palette
+# reproduce the reference colours for every possible input value, including the values lying exactly
+# on a rounding boundary.
+@functools.lru_cache(maxsize = None)
+def _continuousPalette() -> tuple[np.ndarray, np.ndarray]:
+    samples = np.linspace(-2.0, 2.0, 2 ** 18 + 1)
+    sample_colours = _continuousColours(samples)
+
+    changes = np.flatnonzero(np.any(sample_colours[1:] != sample_colours[:-1], axis = 1))
+    low = samples[changes]
+    high = samples[changes + 1]
+    low_colours = sample_colours[changes]
+
+    # Bisect all the intervals together until low and high are neighbouring float64 values
+    while(True):
+        middle = low + (high - low) / 2
+        active = (middle != low) & (middle != high)
+        if(not np.any(active)):
+            break
+
+        same_as_low = np.all(_continuousColours(middle) == low_colours, axis = 1)
+        low = np.where(active & same_as_low, middle, low)
+        high = np.where(active & ~same_as_low, middle, high)
+
+    # The colour changes at the first value of each interval which does not have the colour of the lower end
+    edges = high
+    lookup_table = np.concatenate([
+        sample_colours[:1],
+        _continuousColours(edges),
+        _continuousColours(np.array([np.nan]))
+    ])
+
+    return edges, lookup_table
+
+
+# Function to build the palette of the categorical visualization from the thresholds in the .env file.
+# If heavy vegetation, a deep green colour is chosen.
+# If moderate vegetation, a light green colour is chosen.
+# If sparse vegetation, a white colour is chosen.
+# If no vegetation, a light brown colour is chosen.
+# Values below the no vegetation threshold, and NaN values, are left black.
+def _categoricalPalette() -> tuple[np.ndarray, np.ndarray]:
+    edges = np.array([
+        float(os.environ.get("NDVI_NO_VEGETATION")),
+        float(os.environ.get("NDVI_SPARSE_VEGETATION")),
+        float(os.environ.get("NDVI_MODERATE_VEGETATION")),
+        float(os.environ.get("NDVI_THICK_VEGETATION"))
+    ])
+
+    # Colours are in BGR order as OpenCV works with BGR and not RGB
+    lookup_table = np.array([
+        [0, 0, 0],
+        [125, 194, 223],
+        [245, 245, 245],
+        [193, 205, 128],
+        [113, 133, 1],
+        [0, 0, 0]
+    ], dtype = np.uint8)
+
+    # This is a dark brown colour which goes well with this color scheme.
+    # It is not required for this purpose as we are only interested with vegetation.
+    # But it has been kept here so that in the future, if a new class needs to be added
+    # which is on the negative NDVI scale, then this color can be used.
+    # [26, 97, 166]
+
+    return edges, lookup_table